@@ -13,7 +13,10 @@
 /************************************************************************/
 
 /* To build python bindings: gcc -O3 -Wall -Wextra -shared align.c -o libalign.so */
-/* WARNING: currently not thread-safe */
+/* All the state of an alignment is held in a struct align_context, so     */
+/* several alignments can run at once, each in its own context. The        */
+/* functions without a context argument work on a single global context,   */
+/* and are kept for the command line tool and older bindings.              */
 
 #include <stdio.h>
 #include <string.h>
@@ -47,16 +50,8 @@
 int g_maxsymbol = 0;
 int g_debug = 0;
 int g_med = 0;
-int g_in_result[256];
-int g_out_result[256];
-int g_paircount = 0;
-int g_distinct_pairs = 0;
 int g_input_format = INPUT_FORMAT_L2P;
 int g_output_format = OUTPUT_FORMAT_ALIGNED;
-double g_trellis[256][256];
-int g_backptr[256][256];
-int g_current_count[256][256];
-int g_global_count[256][256];
 char *g_symboltable[1024];
 double g_prior = 0.1;
 double g_zero = 0.0;
@@ -67,11 +62,58 @@ struct stringpair {          /* These are all               */
     int *inaligned;
     int *outaligned;
     struct stringpair *next;
-} *g_stringpairs = NULL, *g_stringpairs_tail = NULL;
+};
+
+struct align_context {
+    int maxsymbol;                  /* Largest symbol number added    */
+    int paircount;
+    int distinct_pairs;
+    double prior;
+    unsigned short rand_state[3];   /* erand48() state of the sampler */
+    int in_result[256];
+    int out_result[256];
+    double trellis[256][256];
+    int backptr[256][256];
+    int current_count[256][256];
+    int global_count[256][256];
+    struct stringpair *stringpairs;
+    struct stringpair *stringpairs_tail;
+};
+
+struct align_context *g_context = NULL;
+
+void ctx_add_int_pair(struct align_context *ctx, int *in, int *out);
+void ctx_clear_pairs(struct align_context *ctx);
+
+/* Seeds the sampler of a context as srand48(seed) would seed drand48() */
+void align_context_seed(struct align_context *ctx, long seed) {
+	ctx->rand_state[0] = 0x330E;
+	ctx->rand_state[1] = (unsigned short)(seed & 0xFFFF);
+	ctx->rand_state[2] = (unsigned short)((seed >> 16) & 0xFFFF);
+}
+
+/* A new, empty context. Its sampler starts where an unseeded drand48() does */
+struct align_context *align_context_new(void) {
+	struct align_context *ctx;
+	ctx = calloc(1, sizeof(struct align_context));
+	if (ctx == NULL) {
+		return NULL;
+	}
+	ctx->prior = g_prior;     /* rand_state is zeroed, as glibc leaves the drand48() state */
+	return ctx;
+}
+
+void align_context_free(struct align_context *ctx) {
+	if (ctx == NULL) {
+		return;
+	}
+	ctx_clear_pairs(ctx);
+	free(ctx);
+}
 
 void align_init(void) {
-	g_stringpairs = NULL;
-	g_stringpairs_tail = NULL;	
+	align_context_free(g_context);
+	g_context = align_context_new();
 }
 
 int intseqlen(int *seq) {
@@ -141,7 +183,7 @@ int utf8strlen(char *str) {
 	return j;
 }
 
-int random_3draw(double a, double b, double c) {
+int random_3draw(struct align_context *ctx, double a, double b, double c) {
 
     /* From three negative logprobs, do a weighted coin toss */
     /* proportional to each probability, returing -1, 0, 1   */
@@ -159,7 +201,7 @@ int random_3draw(double a, double b, double c) {
 	a = exp(-a);         /* Convert to three probabilities */
 	b = exp(-b);
 	c = exp(-c);
-	rand = drand48();
+	rand = erand48(ctx->rand_state);
 	rand = rand * (a + b + c);
 	if (rand < a)   { return -1; }
 	if (rand < a+b) { return  0; }
@@ -167,37 +209,38 @@ int random_3draw(double a, double b, double c) {
 }
 
 /* Fills trellis with aligned integer sequences in and out, using the callback function  */
-/* cost().  Returns aligned strings in g_in_result[] and g_out_result[]                  */
+/* cost().  Returns aligned strings in ctx->in_result[] and ctx->out_result[]            */
 /* If mode = MODE_GS, we resample alignments by a CRP process (filling trellis "forward" */
 /*                    and then drawing a new alignment going "backward")                 */
 /* If mode = MODE_MED, we find the "cheapest" alignment                                  */
 
-double fill_trellis(int *in, int *out, double(*cost)(int, int), int mode) {
+double fill_trellis(struct align_context *ctx, int *in, int *out, double(*cost)(struct align_context *, int, int),
+                    int mode) {
     int i, x, y, inlen, outlen;
     double left, down, diag, p;
     inlen = intseqlen(in);
     outlen = intseqlen(out);
-    g_trellis[0][0] = g_zero;
+    ctx->trellis[0][0] = g_zero;
     for (x = 1; x <= outlen; x++) {
-		g_trellis[x][0] = g_trellis[x-1][0] + cost(0,out[x-1]);
-		g_backptr[x][0] = LEFT;
+		ctx->trellis[x][0] = ctx->trellis[x-1][0] + cost(ctx, 0,out[x-1]);
+		ctx->backptr[x][0] = LEFT;
     }
     for (y = 1; y <= inlen; y++) {
-		g_trellis[0][y] = g_trellis[0][y-1] + cost(in[y-1], 0);
-		g_backptr[0][y] = DOWN;
+		ctx->trellis[0][y] = ctx->trellis[0][y-1] + cost(ctx, in[y-1], 0);
+		ctx->backptr[0][y] = DOWN;
     }
     for (x = 1; x <= outlen; x++) {
 		for (y = 1; y <= inlen; y++) {
-			left = g_trellis[x-1][y] + cost(0,out[x-1]);
-			down = g_trellis[x][y-1] + cost(in[y-1], 0);
-			diag = g_trellis[x-1][y-1] + cost(in[y-1], out[x-1]);
+			left = ctx->trellis[x-1][y] + cost(ctx, 0,out[x-1]);
+			down = ctx->trellis[x][y-1] + cost(ctx, in[y-1], 0);
+			diag = ctx->trellis[x-1][y-1] + cost(ctx, in[y-1], out[x-1]);
 	    
 			if (mode == MATRIX_MODE_MED) {
-				g_trellis[x][y] = MIN3(left, diag, down);
-				g_backptr[x][y] = CMP3(left, diag, down);
+				ctx->trellis[x][y] = MIN3(left, diag, down);
+				ctx->backptr[x][y] = CMP3(left, diag, down);
 			}
 			else if (mode == MATRIX_MODE_GS) {
-				g_trellis[x][y] = log_add(log_add(left, diag), down);
+				ctx->trellis[x][y] = log_add(log_add(left, diag), down);
 			}
 		}
     }
@@ -218,10 +261,10 @@ double fill_trellis(int *in, int *out, double(*cost)(int, int), int mode) {
 			} else if (y == 0) {
 				x--;
 			} else {
-				left = g_trellis[x-1][y] + cost(0,out[x-1]);
-				down = g_trellis[x][y-1] + cost(in[y-1], 0);
-				diag = g_trellis[x-1][y-1] + cost(in[y-1], out[x-1]);
-				g_backptr[x][y] = random_3draw(left, diag, down);
+				left = ctx->trellis[x-1][y] + cost(ctx, 0,out[x-1]);
+				down = ctx->trellis[x][y-1] + cost(ctx, in[y-1], 0);
+				diag = ctx->trellis[x-1][y-1] + cost(ctx, in[y-1], out[x-1]);
+				ctx->backptr[x][y] = random_3draw(ctx, left, diag, down);
 				x--;
 				y--;
 			}
@@ -229,79 +272,80 @@ double fill_trellis(int *in, int *out, double(*cost)(int, int), int mode) {
     }
 
     for (i = 0, y = inlen, x = outlen; x > 0 || y > 0; i++) {
-		if (g_backptr[x][y] == DIAG) {
+		if (ctx->backptr[x][y] == DIAG) {
 			x--; 
 			y--;
-			g_in_result[i] = in[y];
-			g_out_result[i] = out[x];
-		} else if (g_backptr[x][y] == LEFT) {
+			ctx->in_result[i] = in[y];
+			ctx->out_result[i] = out[x];
+		} else if (ctx->backptr[x][y] == LEFT) {
 			x--;
-			g_in_result[i] = 0;
-			g_out_result[i] = out[x];
-		} else if (g_backptr[x][y] == DOWN) {
+			ctx->in_result[i] = 0;
+			ctx->out_result[i] = out[x];
+		} else if (ctx->backptr[x][y] == DOWN) {
 			y--;
-			g_in_result[i] = in[y];
-			g_out_result[i] = 0;
+			ctx->in_result[i] = in[y];
+			ctx->out_result[i] = 0;
 		}
     }
 
-    g_in_result[i] = -1;
-    g_out_result[i] = -1;
+    ctx->in_result[i] = -1;
+    ctx->out_result[i] = -1;
 
-    vector_reverse(g_in_result, i);
-    vector_reverse(g_out_result, i);
-    p = g_trellis[outlen][inlen];
+    vector_reverse(ctx->in_result, i);
+    vector_reverse(ctx->out_result, i);
+    p = ctx->trellis[outlen][inlen];
     return(p);
 }
 
 /* Removes the counts of symbol pairs in two -1 -terminated sequences */
 /* to the current count table                                         */
-void remove_counts(int *in, int *out) {
+void remove_counts(struct align_context *ctx, int *in, int *out) {
 	int i;
 	for (i = 0; in[i] != -1 && out[i] != -1; i++) {
-		g_current_count[in[i]][out[i]]--;
-		if (g_current_count[in[i]][out[i]] == 0) {
-			g_distinct_pairs--;
+		ctx->current_count[in[i]][out[i]]--;
+		if (ctx->current_count[in[i]][out[i]] == 0) {
+			ctx->distinct_pairs--;
 		}
 	}
 }
 
 /* Add the counts of symbol pairs in two -1 -terminated sequences */
 /* to the current count table                                     */
-void add_counts(int *in, int *out) {
+void add_counts(struct align_context *ctx, int *in, int *out) {
 	int i;
 	for (i = 0; in[i] != -1 && out[i] != -1; i++) {
-		g_current_count[in[i]][out[i]]++;
-		g_paircount++;
-		if (g_current_count[in[i]][out[i]] == 1) {
-			g_distinct_pairs++;
+		ctx->current_count[in[i]][out[i]]++;
+		ctx->paircount++;
+		if (ctx->current_count[in[i]][out[i]] == 1) {
+			ctx->distinct_pairs++;
 		}
 	}
 }
 
 /* Add running counts of pairs to the global count table */
-void add_global_counts() {
+void add_global_counts(struct align_context *ctx) {
 	int i, j;
-	for (i = 0; i <= g_maxsymbol; i++) {
-		for (j = 0; j <= g_maxsymbol; j++) {
-			g_global_count[i][j] += g_current_count[i][j];
+	for (i = 0; i <= ctx->maxsymbol; i++) {
+		for (j = 0; j <= ctx->maxsymbol; j++) {
+			ctx->global_count[i][j] += ctx->current_count[i][j];
 		}
 	}
 }
 
-void print_counts() {
+void print_counts(struct align_context *ctx) {
 	int i, j;
 	debug("\n");
-	for (i = 0; i <= g_maxsymbol; i++) {
-		for (j = 0; j <= g_maxsymbol; j++) {
-			debug("%i ", g_current_count[i][j]);
+	for (i = 0; i <= ctx->maxsymbol; i++) {
+		for (j = 0; j <= ctx->maxsymbol; j++) {
+			debug("%i ", ctx->current_count[i][j]);
 		}		
 		debug("\n");
 	}
 }
 
 /* Cost function called by fill_trellis for MED */
-double cost_levenshtein(int a, int b) {
+double cost_levenshtein(struct align_context *ctx, int a, int b) {
+	(void)ctx;
 	if (a != b) {
 		return 1.0;
 	}
@@ -309,17 +353,18 @@ double cost_levenshtein(int a, int b) {
 }
 
 /* Cost function called by fill_trellis for CRP alignment */
-double cost_crp(int in, int out) {
+double cost_crp(struct align_context *ctx, int in, int out) {
     double cost;
-    cost = (double)( g_current_count[in][out] + g_prior ) / (double)( g_paircount + g_distinct_pairs * g_prior );
+    cost = (double)( ctx->current_count[in][out] + ctx->prior ) /
+           (double)( ctx->paircount + ctx->distinct_pairs * ctx->prior );
     return(-log(cost));
 }
 
 /* Initially, align all string pairs greedily, i.e. e.g. <abcd, ax> => <abcd,ax00> */
-void initial_align() {
+void ctx_initial_align(struct align_context *ctx) {
     struct stringpair *pair;
     int inlen, outlen, i, j, k;
-    for (pair = g_stringpairs; pair != NULL; pair = pair->next) {
+    for (pair = ctx->stringpairs; pair != NULL; pair = pair->next) {
 		inlen = intseqlen(pair->in);
 		outlen = intseqlen(pair->out);
 		pair->inaligned = malloc(sizeof(int) * (inlen+outlen+1));
@@ -344,58 +389,58 @@ void initial_align() {
 		}
 		pair->inaligned[k] = -1;
 		pair->outaligned[k] = -1;
-		add_counts(pair->inaligned, pair->outaligned);
+		add_counts(ctx, pair->inaligned, pair->outaligned);
 	}
 }
 
 /* Align a set of string pairs by minimum edit distance (for reference) */
-void med_align() {
+void ctx_med_align(struct align_context *ctx) {
     struct stringpair *sp;
     int j;
-    for (sp = g_stringpairs; sp != NULL; sp = sp->next) {
-		fill_trellis(sp->in, sp->out, &cost_levenshtein, MATRIX_MODE_MED); /* Fill trellis */
-		for (j = 0; g_in_result[j] != -1; j++) {
-			sp->inaligned[j] = g_in_result[j];
-			sp->outaligned[j] = g_out_result[j];
+    for (sp = ctx->stringpairs; sp != NULL; sp = sp->next) {
+		fill_trellis(ctx, sp->in, sp->out, &cost_levenshtein, MATRIX_MODE_MED); /* Fill trellis */
+		for (j = 0; ctx->in_result[j] != -1; j++) {
+			sp->inaligned[j] = ctx->in_result[j];
+			sp->outaligned[j] = ctx->out_result[j];
 		}
 		sp->inaligned[j] = -1;
 		sp->outaligned[j] = -1;
     }
 }
 
-void crp_align() {
+void ctx_crp_align(struct align_context *ctx) {
     struct stringpair *sp;
     int j;
-    for (sp = g_stringpairs; sp != NULL; sp = sp->next) {
-		fill_trellis(sp->in, sp->out, &cost_crp, MATRIX_MODE_MED);
-		for (j = 0; g_in_result[j] != -1; j++) {
-			sp->inaligned[j] = g_in_result[j];
-			sp->outaligned[j] = g_out_result[j];
+    for (sp = ctx->stringpairs; sp != NULL; sp = sp->next) {
+		fill_trellis(ctx, sp->in, sp->out, &cost_crp, MATRIX_MODE_MED);
+		for (j = 0; ctx->in_result[j] != -1; j++) {
+			sp->inaligned[j] = ctx->in_result[j];
+			sp->outaligned[j] = ctx->out_result[j];
 		}
 		sp->inaligned[j] = -1;
 		sp->outaligned[j] = -1;
 	}
 }
 
-void crp_train(int iterations, int burnin, int lag) {
+void ctx_crp_train(struct align_context *ctx, int iterations, int burnin, int lag) {
     struct stringpair *sp;
     int i, j;
 	for (i = 0; i < iterations; i++) {
 		fprintf(stderr,"Alignment iteration: %i\n", i);
-		print_counts();
-		for (sp = g_stringpairs; sp != NULL; sp = sp->next) {
-			remove_counts(sp->inaligned, sp->outaligned);  /* Remove counts before aligning */
-			fill_trellis(sp->in, sp->out, &cost_crp, MATRIX_MODE_GS);
-			for (j = 0; g_in_result[j] != -1; j++) {
-				sp->inaligned[j] = g_in_result[j];
-				sp->outaligned[j] = g_out_result[j];
+		print_counts(ctx);
+		for (sp = ctx->stringpairs; sp != NULL; sp = sp->next) {
+			remove_counts(ctx, sp->inaligned, sp->outaligned);  /* Remove counts before aligning */
+			fill_trellis(ctx, sp->in, sp->out, &cost_crp, MATRIX_MODE_GS);
+			for (j = 0; ctx->in_result[j] != -1; j++) {
+				sp->inaligned[j] = ctx->in_result[j];
+				sp->outaligned[j] = ctx->out_result[j];
 			}
 			sp->inaligned[j] = -1;
 			sp->outaligned[j] = -1;
-			add_counts(sp->inaligned, sp->outaligned);  /* Add counts back from new alignment */
+			add_counts(ctx, sp->inaligned, sp->outaligned);  /* Add counts back from new alignment */
 		}
 		if (i > burnin && i % lag == 0) {
-			add_global_counts();
+			add_global_counts(ctx);
 		}
     }
 }
@@ -422,7 +467,6 @@ void add_string_pair(char *in, char *out) {
     int *int_in, *int_out;
     int i, j;
     char *token;
-    struct stringpair *newpair;
     /* Get int array */
     int_in  = malloc(sizeof(int) * (utf8strlen(in) + 1));
     int_out = malloc(sizeof(int) * (utf8strlen(out) + 1));
@@ -450,48 +494,204 @@ void add_string_pair(char *in, char *out) {
 		int_out[j] = -1;	
 	}
 
-	newpair = malloc(sizeof(struct stringpair));
-	newpair->in = int_in;
-	newpair->out = int_out;    
-	newpair->next = NULL;
-	if (g_stringpairs == NULL) {
-		g_stringpairs = newpair;
-		g_stringpairs_tail = newpair;
-	} else {
-		g_stringpairs_tail->next = newpair;
-		g_stringpairs_tail = newpair;
-	}    
+	ctx_add_int_pair(g_context, int_in, int_out);
+	free(int_in);
+	free(int_out);
 }
 
 /* Directly add two -1 terminated integer sequences */
-void add_int_pair(int *in, int *out) {
-	int inlen, outlen;
+void ctx_add_int_pair(struct align_context *ctx, int *in, int *out) {
+	int i, inlen, outlen;
     struct stringpair *newpair;
     newpair = malloc(sizeof(struct stringpair));
 	inlen = intseqlen(in) + 1;
 	outlen = intseqlen(out) + 1;
 	newpair->in = malloc(inlen * sizeof(int));
 	newpair->out = malloc(outlen * sizeof(int));
+	newpair->inaligned = NULL;
+	newpair->outaligned = NULL;
 	memcpy(newpair->in, in, inlen * sizeof(int));
 	memcpy(newpair->out, out, outlen * sizeof(int));
+	for (i = 0; in[i] != -1; i++) {
+		if (in[i] > ctx->maxsymbol)
+			ctx->maxsymbol = in[i];
+	}
+	for (i = 0; out[i] != -1; i++) {
+		if (out[i] > ctx->maxsymbol)
+			ctx->maxsymbol = out[i];
+	}
     newpair->next = NULL;
-    if (g_stringpairs == NULL) {
-		g_stringpairs = newpair;
-		g_stringpairs_tail = newpair;
+    if (ctx->stringpairs == NULL) {
+		ctx->stringpairs = newpair;
+		ctx->stringpairs_tail = newpair;
     } else {
-		g_stringpairs_tail->next = newpair;
-		g_stringpairs_tail = newpair;
+		ctx->stringpairs_tail->next = newpair;
+		ctx->stringpairs_tail = newpair;
     }
 }
 
-void clear_counts() {	
+void ctx_clear_counts(struct align_context *ctx) {
 	int i,j;
-	for (i = 0; i <= g_maxsymbol; i++) {
-		for (j = 0; j <= g_maxsymbol; j++) {
-			g_current_count[i][j] = 0;
-			g_global_count[i][j] = 0;
+	for (i = 0; i <= ctx->maxsymbol; i++) {
+		for (j = 0; j <= ctx->maxsymbol; j++) {
+			ctx->current_count[i][j] = 0;
+			ctx->global_count[i][j] = 0;
+		}
+	}
+	ctx->paircount = 0;
+	ctx->distinct_pairs = 0;
+}
+
+/* Add n pairs at once. The symbols of pair k are in_symbols[in_offsets[k]] to        */
+/* in_symbols[in_offsets[k+1]-1] and likewise for out, without -1 terminators.      */
+void ctx_add_int_pairs(struct align_context *ctx, int n, int *in_symbols, int *in_offsets, int *out_symbols,
+                       int *out_offsets) {
+	int k, i, inlen, outlen;
+	struct stringpair *newpair;
+	for (k = 0; k < n; k++) {
+		inlen = in_offsets[k+1] - in_offsets[k];
+		outlen = out_offsets[k+1] - out_offsets[k];
+		newpair = malloc(sizeof(struct stringpair));
+		newpair->in = malloc((inlen + 1) * sizeof(int));
+		newpair->out = malloc((outlen + 1) * sizeof(int));
+		newpair->inaligned = NULL;
+		newpair->outaligned = NULL;
+		memcpy(newpair->in, in_symbols + in_offsets[k], inlen * sizeof(int));
+		memcpy(newpair->out, out_symbols + out_offsets[k], outlen * sizeof(int));
+		newpair->in[inlen] = -1;
+		newpair->out[outlen] = -1;
+		for (i = 0; i < inlen; i++) {
+			if (newpair->in[i] > ctx->maxsymbol)
+				ctx->maxsymbol = newpair->in[i];
+		}
+		for (i = 0; i < outlen; i++) {
+			if (newpair->out[i] > ctx->maxsymbol)
+				ctx->maxsymbol = newpair->out[i];
+		}
+		newpair->next = NULL;
+		if (ctx->stringpairs == NULL) {
+			ctx->stringpairs = newpair;
+			ctx->stringpairs_tail = newpair;
+		} else {
+			ctx->stringpairs_tail->next = newpair;
+			ctx->stringpairs_tail = newpair;
+		}
+	}
+}
+
+/* Total length of the aligned pairs, the size of the buffers ctx_get_aligned fills */
+int ctx_aligned_length(struct align_context *ctx) {
+	struct stringpair *sp;
+	int length = 0;
+	for (sp = ctx->stringpairs; sp != NULL; sp = sp->next) {
+		length += intseqlen(sp->inaligned);
+	}
+	return length;
+}
+
+/* Copy all the aligned pairs out, in the layout ctx_add_int_pairs takes. The     */
+/* aligned in and out of a pair have the same length, so they share the offsets.  */
+void ctx_get_aligned(struct align_context *ctx, int *in_symbols, int *out_symbols, int *offsets) {
+	struct stringpair *sp;
+	int k, length, position = 0;
+	offsets[0] = 0;
+	for (sp = ctx->stringpairs, k = 1; sp != NULL; sp = sp->next, k++) {
+		length = intseqlen(sp->inaligned);
+		memcpy(in_symbols + position, sp->inaligned, length * sizeof(int));
+		memcpy(out_symbols + position, sp->outaligned, length * sizeof(int));
+		position += length;
+		offsets[k] = position;
+	}
+}
+
+/* The CRP counts of a context, to keep them after training: counts gets the       */
+/* (maxsymbol+1) x (maxsymbol+1) current count table, totals gets paircount and   */
+/* distinct_pairs.                                                                */
+int ctx_max_symbol(struct align_context *ctx) {
+	return ctx->maxsymbol;
+}
+
+void ctx_get_counts(struct align_context *ctx, int *counts, int *totals) {
+	int i, j;
+	for (i = 0; i <= ctx->maxsymbol; i++) {
+		for (j = 0; j <= ctx->maxsymbol; j++) {
+			counts[i * (ctx->maxsymbol + 1) + j] = ctx->current_count[i][j];
 		}
 	}
+	totals[0] = ctx->paircount;
+	totals[1] = ctx->distinct_pairs;
+}
+
+/* Restore counts saved by ctx_get_counts, maxsymbol must be below 256 */
+void ctx_set_counts(struct align_context *ctx, int maxsymbol, int *counts, int paircount, int distinct_pairs) {
+	int i, j;
+	ctx_clear_counts(ctx);
+	if (maxsymbol > ctx->maxsymbol)
+		ctx->maxsymbol = maxsymbol;
+	for (i = 0; i <= maxsymbol; i++) {
+		for (j = 0; j <= maxsymbol; j++) {
+			ctx->current_count[i][j] = counts[i * (maxsymbol + 1) + j];
+		}
+	}
+	ctx->paircount = paircount;
+	ctx->distinct_pairs = distinct_pairs;
+}
+
+/* Align the pairs of a context in a single pass against its current counts, */
+/* which are left as they are - the counts of a trained context, or restored */
+/* by ctx_set_counts.                                                        */
+void ctx_align_fixed(struct align_context *ctx) {
+	struct stringpair *sp;
+	int length;
+	for (sp = ctx->stringpairs; sp != NULL; sp = sp->next) {
+		if (sp->inaligned == NULL) {
+			length = intseqlen(sp->in) + intseqlen(sp->out) + 1;
+			sp->inaligned = malloc(sizeof(int) * length);
+			sp->outaligned = malloc(sizeof(int) * length);
+		}
+	}
+	ctx_crp_align(ctx);
+}
+
+/* Remove the pairs of a context, keeping its counts */
+void ctx_clear_pairs(struct align_context *ctx) {
+	struct stringpair *sp, *next;
+	for (sp = ctx->stringpairs; sp != NULL; sp = next) {
+		next = sp->next;
+		free(sp->in);
+		free(sp->out);
+		free(sp->inaligned);
+		free(sp->outaligned);
+		free(sp);
+	}
+	ctx->stringpairs = NULL;
+	ctx->stringpairs_tail = NULL;
+}
+
+/* The same functions on the global context */
+
+void add_int_pair(int *in, int *out) {
+	ctx_add_int_pair(g_context, in, out);
+}
+
+void clear_counts() {
+	ctx_clear_counts(g_context);
+}
+
+void initial_align() {
+	ctx_initial_align(g_context);
+}
+
+void med_align() {
+	ctx_med_align(g_context);
+}
+
+void crp_align() {
+	ctx_crp_align(g_context);
+}
+
+void crp_train(int iterations, int burnin, int lag) {
+	ctx_crp_train(g_context, iterations, burnin, lag);
 }
 
 void print_pair_plain(int *in, int *out) {
@@ -558,8 +758,12 @@ void print_pair_aligned(int *in, int *out) {
 
 /* Functions for Python ctypes wrap */
 
+struct stringpair *ctx_getpairs_init(struct align_context *ctx) {
+	return ctx->stringpairs;
+}
+
 struct stringpair *getpairs_init() {
-	return g_stringpairs;	
+	return g_context->stringpairs;
 }
 
 int *getpairs_in(struct stringpair *sp) {
@@ -578,7 +782,7 @@ struct stringpair *getpairs_advance(struct stringpair *sp) {
 
 void write_stringpairs() {
 	struct stringpair *sp;
-	for (sp = g_stringpairs; sp != NULL; sp = sp->next) {
+	for (sp = g_context->stringpairs; sp != NULL; sp = sp->next) {
 		switch(g_output_format) {
 			case OUTPUT_FORMAT_PLAIN:
 			print_pair_plain(sp->inaligned, sp->outaligned);
@@ -698,7 +902,8 @@ int main(int argc, char **argv) {
 		}
 	}
     
-	srand48((unsigned int)time((time_t *)NULL));   
+	align_init();
+	align_context_seed(g_context, (long)time((time_t *)NULL));
 	read_stringpairs();
 	if (g_med == 1) {
 		med_align();
@@ -11,80 +11,281 @@
 # Usage:
 # Align(wordpairs) <= wordpairs is an iterable of 2-tuples
 # The resulting Align.alignedpairs is a list of aligned 2-tuples
+# The same alignment is in Align.aligned_in, Align.aligned_out and Align.aligned_offsets as int32 numpy arrays of symbol
+# numbers (0 is the align symbol), pair k taking the range aligned_offsets[k]:aligned_offsets[k+1] of both
+# parallel_align([wordpairs, ...]) <= aligns several lists of pairs in worker processes
+# Align(wordpairs, keep_model=True).model <= the learned counts, whose align(wordpairs) aligns new pairs in one pass
 
 # Relies on C-code in libalign.so built from align.c through ctypes.
+# Each Aligner runs in its own alignment context in the library, so aligners don't share counts or sampler state.
 # Author: Mans Hulden
 # MH20151102
 
 import itertools
+import json
+import numpy as np
+from multiprocessing import Pool, cpu_count
 from ctypes import *
 
 libalign = cdll.LoadLibrary('./libalign.so')
 
-libalign_add_int_pair = libalign.add_int_pair
-libalign_clear_counts = libalign.clear_counts
-libalign_initial_align = libalign.initial_align
-libalign_crp_train = libalign.crp_train
-libalign_crp_align = libalign.crp_align
-libalign_med_align = libalign.med_align
-
-libalign_getpairs_init = libalign.getpairs_init
-libalign_getpairs_init.restype = c_void_p
-libalign_getpairs_in = libalign.getpairs_in
-libalign_getpairs_in.restype = POINTER(c_int)
-libalign_getpairs_out = libalign.getpairs_out
-libalign_getpairs_out.restype = POINTER(c_int)
-libalign_getpairs_advance = libalign.getpairs_advance
-libalign_getpairs_advance.restype = c_void_p
-libalign_align_init = libalign.align_init
-libalign_align_init.restype = None
+# symbols are numbered 1 to MAX_SYMBOLS, 0 is the align symbol, as libalign keeps 256 x 256 count tables
+MAX_SYMBOLS = 255
+
+libalign_context_new = libalign.align_context_new
+libalign_context_new.restype = c_void_p
+libalign_context_free = libalign.align_context_free
+libalign_context_free.argtypes = [c_void_p]
+libalign_context_free.restype = None
+libalign_context_seed = libalign.align_context_seed
+libalign_context_seed.argtypes = [c_void_p, c_long]
+libalign_context_seed.restype = None
+
+libalign_add_int_pairs = libalign.ctx_add_int_pairs
+libalign_add_int_pairs.argtypes = [c_void_p, c_int, POINTER(c_int), POINTER(c_int), POINTER(c_int), POINTER(c_int)]
+libalign_add_int_pairs.restype = None
+libalign_clear_counts = libalign.ctx_clear_counts
+libalign_clear_counts.argtypes = [c_void_p]
+libalign_initial_align = libalign.ctx_initial_align
+libalign_initial_align.argtypes = [c_void_p]
+libalign_crp_train = libalign.ctx_crp_train
+libalign_crp_train.argtypes = [c_void_p, c_int, c_int, c_int]
+libalign_crp_align = libalign.ctx_crp_align
+libalign_crp_align.argtypes = [c_void_p]
+libalign_med_align = libalign.ctx_med_align
+libalign_med_align.argtypes = [c_void_p]
+
+libalign_aligned_length = libalign.ctx_aligned_length
+libalign_aligned_length.argtypes = [c_void_p]
+libalign_get_aligned = libalign.ctx_get_aligned
+libalign_get_aligned.argtypes = [c_void_p, POINTER(c_int), POINTER(c_int), POINTER(c_int)]
+libalign_get_aligned.restype = None
+libalign_max_symbol = libalign.ctx_max_symbol
+libalign_max_symbol.argtypes = [c_void_p]
+libalign_get_counts = libalign.ctx_get_counts
+libalign_get_counts.argtypes = [c_void_p, POINTER(c_int), POINTER(c_int)]
+libalign_get_counts.restype = None
+libalign_set_counts = libalign.ctx_set_counts
+libalign_set_counts.argtypes = [c_void_p, c_int, POINTER(c_int), c_int, c_int]
+libalign_set_counts.restype = None
+libalign_align_fixed = libalign.ctx_align_fixed
+libalign_align_fixed.argtypes = [c_void_p]
+libalign_align_fixed.restype = None
+
+
+def int_pointer(array):
+    return array.ctypes.data_as(POINTER(c_int))
+
+
+def encode_strings(strings):
+    """ Return the code points of all the strings in one int32 array, and the offsets of each string in it """
+    text = u''.join(strings)
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype='<u4').astype(np.int32)
+    offsets = np.zeros(len(strings) + 1, dtype=np.int32)
+    np.cumsum([len(string) for string in strings], out=offsets[1:])
+    return codes, offsets
+
+
+def decode_strings(codes, offsets):
+    """ The inverse of encode_strings """
+    text = np.asarray(codes, dtype='<u4').tobytes().decode('utf-32-le')
+    offsets = offsets.tolist()
+    return [text[offsets[k]:offsets[k + 1]] for k in xrange(len(offsets) - 1)]
+
+
+def number_symbols(codes, symbol_codes):
+    """ Return the symbol numbers of code points - 1 + their position in the sorted symbol_codes, and numbers following
+    those for code points not in symbol_codes - and the code points the following numbers stand for """
+    positions = np.searchsorted(symbol_codes, codes)
+    known = positions < len(symbol_codes)
+    known[known] = symbol_codes[positions[known]] == codes[known]
+    new_codes, new_positions = np.unique(codes[~known], return_inverse=True)
+    numbers = positions + 1
+    numbers[~known] = len(symbol_codes) + 1 + new_positions
+    return numbers.astype(np.int32), new_codes.astype(np.int32)
+
+
+def get_aligned(context, pair_count):
+    """ Copy the aligned symbols of all the pairs of a context out in bulk """
+    length = libalign_aligned_length(context)
+    aligned_in = np.zeros(length, dtype=np.int32)
+    aligned_out = np.zeros(length, dtype=np.int32)
+    aligned_offsets = np.zeros(pair_count + 1, dtype=np.int32)
+    libalign_get_aligned(context, int_pointer(aligned_in), int_pointer(aligned_out), int_pointer(aligned_offsets))
+    return aligned_in, aligned_out, aligned_offsets
+
+
+def decode_aligned(aligned_in, aligned_out, aligned_offsets, symbol_codes, align_symbol):
+    # the align symbol may be longer than a character, then the pairs are joined one by one
+    if len(align_symbol) == 1:
+        code_table = np.concatenate([[ord(align_symbol)], symbol_codes]).astype(np.int32)
+        return zip(decode_strings(code_table[aligned_in], aligned_offsets),
+                   decode_strings(code_table[aligned_out], aligned_offsets))
+    symbol_table = [align_symbol] + [unichr(c) for c in symbol_codes]
+    offsets = aligned_offsets.tolist()
+    aligned_in = [symbol_table[j] for j in aligned_in.tolist()]
+    aligned_out = [symbol_table[j] for j in aligned_out.tolist()]
+    return [(u''.join(aligned_in[offsets[k]:offsets[k + 1]]), u''.join(aligned_out[offsets[k]:offsets[k + 1]]))
+            for k in xrange(len(offsets) - 1)]
+
 
 class Aligner:
 
-    def __init__(self, wordpairs, align_symbol = u' ', iterations = 10, burnin = 5, lag = 1, mode = 'crp'):
-        s = set(u''.join((x[0] + x[1] for x in wordpairs)))
-        self.symboltoint = dict(zip(s, xrange(1,len(s)+1)))
+    def __init__(self, wordpairs, align_symbol = u' ', iterations = 10, burnin = 5, lag = 1, mode = 'crp', seed = None,
+                 keep_model = False):
+        ## Map stringpairs to integer sequences, all the inputs in one buffer and all the outputs in another ##
+        in_codes, in_offsets = encode_strings([x[0] for x in wordpairs])
+        out_codes, out_offsets = encode_strings([x[1] for x in wordpairs])
+        codes = np.union1d(in_codes, out_codes).astype(np.int32)
+        self.symboltoint = dict(zip([unichr(c) for c in codes], xrange(1, len(codes) + 1)))
         self.inttosymbol = {v:k for k, v in self.symboltoint.items()}
         self.inttosymbol[0] = align_symbol
-        ## Map stringpairs to -1 terminated integer sequences ##
-        intpairs = []
-        for i, o in wordpairs:
-            intin = map(lambda x: self.symboltoint[x], i) + [-1]
-            intout = map(lambda x: self.symboltoint[x], o) + [-1]
-            intpairs.append((intin, intout))
-
-        libalign_align_init()
-        for i, o in intpairs:
-            icint = (c_int * len(i))(*i)
-            ocint = (c_int * len(o))(*o)
-            libalign_add_int_pair(icint, ocint)
-            
+        in_symbols = number_symbols(in_codes, codes)[0]
+        out_symbols = number_symbols(out_codes, codes)[0]
+
+        context = libalign_context_new()
+        if not context:
+            raise MemoryError('could not allocate an alignment context')
+        try:
+            # without a seed, the sampler of a new context always starts from the same state
+            if seed is not None:
+                libalign_context_seed(context, seed)
+            libalign_add_int_pairs(context, len(in_offsets) - 1, int_pointer(in_symbols), int_pointer(in_offsets),
+                                   int_pointer(out_symbols), int_pointer(out_offsets))
+            self.align(context, iterations, burnin, lag, mode)
+            self.aligned_in, self.aligned_out, self.aligned_offsets = get_aligned(context, len(in_offsets) - 1)
+
+            # the counts learned by the sampler, to align more pairs against later
+            if keep_model and mode == 'crp':
+                self.model = AlignmentModel.from_context(context, codes, align_symbol)
+        finally:
+            libalign_context_free(context)
+
+        self.alignedpairs = decode_aligned(self.aligned_in, self.aligned_out, self.aligned_offsets, codes, align_symbol)
+
+    def align(self, context, iterations, burnin, lag, mode):
         # Run CRP align
         if mode == 'crp':
-            libalign_clear_counts()
-            libalign_initial_align()
-            libalign_crp_train(c_int(iterations), c_int(burnin), c_int(lag))
-            libalign_crp_align()
+            libalign_clear_counts(context)
+            libalign_initial_align(context)
+            libalign_crp_train(context, iterations, burnin, lag)
+            libalign_crp_align(context)
         else:
-            libalign_clear_counts()
-            libalign_initial_align()
-            libalign_med_align()
-        
-        # Reconvert to output
-        self.alignedpairs = []
-        stringpairptr = libalign_getpairs_init()
-        while stringpairptr != None:
-            inints = libalign_getpairs_in(c_void_p(stringpairptr))
-            outints = libalign_getpairs_out(c_void_p(stringpairptr))
-            instr = []
-            outstr = []
-            for j in itertools.count():
-                if inints[j] == -1:
-                    break
-                instr.append(self.inttosymbol[inints[j]])
-            for j in itertools.count():
-                if outints[j] == -1:
-                    break
-                outstr.append(self.inttosymbol[outints[j]])
-            self.alignedpairs.append((''.join(instr), ''.join(outstr)))
-            stringpairptr = libalign_getpairs_advance(c_void_p(stringpairptr))
+            libalign_clear_counts(context)
+            libalign_initial_align(context)
+            libalign_med_align(context)
+
+
+class AlignmentModel:
+    """ The CRP counts of a trained Aligner, to align new pairs against in a single pass
+
+    New pairs are aligned as the Aligner aligns its own pairs after sampling - the cheapest alignment under the counts -
+    but the counts are not changed and nothing is sampled, so a pair is always aligned the same way, alone or with
+    others. Symbols unseen in training are aligned by the prior alone.
+    """
+
+    def __init__(self, symbol_codes, counts, paircount, distinct_pairs, align_symbol):
+        self.symbol_codes = np.asarray(symbol_codes, dtype=np.int32)
+        self.counts = np.ascontiguousarray(counts, dtype=np.int32)
+        self.paircount = paircount
+        self.distinct_pairs = distinct_pairs
+        self.align_symbol = align_symbol
+
+    @staticmethod
+    def from_context(context, symbol_codes, align_symbol):
+        size = libalign_max_symbol(context) + 1
+        counts = np.zeros((size, size), dtype=np.int32)
+        totals = np.zeros(2, dtype=np.int32)
+        libalign_get_counts(context, int_pointer(counts), int_pointer(totals))
+        return AlignmentModel(symbol_codes, counts, int(totals[0]), int(totals[1]), align_symbol)
+
+    def save(self, path):
+        # the count table is mostly zeros, only the nonzero counts are written
+        rows, columns = np.nonzero(self.counts)
+        content = {'align_symbol': self.align_symbol, 'symbol_codes': self.symbol_codes.tolist(),
+                   'size': len(self.counts), 'paircount': self.paircount, 'distinct_pairs': self.distinct_pairs,
+                   'counts': zip(rows.tolist(), columns.tolist(), self.counts[rows, columns].tolist())}
+        with open(path, 'w') as f:
+            json.dump(content, f)
+
+    @staticmethod
+    def load(path):
+        with open(path) as f:
+            content = json.load(f)
+        counts = np.zeros((content['size'], content['size']), dtype=np.int32)
+        for row, column, count in content['counts']:
+            counts[row, column] = count
+        return AlignmentModel(content['symbol_codes'], counts, content['paircount'], content['distinct_pairs'],
+                              content['align_symbol'])
+
+    def align(self, wordpairs):
+        in_codes, in_offsets = encode_strings([x[0] for x in wordpairs])
+        out_codes, out_offsets = encode_strings([x[1] for x in wordpairs])
+        # the input and output are numbered together, so symbols unseen in training get the same numbers in both
+        numbers, new_codes = number_symbols(np.concatenate([in_codes, out_codes]), self.symbol_codes)
+        if len(self.symbol_codes) + len(new_codes) > MAX_SYMBOLS:
+            raise ValueError('more than {} symbols to align'.format(MAX_SYMBOLS))
+        in_symbols = np.ascontiguousarray(numbers[:len(in_codes)])
+        out_symbols = np.ascontiguousarray(numbers[len(in_codes):])
+
+        context = libalign_context_new()
+        if not context:
+            raise MemoryError('could not allocate an alignment context')
+        try:
+            libalign_set_counts(context, len(self.counts) - 1, int_pointer(self.counts), self.paircount,
+                                self.distinct_pairs)
+            libalign_add_int_pairs(context, len(in_offsets) - 1, int_pointer(in_symbols), int_pointer(in_offsets),
+                                   int_pointer(out_symbols), int_pointer(out_offsets))
+            libalign_align_fixed(context)
+            aligned_in, aligned_out, aligned_offsets = get_aligned(context, len(in_offsets) - 1)
+        finally:
+            libalign_context_free(context)
+        return decode_aligned(aligned_in, aligned_out, aligned_offsets,
+                              np.concatenate([self.symbol_codes, new_codes]), self.align_symbol)
+
+
+def align_shard(params):
+    wordpairs, align_symbol, iterations, burnin, lag, mode = params
+    return Aligner(wordpairs, align_symbol=align_symbol, iterations=iterations, burnin=burnin, lag=lag,
+                   mode=mode).alignedpairs
+
+
+def parallel_align(wordpairs_lists, align_symbol = u' ', iterations = 10, burnin = 5, lag = 1, mode = 'crp',
+                   shard_size = None, processes = None):
+    """ Align several lists of word pairs - e.g. a train and a dev set, or the data of several languages - in worker
+    processes, and return the list of aligned pairs of each, in the given order.
+
+    If shard_size is given, lists longer than it are split into consecutive shards of shard_size pairs, which are
+    aligned separately and concatenated back. Each shard learns its own CRP counts, so small shards align worse.
+    Every shard is aligned in a new context with the same sampler state, so the result depends only on the pairs and
+    the shard size, never on the amount of processes or the order in which the shards finish.
+    """
+    shards = []
+    shard_counts = []
+    for wordpairs in wordpairs_lists:
+        wordpairs = list(wordpairs)
+        size = shard_size if shard_size else max(len(wordpairs), 1)
+        starts = range(0, len(wordpairs), size) or [0]
+        shard_counts.append(len(starts))
+        for start in starts:
+            shards.append((wordpairs[start:start + size], align_symbol, iterations, burnin, lag, mode))
+
+    if processes is None:
+        processes = cpu_count()
+    processes = min(processes, len(shards))
+    if processes <= 1:
+        aligned_shards = map(align_shard, shards)
+    else:
+        pool = Pool(processes)
+        try:
+            aligned_shards = pool.map(align_shard, shards, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    alignedpairs_lists = []
+    position = 0
+    for count in shard_counts:
+        alignedpairs_lists.append(list(itertools.chain(*aligned_shards[position:position + count])))
+        position += count
+    return alignedpairs_lists
@@ -0,0 +1,97 @@
+# Log-space beam search over the outputs of a decoder, shared by the dynet models.
+#
+# Usage:
+# beam = Beam(beam_width, nbest, end_index)
+# while not beam.done():
+#     log_probs = ... <= (vocabulary x live hypotheses) matrix of log probabilities from the decoder
+#     parents, outputs = beam.advance(log_probs)
+#     ... <= reorder the decoder states by parents, feed outputs back in
+# beam.nbest() <= list of (output indices, log prob), best first
+#
+# The model computes the log probabilities, so the beam is independent of the network. Candidates are pruned to the
+# beam width on the score matrix itself, and each step only keeps arrays of backpointers and outputs, so no hypothesis
+# objects or sequence copies are created for candidates that fall off the beam.
+
+import numpy as np
+
+
+def top_k(scores, k):
+    # flat indices of the k highest scores, best first
+    flat_scores = scores.ravel()
+    k = min(k, len(flat_scores))
+    if k < len(flat_scores):
+        best = np.argpartition(-flat_scores, k - 1)[:k]
+    else:
+        best = np.arange(len(flat_scores))
+    return best[np.argsort(-flat_scores[best], kind='mergesort')]
+
+
+class Beam:
+
+    def __init__(self, beam_width, nbest, end_index):
+        self.beam_width = beam_width
+        self.nbest_size = nbest
+        self.end_index = end_index
+
+        # log probs of the live hypotheses, initially only the empty prefix
+        self.scores = np.zeros(1)
+
+        # for every step, the index of each live hypothesis' parent in the previous step, and its output
+        self.parents = []
+        self.outputs = []
+
+        # (log prob, step, parent) of hypotheses that produced end_index, which is not part of their sequence
+        self.finished = []
+
+    def done(self):
+        return len(self.scores) == 0
+
+    def size(self):
+        return len(self.scores)
+
+    def advance(self, log_probs):
+        # log_probs is a (vocabulary x live hypotheses) matrix
+        candidate_scores = log_probs + self.scores
+        best = top_k(candidate_scores, self.beam_width)
+        outputs, parents = np.divmod(best, candidate_scores.shape[1])
+        scores = candidate_scores.ravel()[best]
+
+        # hypotheses that produced the end symbol are complete
+        step = len(self.outputs)
+        ended = outputs == self.end_index
+        for score, parent in zip(scores[ended], parents[ended]):
+            self.finished.append((float(score), step, int(parent)))
+        live = ~ended
+
+        # once there are nbest complete hypotheses, expanding ones with a lower score can't improve on them
+        if len(self.finished) >= self.nbest_size:
+            threshold = sorted([f[0] for f in self.finished], reverse=True)[self.nbest_size - 1]
+            live &= scores > threshold
+
+        self.scores = scores[live]
+        self.parents.append(parents[live])
+        self.outputs.append(outputs[live])
+        return self.parents[-1], self.outputs[-1]
+
+    def sequence(self, step, index):
+        # follow the backpointers from the given hypothesis back to the empty prefix
+        sequence = []
+        while step >= 0:
+            sequence.append(int(self.outputs[step][index]))
+            index = self.parents[step][index]
+            step -= 1
+        sequence.reverse()
+        return sequence
+
+    def nbest(self, trim_unfinished=False):
+        candidates = [(score, self.sequence(step - 1, parent)) for score, step, parent in self.finished]
+
+        # hypotheses that are still live when decoding stopped at the maximal length
+        for index, score in enumerate(self.scores):
+            sequence = self.sequence(len(self.outputs) - 1, index)
+            if trim_unfinished:
+                sequence = sequence[0:-1]
+            candidates.append((float(score), sequence))
+
+        candidates.sort(key=lambda x: x[0], reverse=True)
+        return [(sequence, score) for score, sequence in candidates[:self.nbest_size]]
@@ -1,14 +1,31 @@
 import align
+import model_bundle
+import prepare_sigmorphon_data
 import codecs
 import os
+import json
+import hashlib
 import heapq
+import random
+import time
+import resource
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import Pool
 
 NULL = '%'
+TELEMETRY_PHASES = ['graph', 'forward', 'backward', 'update']
 
 def cluster_data_by_morph_type(feat_dicts, feature_types):
+    # the morph string is built once for each distinct morph signature
+    signatures = {}
+    morph_ids = get_morph_ids(feat_dicts, feature_types, signatures)
+    morph_strings = [None] * len(signatures)
     morphs_to_indices = {}
-    for i, feat_dict in enumerate(feat_dicts):
-        s = get_morph_string(feat_dict, feature_types)
+    for i, (morph_id, feat_dict) in enumerate(zip(morph_ids, feat_dicts)):
+        if morph_strings[morph_id] is None:
+            morph_strings[morph_id] = get_morph_string(feat_dict, feature_types)
+        s = morph_strings[morph_id]
         if s in morphs_to_indices:
             morphs_to_indices[s].append(i)
         else:
@@ -16,6 +33,27 @@ def cluster_data_by_morph_type(feat_dicts, feature_types):
     return morphs_to_indices
 
 
+# interns the morph signature of each feature dict - its values for the sorted feature types, NULL where it has none -
+# as a small int, without building a morph string for it. the same signature gets the same id as long as the same
+# signatures dict is passed, which maps each signature tuple to its id and grows with the new ones
+def get_morph_ids(feat_dicts, feature_types, signatures=None):
+    if signatures is None:
+        signatures = {}
+    sorted_feature_types = sorted(feature_types)
+
+    # examples loaded with the same feature bundle share their dict, which is then only looked at once
+    dict_ids = {}
+    morph_ids = []
+    for feat_dict in feat_dicts:
+        morph_id = dict_ids.get(id(feat_dict))
+        if morph_id is None:
+            signature = tuple([feat_dict.get(f, NULL) for f in sorted_feature_types])
+            morph_id = signatures.setdefault(signature, len(signatures))
+            dict_ids[id(feat_dict)] = morph_id
+        morph_ids.append(morph_id)
+    return morph_ids
+
+
 def get_morph_string(feat_dict, feature_types):
     s = ''
     for f in sorted(feature_types):
@@ -66,6 +104,35 @@ def get_feature_alphabet(feat_dicts):
     return feature_alphabet
 
 
+# builds the character and feature alphabets of a model from its saved vocabulary, or from the train set for models
+# saved without one. symbols are the model's own symbols, added after the characters and features, and unk_feat
+# after the feature values. train_alphabet is the result of get_alphabet on the train set if it is already known, e.g.
+# from a data cache
+def build_alphabets(train_words, train_lemmas, train_feat_dicts, symbols, unk_feat, train_alphabet=None,
+                    vocabulary=None):
+    if vocabulary:
+        alphabet, feature_types = list(vocabulary['alphabet']), list(vocabulary['feature_types'])
+    elif train_alphabet:
+        alphabet, feature_types = list(train_alphabet[0]), list(train_alphabet[1])
+    else:
+        alphabet, feature_types = prepare_sigmorphon_data.get_alphabet(train_words, train_lemmas, train_feat_dicts)
+    alphabet += symbols
+
+    # char 2 int
+    alphabet_index = dict(zip(alphabet, range(0, len(alphabet))))
+    inverse_alphabet_index = {index: char for char, index in alphabet_index.items()}
+
+    # feat 2 int
+    if vocabulary:
+        feature_alphabet = list(vocabulary['feature_alphabet'])
+    else:
+        feature_alphabet = get_feature_alphabet(train_feat_dicts)
+    feature_alphabet.append(unk_feat)
+    feat_index = dict(zip(feature_alphabet, range(0, len(feature_alphabet))))
+
+    return alphabet, alphabet_index, inverse_alphabet_index, feature_alphabet, feat_index, feature_types
+
+
 def dumb_align(wordpairs, align_symbol):
     alignedpairs = []
     for idx, pair in enumerate(wordpairs):
@@ -79,17 +146,401 @@ def dumb_align(wordpairs, align_symbol):
     return alignedpairs
 
 
-def mcmc_align(wordpairs, align_symbol):
+def mcmc_align(wordpairs, align_symbol, align_cache=None):
+    if align_cache:
+        return align_cache.align(wordpairs, align_symbol)
     a = align.Aligner(wordpairs, align_symbol=align_symbol)
     return a.alignedpairs
 
 
-def med_align(wordpairs, align_symbol):
+def med_align(wordpairs, align_symbol, align_cache=None):
+    if align_cache:
+        return align_cache.align(wordpairs, align_symbol, mode='med')
     a = align.Aligner(wordpairs, align_symbol=align_symbol, mode='med')
     return a.alignedpairs
 
-def write_results_file_and_evaluate_externally(hyper_params, accuracy, train_path, test_path, output_file_path,
-                                               sigmorphon_root_dir, final_results, nbest=False):
+
+# aligns the word pairs, and returns the aligned pairs with the align.AlignmentModel learned on them
+def mcmc_align_with_model(wordpairs, align_symbol, align_cache=None):
+    if align_cache:
+        return align_cache.align_with_model(wordpairs, align_symbol)
+    a = align.Aligner(wordpairs, align_symbol=align_symbol, keep_model=True)
+    return a.alignedpairs, a.model
+
+
+# aligns each of the lists of word pairs separately, in parallel worker processes
+def mcmc_align_many(wordpairs_lists, align_symbol, align_cache=None, shard_size=None):
+    if align_cache:
+        return align_cache.align_many(wordpairs_lists, align_symbol, shard_size=shard_size)
+    return align.parallel_align(wordpairs_lists, align_symbol=align_symbol, shard_size=shard_size)
+
+
+class AlignmentCache:
+    """ Keeps the alignments computed by align.Aligner in a directory, one JSON file per alignment
+
+    an alignment is keyed by the sha1 of the word pairs and the aligner settings, so runs on the same data - e.g. the
+    members of an ensemble - align it only once. every alignment starts from the same sampler state, so a cached
+    alignment is the one the aligner would have returned for the same pairs and settings
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, wordpairs, align_symbol, mode, iterations, burnin, lag, shard_size=None):
+        settings = [align_symbol, mode, iterations, burnin, lag]
+        if shard_size:
+            settings.append(shard_size)
+        content = json.dumps([settings, [list(pair) for pair in wordpairs]], ensure_ascii=False)
+        return hashlib.sha1(content.encode('utf8')).hexdigest()
+
+    def align(self, wordpairs, align_symbol, mode='crp', iterations=10, burnin=5, lag=1):
+        return self.align_many([wordpairs], align_symbol, mode, iterations, burnin, lag)[0]
+
+    def align_many(self, wordpairs_lists, align_symbol, mode='crp', iterations=10, burnin=5, lag=1, shard_size=None):
+        # the lists missing from the cache are aligned together by align.parallel_align
+        paths = [os.path.join(self.cache_dir, self.key(wordpairs, align_symbol, mode, iterations, burnin, lag,
+                                                       shard_size) + '.json') for wordpairs in wordpairs_lists]
+        alignedpairs_lists = [self.load(path) for path in paths]
+        missing = [i for i, alignedpairs in enumerate(alignedpairs_lists) if alignedpairs is None]
+        self.hits += len(paths) - len(missing)
+        self.misses += len(missing)
+
+        if len(missing) > 0:
+            aligned = align.parallel_align([wordpairs_lists[i] for i in missing], align_symbol=align_symbol,
+                                           iterations=iterations, burnin=burnin, lag=lag, mode=mode,
+                                           shard_size=shard_size)
+            for i, alignedpairs in zip(missing, aligned):
+                alignedpairs_lists[i] = alignedpairs
+                self.save(paths[i], alignedpairs)
+        return alignedpairs_lists
+
+    def align_with_model(self, wordpairs, align_symbol, iterations=10, burnin=5, lag=1):
+        # the model is kept next to the alignment it was learned with, under the same key
+        path = os.path.join(self.cache_dir, self.key(wordpairs, align_symbol, 'crp', iterations, burnin, lag) + '.json')
+        model_path = path[:-len('.json')] + '.model.json'
+        if os.path.isfile(model_path):
+            alignedpairs = self.load(path)
+            if alignedpairs is not None:
+                self.hits += 1
+                return alignedpairs, align.AlignmentModel.load(model_path)
+
+        self.misses += 1
+        a = align.Aligner(wordpairs, align_symbol=align_symbol, iterations=iterations, burnin=burnin, lag=lag,
+                          keep_model=True)
+        self.save(path, a.alignedpairs)
+        try:
+            tmp_path = model_path + '.tmp{}'.format(os.getpid())
+            a.model.save(tmp_path)
+            os.rename(tmp_path, model_path)
+        except (IOError, OSError) as e:
+            print 'could not write alignment model cache {}: {}'.format(model_path, e)
+        return a.alignedpairs, a.model
+
+    def load(self, path):
+        if not os.path.isfile(path):
+            return None
+        with codecs.open(path, 'r', encoding='utf8') as f:
+            alignedpairs = [tuple(pair) for pair in json.load(f)]
+        print 'loaded alignment of {} pairs from cache: {}'.format(len(alignedpairs), path)
+        return alignedpairs
+
+    def save(self, path, alignedpairs):
+        # written under a temporary name first, so runs sharing the cache never read a partial alignment
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            tmp_path = path + '.tmp{}'.format(os.getpid())
+            with codecs.open(tmp_path, 'w', encoding='utf8') as f:
+                json.dump(alignedpairs, f, ensure_ascii=False)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            print 'could not write alignment cache {}: {}'.format(path, e)
+
+    def report(self):
+        print 'alignment cache {}: {} hits, {} misses'.format(self.cache_dir, self.hits, self.misses)
+
+
+# evaluates snapshots of the parameters of a model in a worker process while training goes on, at most one at a time.
+# initializer runs once in the worker with initargs, e.g. to build the model the snapshots are loaded into, and
+# evaluate is then called there with each snapshot. both must be module level functions
+class AsyncEvaluator:
+
+    def __init__(self, initializer, initargs, evaluate):
+        self.pool = Pool(1, initializer=initializer, initargs=initargs)
+        self.evaluate = evaluate
+        self.pending = None
+
+    def submit(self, epoch, snapshot):
+        # returns the result of the previously submitted snapshot, or None if there is none
+        result = self.collect()
+        self.pending = (epoch, snapshot, self.pool.apply_async(self.evaluate, (snapshot,)))
+        return result
+
+    def collect(self):
+        # waits for the pending snapshot, and returns (epoch, snapshot, result of evaluate) or None
+        if self.pending is None:
+            return None
+        epoch, snapshot, async_result = self.pending
+        self.pending = None
+        return epoch, snapshot, async_result.get()
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+# the model and dev examples of the dev evaluation worker process, set once by init_dev_worker
+dev_worker_state = None
+
+
+# the initializer of an AsyncEvaluator that evaluates a trainer's parameter snapshots on dev. the worker builds its own
+# model with the trainer's build_model from the model metadata, and evaluate_dev is then called with the model
+# parameters followed by dev_args
+def init_dev_worker(build_model, evaluate_dev, model_metadata, dev_args):
+    global dev_worker_state
+    hyper_params = model_metadata['hyper_params']
+    model_params = build_model(model_metadata['alphabet'], hyper_params['INPUT_DIM'], hyper_params['HIDDEN_DIM'],
+                               hyper_params['LAYERS'], model_metadata['feature_types'], hyper_params['FEAT_INPUT_DIM'],
+                               model_metadata['feature_alphabet'])
+    dev_worker_state = (model_params, evaluate_dev, tuple(dev_args))
+
+
+# evaluates a snapshot of the parameters on dev in the worker process
+def evaluate_dev_snapshot(snapshot):
+    model_params, evaluate_dev, dev_args = dev_worker_state
+    model_bundle.set_parameters(model_params[0], snapshot[0], snapshot[1])
+    return evaluate_dev(*model_params + dev_args)
+
+
+# everything besides the parameters that is needed to rebuild a model
+def make_model_metadata(alphabet, feature_alphabet, feature_types, input_dim, hidden_dim, layers, feat_input_dim,
+                        max_prediction_len):
+    return {'hyper_params': {'INPUT_DIM': input_dim, 'HIDDEN_DIM': hidden_dim, 'LAYERS': layers,
+                             'FEAT_INPUT_DIM': feat_input_dim, 'MAX_PREDICTION_LEN': max_prediction_len},
+            'alphabet': list(alphabet), 'feature_alphabet': list(feature_alphabet),
+            'feature_types': list(feature_types)}
+
+
+# updates the early stopping state with the dev results of an evaluated epoch, and calls save_best with the evaluated
+# snapshot if it is the best so far - the snapshot holds the evaluated parameter arrays, or None if they are the model's
+# current ones. with improve_on_tie, an accuracy equal to the best one is an improvement too
+def update_best_dev(save_best, snapshot, dev_epoch, dev_accuracy, avg_dev_loss, best_dev_accuracy, best_dev_epoch,
+                    best_avg_dev_loss, patience, improve_on_tie=False):
+    if dev_accuracy > best_dev_accuracy or (improve_on_tie and dev_accuracy == best_dev_accuracy):
+        best_dev_accuracy = dev_accuracy
+        best_dev_epoch = dev_epoch
+
+        # save best model to disk
+        save_best(snapshot)
+        print 'saved new best model'
+        patience = 0
+    else:
+        patience += 1
+
+    if avg_dev_loss < best_avg_dev_loss:
+        best_avg_dev_loss = avg_dev_loss
+
+    return best_dev_accuracy, best_dev_epoch, best_avg_dev_loss, patience
+
+
+# waits for the snapshot still evaluated in the background when training stops, so it is saved if it is the best one.
+# get_dev_accuracy gives the accuracy of the dev predictions. returns the best epoch on dev
+def finish_dev_evaluation(dev_evaluator, get_dev_accuracy, save_best, best_dev_accuracy, best_dev_epoch,
+                          best_avg_dev_loss, patience, improve_on_tie=False):
+    if dev_evaluator is None:
+        return best_dev_epoch
+    dev_result = dev_evaluator.collect()
+    dev_evaluator.close()
+    if dev_result is not None:
+        dev_epoch, dev_snapshot, (dev_predictions, avg_dev_loss) = dev_result
+        dev_accuracy = get_dev_accuracy(dev_predictions)
+        best_dev_accuracy, best_dev_epoch = update_best_dev(save_best, dev_snapshot, dev_epoch, dev_accuracy,
+                                                            avg_dev_loss, best_dev_accuracy, best_dev_epoch,
+                                                            best_avg_dev_loss, patience, improve_on_tie)[:2]
+        print 'dev results of epoch {0}: dev loss: {1:.4f} dev accuracy: {2:.4f} best dev accuracy {3:.4f} ' \
+              '(epoch {4})'.format(dev_epoch, avg_dev_loss, dev_accuracy, best_dev_accuracy, best_dev_epoch)
+    return best_dev_epoch
+
+
+# per epoch telemetry of a trainer, appended to a JSON lines file. the time of each training step is split between its
+# phases - building the graph of the loss, computing it, backpropagating and updating the parameters - by calling
+# start_step before the step and mark after each phase. dynet builds graphs lazily, so the graph phase does not
+# include computation
+class TrainingTelemetry:
+
+    def __init__(self, path):
+        self.path = path
+        self.phase_seconds = OrderedDict()
+        self.last_mark = time.time()
+        self.start_epoch()
+
+    def start_epoch(self):
+        for phase in TELEMETRY_PHASES:
+            self.phase_seconds[phase] = 0.0
+
+    def start_step(self):
+        self.last_mark = time.time()
+
+    def mark(self, phase):
+        now = time.time()
+        self.phase_seconds[phase] += now - self.last_mark
+        self.last_mark = now
+
+    def write_epoch(self, epoch, examples, chars, train_seconds, fields):
+        # fields are further values of the epoch, e.g. its evaluation times and results
+        record = OrderedDict([('epoch', epoch), ('examples', examples), ('chars', chars),
+                              ('train_seconds', train_seconds),
+                              ('examples_per_second', examples / train_seconds if train_seconds > 0 else None),
+                              ('chars_per_second', chars / train_seconds if train_seconds > 0 else None)])
+        for phase in TELEMETRY_PHASES:
+            record[phase + '_seconds'] = self.phase_seconds[phase]
+        record.update(fields)
+
+        # ru_maxrss is in kilobytes on linux. background workers are separate processes and are not included
+        record['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        self.start_epoch()
+
+
+# the order of the training examples in each epoch, as indices into the training set. lengths holds a sort key of each
+# example, e.g. its lemma and inflection lengths. with batch_size > 1 the examples are grouped into batches of similar
+# length - fixed once and shuffled each epoch, or regrouped each epoch after shuffling within buckets of bucket_batches
+# batches of similar length if given. with curriculum_epochs, epoch e of the first curriculum_epochs trains on the
+# shortest (e + 1) / (curriculum_epochs + 1) of the examples only, from short to long words
+class TrainingSampler:
+
+    def __init__(self, lengths, batch_size=1, bucket_batches=None, curriculum_epochs=0):
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+        self.curriculum_epochs = curriculum_epochs
+        self.by_length = sorted(xrange(len(lengths)), key=lengths.__getitem__)
+        self.batches = None
+        if batch_size > 1:
+            self.batches = self.group(self.by_length)
+
+    def group(self, indices):
+        return [indices[k:k + self.batch_size] for k in xrange(0, len(indices), self.batch_size)]
+
+    def epoch_size(self, e):
+        if e < self.curriculum_epochs:
+            return max(self.batch_size, len(self.by_length) * (e + 1) // (self.curriculum_epochs + 1))
+        return len(self.by_length)
+
+    def examples_before(self, e):
+        # the amount of examples trained on in the epochs before epoch e
+        return sum([self.epoch_size(k) for k in xrange(min(e, self.curriculum_epochs))]) + \
+            max(0, e - self.curriculum_epochs) * len(self.by_length)
+
+    def epoch_examples(self, e):
+        # the indices of the examples trained on in epoch e, shortest first
+        return self.by_length[:self.epoch_size(e)]
+
+    def epoch(self, e):
+        # lazily yields the example indices of epoch e, or lists of them if batch_size > 1. the examples are shuffled
+        # when the iteration starts
+        size = self.epoch_size(e)
+        if self.batch_size == 1:
+            if size < len(self.by_length):
+                indices = self.by_length[:size]
+            else:
+                indices = range(size)
+            random.shuffle(indices)
+            for k in indices:
+                yield k
+            return
+
+        if self.bucket_batches:
+            bucket_size = self.bucket_batches * self.batch_size
+            batches = []
+            for start in xrange(0, size, bucket_size):
+                bucket = self.by_length[start:min(start + bucket_size, size)]
+                random.shuffle(bucket)
+                batches += self.group(bucket)
+            self.batches = batches
+        elif size < len(self.by_length):
+            batches = self.group(self.by_length[:size])
+        else:
+            # the fixed batches keep their order from the previous epoch, so it is saved with the checkpoints
+            batches = self.batches
+        random.shuffle(batches)
+        for batch in batches:
+            yield batch
+
+
+# the states of the python and numpy random generators, as lists that can be saved as JSON
+def get_random_state():
+    version, internal_state, gauss_next = random.getstate()
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    return {'python': [version, list(internal_state), gauss_next],
+            'numpy': [name, keys.tolist(), position, has_gauss, cached_gaussian]}
+
+
+def set_random_state(random_state):
+    version, internal_state, gauss_next = random_state['python']
+    random.setstate((version, tuple(internal_state), gauss_next))
+    name, keys, position, has_gauss, cached_gaussian = random_state['numpy']
+    np.random.set_state((str(name), np.array(keys, dtype=np.uint32), position, has_gauss, cached_gaussian))
+
+
+# saves the parameters and the rest of the training state after epoch e - the counters, the learning curves, the order
+# of the batches if it is fixed and the random generators - so resume_training can restore them. stopped marks a
+# training that stopped early, and dev_pending a dev evaluation of these parameters still running in the background.
+# the lists are copied, as the next epoch changes them while the checkpoint is written
+def write_checkpoint(checkpoint_writer, model, trainer, results_file_path, model_metadata, e, stopped, dev_pending,
+                     counters, learning_curves, train_batches=None):
+    metadata = dict(model_metadata or {})
+    metadata['training_state'] = dict(counters)
+    metadata['training_state'].update({'epoch': e, 'stopped': stopped, 'dev_pending': dev_pending,
+                                       'learning_curves': [list(curve) for curve in learning_curves],
+                                       'train_batches': list(train_batches) if train_batches is not None else None,
+                                       'learning_rate': trainer.learning_rate,
+                                       'random_state': get_random_state()})
+    parameter_arrays, lookup_parameter_arrays = model_bundle.get_parameter_arrays(model)
+    checkpoint_writer.write(parameter_arrays, lookup_parameter_arrays,
+                            results_file_path + model_bundle.CHECKPOINT_SUFFIX, metadata)
+
+
+# restores the parameters, the learning rate and the random generators from the checkpoint write_checkpoint saved, and
+# returns the training state to go on from, or None if there is no checkpoint. the dev evaluation still running when
+# the checkpoint was written is submitted again, and the dev evaluator of a training that already stopped is closed
+def resume_training(model, trainer, optimization, results_file_path, model_metadata, dev_evaluator):
+    checkpoint_path = results_file_path + model_bundle.CHECKPOINT_SUFFIX
+    if not os.path.isfile(checkpoint_path):
+        print 'no checkpoint found at {}, training from the start'.format(checkpoint_path)
+        return None
+
+    metadata, parameter_arrays, lookup_parameter_arrays = model_bundle.read_bundle(checkpoint_path)
+    if model_metadata is not None and (metadata['alphabet'] != model_metadata['alphabet'] or
+                                       metadata['feature_alphabet'] != model_metadata['feature_alphabet']):
+        raise Exception('the alphabets of {} differ from the ones of the model'.format(checkpoint_path))
+    model_bundle.set_parameters(model, parameter_arrays, lookup_parameter_arrays)
+    state = metadata['training_state']
+    state['learning_curves'] = tuple(state['learning_curves'])
+    trainer.set_learning_rate(state['learning_rate'])
+    set_random_state(state['random_state'])
+    print 'resumed training after epoch {} from {}'.format(state['epoch'], checkpoint_path)
+    if optimization != 'SGD':
+        print 'dynet does not expose the state of the {} trainer besides its learning rate, so it starts ' \
+              'over'.format(optimization)
+
+    if state['stopped']:
+        print 'training already stopped after epoch {}'.format(state['epoch'])
+        if dev_evaluator is not None:
+            dev_evaluator.close()
+    elif state['dev_pending'] and dev_evaluator is not None:
+        # the checkpoint holds the parameters whose dev evaluation was still running in the background
+        dev_evaluator.submit(state['epoch'], model_bundle.get_parameter_arrays(model))
+    return state
+
+
+# writes the results file and the predictions, and evaluates the predictions against the gold inflections in the test
+# file as the sigmorphon evalm.py script does, without running it. final_results maps the index of each test example to
+# its (lemma, feat dict, inflection), or to its (lemma, feat dict, ranked inflections) if nbest
+def write_results_file_and_evaluate(hyper_params, accuracy, train_path, test_path, output_file_path, final_results,
+                                    nbest=False):
     if 'test' in test_path:
         output_file_path += '.test'
 
@@ -134,36 +585,97 @@ def write_results_file_and_evaluate_externally(hyper_params, accuracy, train_pat
         if nbest:
             predictions_path += '.nbest'
 
+    scores = write_and_evaluate_predictions(test_path, predictions_path, final_results, nbest)
+    print 'len of predictions file is {}'.format(len(final_results))
+
+    # the covered test files have no gold inflections to evaluate against
+    if scores is None:
+        print 'wrote results to: ' + output_file_path + '\n' + predictions_path
+        return None
+
+    evaluation_path = output_file_path + '.evaluation'
+    if nbest:
+        evaluation_path += '.nbest'
+    evaluation = format_evaluation(scores)
+    with codecs.open(evaluation_path, 'w', encoding='utf8') as f:
+        f.write(evaluation)
+    print evaluation
+
+    print 'wrote results to: ' + output_file_path + '\n' + evaluation_path + '\n' + predictions_path
+    return scores
+
+
+# kept for the scripts that still evaluate with the sigmorphon evalm.py script - the evaluation now runs in-process, so
+# sigmorphon_root_dir is not used
+def write_results_file_and_evaluate_externally(hyper_params, accuracy, train_path, test_path, output_file_path,
+                                               sigmorphon_root_dir, final_results, nbest=False):
+    return write_results_file_and_evaluate(hyper_params, accuracy, train_path, test_path, output_file_path,
+                                           final_results, nbest)
+
+
+# streams the predictions for the test file to disk line by line, scoring each one against the gold inflection on the
+# way: whether the first prediction is correct, its levenshtein distance from the gold inflection and the reciprocal
+# rank of the gold inflection among the predictions. returns the scores, or None if the test file has no gold
+# inflections
+def write_and_evaluate_predictions(test_path, predictions_path, final_results, nbest=False):
+    count = 0
+    correct = 0
+    total_distance = 0
+    total_reciprocal_rank = 0.0
+    has_gold = True
     with codecs.open(test_path, 'r', encoding='utf8') as test_file:
-        lines = test_file.readlines()
-        print 'len of test file is {}'.format(len(lines))
-        print 'len of predictions file is {}'.format(len(final_results))
         with codecs.open(predictions_path, 'w', encoding='utf8') as predictions:
-            for i, line in enumerate(lines):
-                if 'test-covered' in test_path:
-                    lemma, morph = line.split()
+            for i, line in enumerate(test_file):
+                fields = line.split()
+                if len(fields) == 2:
+                    lemma, morph = fields
+                    word = None
+                    has_gold = False
                 else:
-                    lemma, morph, word = line.split()
+                    lemma, morph, word = fields
                 if i in final_results:
                     if nbest:
-                        for p in final_results[i][2]:
-                            predictions.write(u'{0}\t{1}\t{2}\n'.format(lemma, morph, p))
+                        guesses = list(final_results[i][2])
                     else:
-                        predictions.write(u'{0}\t{1}\t{2}\n'.format(lemma, morph, final_results[i][2]))
+                        guesses = [final_results[i][2]]
                 else:
                     # TODO: handle unseen morphs?
-                    # print u'could not find prediction for {0} {1}'.format(lemma, morph)
-                    predictions.write(u'{0}\t{1}\t{2}\n'.format(lemma, morph, 'ERROR'))
-
-    # evaluate with sigmorphon script
-    evaluation_path = output_file_path + '.evaluation'
-    os.chdir(sigmorphon_root_dir)
-    os.system('python ' + sigmorphon_root_dir + '/src/evalm.py --gold ' + test_path + ' --guesses ' + predictions_path +
-              ' > ' + evaluation_path)
-    os.system('python ' + sigmorphon_root_dir + '/src/evalm.py --gold ' + test_path + ' --guesses ' + predictions_path)
-
-    print 'wrote results to: ' + output_file_path + '\n' + evaluation_path + '\n' + predictions_path
-    return
+                    guesses = [u'ERROR']
+                for guess in guesses:
+                    predictions.write(u'{0}\t{1}\t{2}\n'.format(lemma, morph, guess))
+
+                count += 1
+                if word is not None:
+                    if guesses[0] == word:
+                        correct += 1
+                    total_distance += levenshtein(guesses[0], word)
+                    if word in guesses:
+                        total_reciprocal_rank += 1.0 / (guesses.index(word) + 1)
+    print 'len of test file is {}'.format(count)
+
+    if not has_gold:
+        return None
+    return {'examples': count, 'accuracy': float(correct) / count if count > 0 else 0.0,
+            'levenshtein': float(total_distance) / count if count > 0 else 0.0,
+            'reciprocal_rank': total_reciprocal_rank / count if count > 0 else 0.0}
+
+
+def format_evaluation(scores):
+    return u'Mean Reciprocal Rank: {0:.4f}\nAccuracy: {1:.4f}\nMean Levenshtein: {2:.4f}\nExamples: {3}\n'.format(
+        scores['reciprocal_rank'], scores['accuracy'], scores['levenshtein'], scores['examples'])
+
+
+# the edit distance between two strings, with insertions, deletions and substitutions costing 1 each
+def levenshtein(s1, s2):
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    previous_row = range(len(s2) + 1)
+    for i, c1 in enumerate(s1):
+        current_row = [i + 1]
+        for j, c2 in enumerate(s2):
+            current_row.append(min(previous_row[j + 1] + 1, current_row[j] + 1, previous_row[j] + (c1 != c2)))
+        previous_row = current_row
+    return previous_row[-1]
 
 
 def mirror_data(train_target_words, train_source_words, train_target_feat_dicts, train_source_feat_dicts):
@@ -4,15 +4,17 @@ files and evaluation script.
 Usage:
   hard_attention.py [--dynet-mem MEM][--input=INPUT] [--hidden=HIDDEN]
   [--feat-input=FEAT] [--epochs=EPOCHS] [--layers=LAYERS] [--optimization=OPTIMIZATION] [--reg=REGULARIZATION]
-  [--learning=LEARNING] [--plot] [--eval] [--ensemble=ENSEMBLE] TRAIN_PATH DEV_PATH TEST_PATH RESULTS_PATH
-  SIGMORPHON_PATH...
+  [--learning=LEARNING] [--plot] [--eval] [--ensemble=ENSEMBLE] [--batch-size=BATCH] [--beam=BEAM] [--nbest=NBEST]
+  [--align-cache=DIR] [--align-shard=SIZE] [--incremental-align] [--min-char-count=COUNT] [--min-feat-count=COUNT]
+  [--eval-every=EPOCHS] [--eval-dev-size=SIZE] [--async-eval] [--checkpoint-every=EPOCHS] [--resume]
+  [--bucket-batches=BUCKET] [--curriculum=EPOCHS] TRAIN_PATH DEV_PATH TEST_PATH RESULTS_PATH SIGMORPHON_PATH...
 
 Arguments:
   TRAIN_PATH    destination path
   DEV_PATH      development set path
   TEST_PATH     test path
   RESULTS_PATH  results file to be written
-  SIGMORPHON_PATH   sigmorphon root containing data, src dirs
+  SIGMORPHON_PATH   sigmorphon root containing data, src dirs. not needed for the evaluation, which runs in-process
 
 Options:
   -h --help                     show this help message and exit
@@ -28,6 +30,35 @@ Options:
   --plot                        draw a learning curve plot while training each model
   --eval                        run evaluation without training
   --ensemble=ENSEMBLE           ensemble model paths, separated by comma
+  --batch-size=BATCH            amount of examples in each training minibatch, 1 updates after every example
+  --beam=BEAM                   beam width for decoding the dev and test sets, 1 decodes greedily. each model of an
+                                ensemble decodes with the beam, and the models vote on their best predictions
+  --nbest=NBEST                 amount of ranked predictions to write for each example when decoding with a beam
+  --align-cache=DIR             directory of cached train and dev alignments, shared by the runs that use it. defaults
+                                to an alignment_cache directory next to RESULTS_PATH
+  --align-shard=SIZE            align the train and dev sets in shards of SIZE pairs in parallel processes, each shard
+                                learning its own alignment counts. each set is aligned at once if not given
+  --incremental-align           align the dev set in a single pass against the alignment counts learned on the train
+                                set, instead of sampling its own alignment. the counts are saved to
+                                RESULTS_PATH_align_model.json. the train set is not sharded
+  --min-char-count=COUNT        characters seen less than COUNT times in the train set are left out of the alphabet,
+                                and treated as unknown
+  --min-feat-count=COUNT        feature values seen in less than COUNT train examples are left out of the feature
+                                alphabet, and treated as unknown
+  --eval-every=EPOCHS           evaluate on the train sample and dev set every EPOCHS epochs and after the last one,
+                                patience counts evaluations. 1 if not given
+  --eval-dev-size=SIZE          evaluate on a fixed random sample of SIZE dev examples during training instead of the
+                                whole dev set
+  --async-eval                  evaluate a snapshot of the parameters on dev in a worker process while the next epoch
+                                trains. saving the best model and early stopping act on each epoch one epoch late
+  --checkpoint-every=EPOCHS     save the parameters and the training state to RESULTS_PATH_checkpoint.bundle every
+                                EPOCHS epochs and after the last one. 1 if not given
+  --resume                      go on training from RESULTS_PATH_checkpoint.bundle if it exists, with the vocabulary
+                                saved next to RESULTS_PATH
+  --bucket-batches=BUCKET       regroup the training batches each epoch, shuffling the examples within buckets of
+                                BUCKET batches of similar length first. the batches are grouped once if not given
+  --curriculum=EPOCHS           train on the shortest examples first, adding longer ones in each of the first EPOCHS
+                                epochs until all of them are used. 0 if not given
 """
 
 import traceback
@@ -37,11 +68,15 @@ import prepare_sigmorphon_data
 import progressbar
 import datetime
 import time
+import os
 import common
+import beam_search
+import model_bundle
 from matplotlib import pyplot as plt
 from docopt import docopt
 import dynet as pc
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from multiprocessing import Pool, cpu_count
 import sys
 
 # default values
@@ -57,6 +92,18 @@ MAX_PATIENCE = 100
 REGULARIZATION = 0.0
 LEARNING_RATE = 0.0001  # 0.1
 PARALLELIZE = True
+BATCH_SIZE = 1
+DECODE_BATCH_SIZE = 100
+ENCODER_CACHE_SIZE = 10000
+BEAM_WIDTH = 1
+ALIGN_CACHE_DIR_NAME = 'alignment_cache'
+MIN_CHAR_COUNT = 1
+MIN_FEAT_COUNT = 1
+EVAL_EVERY = 1
+EVAL_DEV_SIZE = None
+CHECKPOINT_EVERY = 1
+BUCKET_BATCHES = None
+CURRICULUM_EPOCHS = 0
 
 NULL = '%'
 UNK = '#'
@@ -69,11 +116,15 @@ ALIGN_SYMBOL = '~'
 
 
 def main(train_path, dev_path, test_path, results_file_path, sigmorphon_root_dir, input_dim, hidden_dim, feat_input_dim,
-         epochs, layers, optimization, regularization, learning_rate, plot, eval_only, ensemble):
+         epochs, layers, optimization, regularization, learning_rate, plot, eval_only, ensemble, batch_size, beam_width,
+         nbest, align_cache_dir=None, align_shard_size=None, incremental_align=False, min_char_count=MIN_CHAR_COUNT,
+         min_feat_count=MIN_FEAT_COUNT, eval_every=EVAL_EVERY, eval_dev_size=EVAL_DEV_SIZE, async_eval=False,
+         checkpoint_every=CHECKPOINT_EVERY, resume=False, bucket_batches=BUCKET_BATCHES,
+         curriculum_epochs=CURRICULUM_EPOCHS):
     hyper_params = {'INPUT_DIM': input_dim, 'HIDDEN_DIM': hidden_dim, 'FEAT_INPUT_DIM': feat_input_dim,
                     'EPOCHS': epochs, 'LAYERS': layers, 'MAX_PREDICTION_LEN': MAX_PREDICTION_LEN,
                     'OPTIMIZATION': optimization, 'PATIENCE': MAX_PATIENCE, 'REGULARIZATION': regularization,
-                    'LEARNING_RATE': learning_rate}
+                    'LEARNING_RATE': learning_rate, 'BATCH_SIZE': batch_size, 'BEAM_WIDTH': beam_width}
 
     print 'train path = ' + str(train_path)
     print 'dev path =' + str(dev_path)
@@ -81,36 +132,41 @@ def main(train_path, dev_path, test_path, results_file_path, sigmorphon_root_dir
     for param in hyper_params:
         print param + '=' + str(hyper_params[param])
 
-    # load train and test data
-    (train_words, train_lemmas, train_feat_dicts) = prepare_sigmorphon_data.load_data(train_path)
-    (dev_words, dev_lemmas, dev_feat_dicts) = prepare_sigmorphon_data.load_data(dev_path)
-    (test_words, test_lemmas, test_feat_dicts) = prepare_sigmorphon_data.load_data(test_path)
-    alphabet, feature_types = prepare_sigmorphon_data.get_alphabet(train_words, train_lemmas, train_feat_dicts)
-
-    # used for character dropout
-    alphabet.append(NULL)
-    alphabet.append(UNK)
-
-    # used during decoding
-    alphabet.append(EPSILON)
-    alphabet.append(BEGIN_WORD)
-    alphabet.append(END_WORD)
-
-    # add indices to alphabet - used to indicate when copying from lemma to word
-    for marker in [str(i) for i in xrange(3 * MAX_PREDICTION_LEN)]:
-        alphabet.append(marker)
-
-    # indicates the FST to step forward in the input
-    alphabet.append(STEP)
-
-    # char 2 int
-    alphabet_index = dict(zip(alphabet, range(0, len(alphabet))))
-    inverse_alphabet_index = {index: char for char, index in alphabet_index.items()}
-
-    # feat 2 int
-    feature_alphabet = common.get_feature_alphabet(train_feat_dicts)
-    feature_alphabet.append(UNK_FEAT)
-    feat_index = dict(zip(feature_alphabet, range(0, len(feature_alphabet))))
+    # evaluated models saved as bundles hold their alphabets, so the train set is only read to train and for models
+    # saved before bundles were introduced
+    model_paths = ensemble.split(',') if ensemble else [results_file_path]
+    bundled = eval_only and len([path for path in model_paths
+                                 if not os.path.isfile(path + '_bestmodel.bundle')]) == 0
+
+    # load train and test data, through the binary caches next to the files
+    if not bundled:
+        train_data = prepare_sigmorphon_data.load_cached_data(train_path)
+        (train_words, train_lemmas, train_feat_dicts) = train_data.to_lists()
+    (dev_words, dev_lemmas, dev_feat_dicts) = prepare_sigmorphon_data.load_cached_data(dev_path).to_lists()
+    (test_words, test_lemmas, test_feat_dicts) = prepare_sigmorphon_data.load_cached_data(test_path).to_lists()
+
+    # a new model gets a vocabulary built from the train set, which is saved next to it so every run on the model gets
+    # the same indices. models saved without a vocabulary use the alphabets get_alphabet builds from the train set
+    if bundled:
+        alphabet, alphabet_index, inverse_alphabet_index, feature_alphabet, feat_index, feature_types, \
+            bundle_hyper_params = read_bundle_alphabets(model_paths)
+
+        # the results report the dimensions of the evaluated model, not the ones given on the command line
+        if not ensemble:
+            hyper_params.update(bundle_hyper_params)
+    elif eval_only:
+        # an ensemble is evaluated with the vocabulary of its members, which must all have the same one
+        vocabulary = prepare_sigmorphon_data.find_vocabulary(ensemble.split(',') if ensemble else [results_file_path])
+    else:
+        # a resumed training keeps the vocabulary of the training it resumes
+        vocabulary = prepare_sigmorphon_data.find_vocabulary([results_file_path]) if resume else None
+        if vocabulary is None:
+            vocabulary = prepare_sigmorphon_data.build_vocabulary(train_data, min_char_count, min_feat_count)
+            prepare_sigmorphon_data.save_vocabulary(vocabulary,
+                                                    results_file_path + prepare_sigmorphon_data.VOCABULARY_SUFFIX)
+    if not bundled:
+        alphabet, alphabet_index, inverse_alphabet_index, feature_alphabet, feat_index, feature_types = \
+            build_alphabets(train_words, train_lemmas, train_feat_dicts, train_data.get_alphabet(), vocabulary)
 
     if not eval_only:
 
@@ -119,11 +175,23 @@ def main(train_path, dev_path, test_path, results_file_path, sigmorphon_root_dir
         train_word_pairs = zip(train_lemmas, train_words)
         dev_word_pairs = zip(dev_lemmas, dev_words)
 
-        # train_aligned_pairs = dumb_align(train_word_pairs, ALIGN_SYMBOL)
-        train_aligned_pairs = common.mcmc_align(train_word_pairs, ALIGN_SYMBOL)
+        if not align_cache_dir:
+            align_cache_dir = os.path.join(os.path.dirname(os.path.abspath(results_file_path)), ALIGN_CACHE_DIR_NAME)
+        align_cache = common.AlignmentCache(align_cache_dir)
 
-        # TODO: align together?
-        dev_aligned_pairs = common.mcmc_align(dev_word_pairs, ALIGN_SYMBOL)
+        # train_aligned_pairs = dumb_align(train_word_pairs, ALIGN_SYMBOL)
+        if incremental_align:
+            # dev is aligned against the counts learned on train, without sampling
+            train_aligned_pairs, align_model = common.mcmc_align_with_model(train_word_pairs, ALIGN_SYMBOL,
+                                                                            align_cache)
+            dev_aligned_pairs = align_model.align(dev_word_pairs)
+            align_model.save(results_file_path + '_align_model.json')
+        else:
+            # train and dev are aligned at the same time, in separate processes
+            train_aligned_pairs, dev_aligned_pairs = common.mcmc_align_many([train_word_pairs, dev_word_pairs],
+                                                                             ALIGN_SYMBOL, align_cache,
+                                                                             align_shard_size)
+        align_cache.report()
         print 'finished aligning'
 
         last_epochs = []
@@ -133,7 +201,8 @@ def main(train_path, dev_path, test_path, results_file_path, sigmorphon_root_dir
                                                         optimization, results_file_path, train_aligned_pairs,
                                                         dev_aligned_pairs,
                                                         feat_index, feature_types, feat_input_dim, feature_alphabet,
-                                                        plot)
+                                                        plot, batch_size, eval_every, eval_dev_size, async_eval,
+                                                        checkpoint_every, resume, bucket_batches, curriculum_epochs)
 
         # print when did each model stop
         print 'stopped on epoch {}'.format(last_epoch)
@@ -150,23 +219,34 @@ def main(train_path, dev_path, test_path, results_file_path, sigmorphon_root_dir
     evaluate_ndst(alphabet, alphabet_index, ensemble, feat_index, feat_input_dim, feature_alphabet, feature_types,
                   hidden_dim, hyper_params, input_dim, inverse_alphabet_index, layers, results_file_path,
                   sigmorphon_root_dir, dev_feat_dicts, dev_lemmas, dev_path,
-                  dev_words, train_path)
+                  dev_words, train_path, beam_width=beam_width, nbest=nbest)
 
     # eval on test
     print '=========TEST EVALUATION:========='
     evaluate_ndst(alphabet, alphabet_index, ensemble, feat_index, feat_input_dim, feature_alphabet, feature_types,
                   hidden_dim, hyper_params, input_dim, inverse_alphabet_index, layers, results_file_path,
                   sigmorphon_root_dir, test_feat_dicts, test_lemmas, test_path,
-                  test_words, train_path)
+                  test_words, train_path, beam_width=beam_width, nbest=nbest)
 
     return
 
 
+# builds the character and feature alphabets of the model from the train set, or from its saved vocabulary
+def build_alphabets(train_words, train_lemmas, train_feat_dicts, train_alphabet=None, vocabulary=None):
+    # NULL and UNK are used for character dropout, EPSILON, BEGIN_WORD and END_WORD during decoding, the indices to
+    # indicate when copying from lemma to word, and STEP indicates the FST to step forward in the input
+    symbols = [NULL, UNK, EPSILON, BEGIN_WORD, END_WORD] + [str(i) for i in xrange(3 * MAX_PREDICTION_LEN)] + [STEP]
+    return common.build_alphabets(train_words, train_lemmas, train_feat_dicts, symbols, UNK_FEAT, train_alphabet,
+                                  vocabulary)
+
+
 def train_model_wrapper(input_dim, hidden_dim, layers, train_lemmas, train_feat_dicts,
                         train_words, dev_lemmas, dev_feat_dicts, dev_words,
                         alphabet, alphabet_index, inverse_alphabet_index, epochs,
                         optimization, results_file_path, train_aligned_pairs, dev_aligned_pairs, feat_index,
-                        feature_types, feat_input_dim, feature_alphabet, plot):
+                        feature_types, feat_input_dim, feature_alphabet, plot, batch_size, eval_every=EVAL_EVERY,
+                        eval_dev_size=EVAL_DEV_SIZE, async_eval=False, checkpoint_every=CHECKPOINT_EVERY,
+                        resume=False, bucket_batches=BUCKET_BATCHES, curriculum_epochs=CURRICULUM_EPOCHS):
     # build model
     initial_model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn = build_model(alphabet, input_dim, hidden_dim, layers,
                                                                          feature_types, feat_input_dim,
@@ -180,7 +260,12 @@ def train_model_wrapper(input_dim, hidden_dim, layers, train_lemmas, train_feat_
                                             inverse_alphabet_index,
                                             epochs, optimization, results_file_path,
                                             train_aligned_pairs, dev_aligned_pairs, feat_index, feature_types,
-                                            plot)
+                                            plot, batch_size,
+                                            common.make_model_metadata(alphabet, feature_alphabet, feature_types,
+                                                                       input_dim, hidden_dim, layers, feat_input_dim,
+                                                                       MAX_PREDICTION_LEN),
+                                            eval_every, eval_dev_size, async_eval, checkpoint_every, resume,
+                                            bucket_batches, curriculum_epochs)
 
     # evaluate last model on dev
     predicted_sequences = predict_sequences(trained_model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, alphabet_index,
@@ -223,31 +308,89 @@ def build_model(alphabet, input_dim, hidden_dim, layers, feature_types, feat_inp
     return model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn
 
 
+# a model saved as a bundle is rebuilt with the dimensions the bundle holds, and must have the given alphabets, which
+# the examples are encoded with. the dimensions are only used for models saved before bundles were introduced
 def load_best_model(alphabet, results_file_path, input_dim, hidden_dim, layers, feature_alphabet,
                     feat_input_dim, feature_types):
-    tmp_model_path = results_file_path + '_bestmodel.txt'
+    if os.path.isfile(results_file_path + '_bestmodel.bundle'):
+        model_params, bundle_alphabet, alphabet_index, inverse_alphabet_index, bundle_feature_alphabet, feat_index, \
+            bundle_feature_types, hyper_params = load_model_bundle(results_file_path)
+        if bundle_alphabet != list(alphabet) or bundle_feature_alphabet != list(feature_alphabet) or \
+                bundle_feature_types != list(feature_types):
+            raise Exception('the alphabets of {} differ from the ones of the evaluated examples'.format(
+                results_file_path + '_bestmodel.bundle'))
+        return model_params
+
     model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn = build_model(alphabet, input_dim, hidden_dim,
                                                                  layers, feature_types,
                                                                  feat_input_dim,
                                                                  feature_alphabet)
+    # models saved before bundles were introduced
+    tmp_model_path = results_file_path + '_bestmodel.txt'
     print 'trying to load model from: {}'.format(tmp_model_path)
     model.load(tmp_model_path)
     return model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn
 
 
-def log_to_file(file_name, e, avg_loss, train_accuracy, dev_accuracy):
+# the alphabets and the feature types the examples are encoded with, with their indices, and the hyperparameters of a
+# bundle
+def get_bundle_alphabets(metadata):
+    alphabet = metadata['alphabet']
+    alphabet_index = dict(zip(alphabet, range(0, len(alphabet))))
+    inverse_alphabet_index = {index: char for char, index in alphabet_index.items()}
+    feature_alphabet = metadata['feature_alphabet']
+    feat_index = dict(zip(feature_alphabet, range(0, len(feature_alphabet))))
+    return alphabet, alphabet_index, inverse_alphabet_index, feature_alphabet, feat_index, \
+        metadata['feature_types'], metadata['hyper_params']
+
+
+# get_bundle_alphabets for the best models of the given results paths, which must all have the same alphabets - the
+# members of an ensemble vote on the predictions of the same encoded examples
+def read_bundle_alphabets(results_file_paths):
+    metadatas = [model_bundle.read_bundle(path + '_bestmodel.bundle')[0] for path in results_file_paths]
+    for path, metadata in zip(results_file_paths[1:], metadatas[1:]):
+        if [metadata[name] for name in ['alphabet', 'feature_alphabet', 'feature_types']] != \
+                [metadatas[0][name] for name in ['alphabet', 'feature_alphabet', 'feature_types']]:
+            raise Exception('the alphabets of {} differ from the ones of {}'.format(path, results_file_paths[0]))
+    return get_bundle_alphabets(metadatas[0])
+
+
+# rebuilds the best model from its bundle alone, without the train set
+def load_model_bundle(results_file_path):
+    start = time.time()
+    bundle_path = results_file_path + '_bestmodel.bundle'
+    metadata, parameter_arrays, lookup_parameter_arrays = model_bundle.read_bundle(bundle_path)
+    alphabet, alphabet_index, inverse_alphabet_index, feature_alphabet, feat_index, feature_types, hyper_params = \
+        get_bundle_alphabets(metadata)
+
+    model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn = build_model(
+        alphabet, hyper_params['INPUT_DIM'], hyper_params['HIDDEN_DIM'], hyper_params['LAYERS'], feature_types,
+        hyper_params['FEAT_INPUT_DIM'], feature_alphabet)
+    model_bundle.set_parameters(model, parameter_arrays, lookup_parameter_arrays)
+    print 'loaded model bundle in {:.3f} seconds'.format(time.time() - start)
+
+    return (model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn), alphabet, \
+        alphabet_index, inverse_alphabet_index, feature_alphabet, feat_index, feature_types, hyper_params
+
+
+# dev_epoch is the epoch the dev accuracy belongs to, which is e unless the evaluation ran in the background
+def log_to_file(file_name, e, avg_loss, train_accuracy, dev_accuracy, dev_epoch, train_seconds, eval_seconds):
     # if first write, add headers
-    if e == 0:
-        log_to_file(file_name, 'epoch', 'avg_loss', 'train_accuracy', 'dev_accuracy')
+    if not os.path.isfile(file_name):
+        with open(file_name, "a") as logfile:
+            logfile.write("epoch\tavg_loss\ttrain_accuracy\tdev_accuracy\tdev_epoch\ttrain_seconds\teval_seconds\n")
 
     with open(file_name, "a") as logfile:
-        logfile.write("{}\t{}\t{}\t{}\n".format(e, avg_loss, train_accuracy, dev_accuracy))
+        logfile.write("{}\t{}\t{}\t{}\t{}\t{:.2f}\t{:.2f}\n".format(e, avg_loss, train_accuracy, dev_accuracy,
+                                                                 dev_epoch, train_seconds, eval_seconds))
 
 
 def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, train_lemmas, train_feat_dicts, train_words, dev_lemmas,
                 dev_feat_dicts, dev_words, alphabet_index, inverse_alphabet_index, epochs, optimization,
                 results_file_path, train_aligned_pairs, dev_aligned_pairs, feat_index, feature_types,
-                plot):
+                plot, batch_size=1, bundle_metadata=None, eval_every=EVAL_EVERY, eval_dev_size=EVAL_DEV_SIZE,
+                async_eval=False, checkpoint_every=CHECKPOINT_EVERY, resume=False, bucket_batches=BUCKET_BATCHES,
+                curriculum_epochs=CURRICULUM_EPOCHS):
     print 'training...'
 
     np.random.seed(17)
@@ -270,6 +413,7 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
     best_avg_dev_loss = 999
     best_dev_accuracy = -1
     best_train_accuracy = -1
+    best_dev_epoch = 0
     patience = 0
     train_len = len(train_words)
     sanity_set_size = 100
@@ -278,6 +422,7 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
     dev_loss_y = []
     train_accuracy_y = []
     dev_accuracy_y = []
+    learning_curves = (epochs_x, train_loss_y, dev_loss_y, train_accuracy_y, dev_accuracy_y)
     e = -1
 
     # progress bar init
@@ -285,29 +430,130 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
     train_progress_bar = progressbar.ProgressBar(widgets=widgets, maxval=epochs).start()
     avg_loss = -1
 
-    for e in xrange(epochs):
-
-        # randomize the training set
-        indices = range(train_len)
-        random.shuffle(indices)
-        train_set = zip(train_lemmas, train_feat_dicts, train_words, train_aligned_pairs)
-        train_set = [train_set[i] for i in indices]
-
-        # compute loss for each example and update
-        for i, example in enumerate(train_set):
-            lemma, feats, word, alignment = example
-            loss = one_word_loss(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, lemma, feats, word,
-                                 alphabet_index, alignment, feat_index, feature_types)
-            loss_value = loss.value()
-            total_loss += loss_value
-            loss.backward()
-            trainer.update()
-            if i > 0:
-                avg_loss = total_loss / float(i + e * train_len)
-            else:
-                avg_loss = total_loss
+    # encode the examples as ints once - the padded lemmas, the feature values and the STEP/char oracles derived from
+    # the alignments - so the epochs never look characters or features up again
+    start = time.time()
+    train_lemma_indices, train_feat_indices, train_oracles = encode_examples(train_lemmas, train_feat_dicts,
+                                                                             train_aligned_pairs, alphabet_index,
+                                                                             feat_index, feature_types)
+    dev_lemma_indices, dev_feat_indices, dev_oracles = encode_examples(dev_lemmas, dev_feat_dicts, dev_aligned_pairs,
+                                                                       alphabet_index, feat_index, feature_types)
+    train_sanity_inputs = (train_lemma_indices[:sanity_set_size], train_feat_indices[:sanity_set_size])
+    print 'encoded {} train and {} dev examples in {:.2f} seconds'.format(train_len, len(dev_lemmas),
+                                                                          time.time() - start)
+
+    # the dev examples evaluated after each evaluated epoch - a fixed sample of them if eval_dev_size is given, drawn
+    # with its own random generator so the training order does not depend on it
+    eval_dev = range(len(dev_lemmas))
+    if eval_dev_size is not None and eval_dev_size < len(dev_lemmas):
+        eval_dev = sorted(random.Random(17).sample(eval_dev, eval_dev_size))
+        print 'evaluating on a sample of {} of the {} dev examples'.format(eval_dev_size, len(dev_lemmas))
+    eval_dev_lemmas, eval_dev_feat_dicts, eval_dev_words, eval_dev_lemma_indices, eval_dev_feat_indices, \
+        eval_dev_oracles = [[column[k] for k in eval_dev] for column in [dev_lemmas, dev_feat_dicts, dev_words,
+                                                                         dev_lemma_indices, dev_feat_indices,
+                                                                         dev_oracles]]
+
+    # saves the evaluated parameters when they are the best so far, and gives the accuracy of the dev predictions
+    save_best = lambda snapshot: save_best_model(model, snapshot, results_file_path, bundle_metadata)
+    get_dev_accuracy = lambda predictions: evaluate_model(predictions, eval_dev_lemmas, eval_dev_feat_dicts,
+                                                          eval_dev_words, feature_types)[1]
+
+    # the dev evaluation of each epoch may run in a worker process on a snapshot of the parameters, while the next
+    # epoch trains. its results then arrive an epoch late
+    dev_evaluator = None
+    if async_eval and EARLY_STOPPING and len(dev_lemmas) > 0:
+        if bundle_metadata is None:
+            print 'evaluating on dev synchronously, the worker process needs the bundle metadata to build its model'
+        else:
+            dev_args = (eval_dev_lemma_indices, eval_dev_feat_indices, eval_dev_oracles, alphabet_index,
+                        inverse_alphabet_index)
+            dev_evaluator = common.AsyncEvaluator(common.init_dev_worker, (build_model, evaluate_dev, bundle_metadata,
+                                                                           dev_args), common.evaluate_dev_snapshot)
+
+    # the order of the examples in each epoch - by lemma length and then by oracle length, so batches of similar
+    # length waste little computation on padding and the curriculum goes from short to long words
+    sampler = common.TrainingSampler([(len(train_lemma_indices[k]), len(train_oracles[k][1])) for k in
+                                      xrange(train_len)], batch_size, bucket_batches, curriculum_epochs)
+    if batch_size > 1:
+        print 'grouped {} training examples into {} batches'.format(train_len, len(sampler.batches))
+
+    # checkpoints are written in the background while the next epoch trains, with these counters
+    checkpoint_writer = model_bundle.BundleWriter()
+    get_counters = lambda: {'total_loss': total_loss, 'avg_loss': avg_loss, 'best_avg_dev_loss': best_avg_dev_loss,
+                            'best_dev_accuracy': best_dev_accuracy, 'best_train_accuracy': best_train_accuracy,
+                            'best_dev_epoch': best_dev_epoch, 'patience': patience}
+    first_epoch = 0
+    state = common.resume_training(model, trainer, optimization, results_file_path, bundle_metadata,
+                                   dev_evaluator) if resume else None
+    if state is not None:
+        e = state['epoch']
+        first_epoch = e + 1
+        total_loss, avg_loss, best_avg_dev_loss, best_dev_accuracy, best_train_accuracy, best_dev_epoch, patience = [
+            state[name] for name in ['total_loss', 'avg_loss', 'best_avg_dev_loss', 'best_dev_accuracy',
+                                     'best_train_accuracy', 'best_dev_epoch', 'patience']]
+        learning_curves = state['learning_curves']
+        epochs_x, train_loss_y, dev_loss_y, train_accuracy_y, dev_accuracy_y = learning_curves
+        if batch_size > 1 and state['train_batches'] is not None:
+            sampler.batches = state['train_batches']
+        if state['stopped']:
+            train_progress_bar.finish()
+            return model, e
+
+    # per epoch throughput and timings, in JSON lines
+    telemetry = common.TrainingTelemetry(results_file_path + '_telemetry.jsonl')
+    example_chars = [len(lemma) + len(word) for lemma, word in zip(train_lemmas, train_words)]
+
+    for e in xrange(first_epoch, epochs):
+        epoch_start = time.time()
+
+        if batch_size > 1:
+
+            # compute loss for each batch, in random order, and update once per batch
+            for batch_indices in sampler.epoch(e):
+                telemetry.start_step()
+                loss = batch_loss(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn,
+                                  [train_lemma_indices[k] for k in batch_indices],
+                                  [train_feat_indices[k] for k in batch_indices],
+                                  [train_oracles[k] for k in batch_indices],
+                                  alphabet_index)
+                telemetry.mark('graph')
+                total_loss += loss.value()
+                telemetry.mark('forward')
+                loss.backward()
+                telemetry.mark('backward')
+                trainer.update()
+                telemetry.mark('update')
+
+            avg_loss = total_loss / float(sampler.examples_before(e + 1))
+        else:
+
+            # compute loss for each example, in random order, and update
+            for i, k in enumerate(sampler.epoch(e)):
+                telemetry.start_step()
+                loss = one_word_loss(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn,
+                                     train_lemma_indices[k], train_feat_indices[k], train_oracles[k], alphabet_index)
+                telemetry.mark('graph')
+                loss_value = loss.value()
+                telemetry.mark('forward')
+                total_loss += loss_value
+                loss.backward()
+                telemetry.mark('backward')
+                trainer.update()
+                telemetry.mark('update')
+                if i > 0:
+                    avg_loss = total_loss / float(i + sampler.examples_before(e))
+                else:
+                    avg_loss = total_loss
+
+        train_seconds = time.time() - epoch_start
+        eval_seconds = 0.0
+        dev_seconds = 0.0
+        dev_epoch = None
+        stop = False
 
-        if EARLY_STOPPING:
+        # evaluate every eval_every epochs, and after the last one
+        if EARLY_STOPPING and ((e + 1) % eval_every == 0 or e == epochs - 1):
+            eval_start = time.time()
 
             # get train accuracy
             print 'evaluating on train...'
@@ -315,7 +561,7 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
                                                   inverse_alphabet_index, train_lemmas[:sanity_set_size],
                                                   train_feat_dicts[:sanity_set_size],
                                                   feat_index,
-                                                  feature_types)
+                                                  feature_types, encoded_inputs=train_sanity_inputs)
 
             train_accuracy = evaluate_model(train_predictions, train_lemmas[:sanity_set_size],
                                             train_feat_dicts[:sanity_set_size],
@@ -330,58 +576,49 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
 
             if len(dev_lemmas) > 0:
 
-                # get dev accuracy
-                dev_predictions = predict_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, alphabet_index,
-                                                    inverse_alphabet_index, dev_lemmas, dev_feat_dicts, feat_index,
-                                                    feature_types)
-                print 'evaluating on dev...'
-                # get dev accuracy
-                dev_accuracy = evaluate_model(dev_predictions, dev_lemmas, dev_feat_dicts, dev_words, feature_types,
-                                              print_results=True)[1]
-
-                if dev_accuracy > best_dev_accuracy:
-                    best_dev_accuracy = dev_accuracy
-
-                    # save best model to disk
-                    save_pycnn_model(model, results_file_path)
-                    print 'saved new best model'
-                    patience = 0
+                # get dev accuracy and dev loss in one pass over dev
+                dev_start = time.time()
+                if dev_evaluator is not None:
+                    print 'evaluating a snapshot on dev in the background...'
+                    dev_result = dev_evaluator.submit(e, model_bundle.get_parameter_arrays(model))
                 else:
-                    patience += 1
-
-                # found "perfect" model
-                if dev_accuracy == 1:
-                    train_progress_bar.finish()
-                    if plot:
-                        plt.cla()
-                    return model, e
-
-                # get dev loss
-                total_dev_loss = 0
-                for i in xrange(len(dev_lemmas)):
-                    total_dev_loss += one_word_loss(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, dev_lemmas[i],
-                                                    dev_feat_dicts[i], dev_words[i], alphabet_index,
-                                                    dev_aligned_pairs[i], feat_index, feature_types).value()
-
-                avg_dev_loss = total_dev_loss / float(len(dev_lemmas))
-                if avg_dev_loss < best_avg_dev_loss:
-                    best_avg_dev_loss = avg_dev_loss
-
-                print 'epoch: {0} train loss: {1:.4f} dev loss: {2:.4f} dev accuracy: {3:.4f} train accuracy = {4:.4f} \
- best dev accuracy {5:.4f} best train accuracy: {6:.4f} patience = {7}'.format(e, avg_loss, avg_dev_loss, dev_accuracy,
-                                                                               train_accuracy, best_dev_accuracy,
-                                                                               best_train_accuracy, patience)
-
-                log_to_file(results_file_path + '_log.txt', e, avg_loss, train_accuracy, dev_accuracy)
-
-                if patience == MAX_PATIENCE:
-                    print 'out of patience after {0} epochs'.format(str(e))
-                    # TODO: would like to return best model but pycnn has a bug with save and load. Maybe copy via code?
-                    # return best_model[0]
-                    train_progress_bar.finish()
-                    if plot:
-                        plt.cla()
-                    return model, e
+                    print 'evaluating on dev...'
+                    dev_result = (e, None, evaluate_dev(model, char_lookup, feat_lookup, R, bias, encoder_frnn,
+                                                        encoder_rrnn, decoder_rnn, eval_dev_lemma_indices,
+                                                        eval_dev_feat_indices, eval_dev_oracles, alphabet_index,
+                                                        inverse_alphabet_index))
+                dev_seconds = time.time() - dev_start
+                eval_seconds = time.time() - eval_start
+
+                # the first snapshot evaluated in the background has no result yet
+                if dev_result is None:
+                    print 'epoch: {0} train loss: {1:.4f} train accuracy = {2:.4f} train time: {3:.1f}s eval time: ' \
+                          '{4:.1f}s'.format(e, avg_loss, train_accuracy, train_seconds, eval_seconds)
+                else:
+                    dev_epoch, dev_snapshot, (dev_predictions, avg_dev_loss) = dev_result
+                    dev_accuracy = evaluate_model(dev_predictions, eval_dev_lemmas, eval_dev_feat_dicts,
+                                                  eval_dev_words, feature_types, print_results=True)[1]
+                    best_dev_accuracy, best_dev_epoch, best_avg_dev_loss, patience = common.update_best_dev(
+                        save_best, dev_snapshot, dev_epoch, dev_accuracy, avg_dev_loss, best_dev_accuracy,
+                        best_dev_epoch, best_avg_dev_loss, patience)
+
+                    print 'epoch: {0} train loss: {1:.4f} dev loss: {2:.4f} dev accuracy: {3:.4f} train accuracy = \
+{4:.4f} best dev accuracy {5:.4f} best train accuracy: {6:.4f} patience = {7}'.format(e, avg_loss, avg_dev_loss,
+                                                                                     dev_accuracy, train_accuracy,
+                                                                                     best_dev_accuracy,
+                                                                                     best_train_accuracy, patience)
+                    print 'dev results of epoch {0}. train time: {1:.1f}s eval time: {2:.1f}s ({3:.1%} of the ' \
+                          'epoch)'.format(dev_epoch, train_seconds, eval_seconds,
+                                          eval_seconds / (train_seconds + eval_seconds))
+
+                    log_to_file(results_file_path + '_log.txt', e, avg_loss, train_accuracy, dev_accuracy,
+                                dev_epoch, train_seconds, eval_seconds)
+
+                    # found "perfect" model or patience has reached
+                    if dev_accuracy == 1 or patience == MAX_PATIENCE:
+                        if patience == MAX_PATIENCE:
+                            print 'out of patience after {0} epochs'.format(str(e))
+                        stop = True
             else:
 
                 # if no dev set is present, optimize on train set
@@ -392,7 +629,7 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
                     best_train_accuracy = train_accuracy
 
                     # save best model to disk
-                    save_pycnn_model(model, results_file_path)
+                    save_pycnn_model(model, results_file_path, bundle_metadata)
                     print 'saved new best model'
                     patience = 0
                 else:
@@ -402,11 +639,8 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
                 patience = {4}'.format(e, avg_loss, train_accuracy, best_train_accuracy, patience)
 
                 # found "perfect" model on train set or patience has reached
-                if train_accuracy == 1 or patience == MAX_PATIENCE:
-                    train_progress_bar.finish()
-                    if plot:
-                        plt.cla()
-                    return model, e
+                stop = train_accuracy == 1 or patience == MAX_PATIENCE
+                eval_seconds = time.time() - eval_start
 
             # update lists for plotting
             train_accuracy_y.append(train_accuracy)
@@ -415,6 +649,27 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
             dev_loss_y.append(avg_dev_loss)
             dev_accuracy_y.append(dev_accuracy)
 
+        epoch_examples = sampler.epoch_examples(e)
+        telemetry.write_epoch(e, len(epoch_examples), sum([example_chars[k] for k in epoch_examples]), train_seconds,
+                              OrderedDict([('eval_seconds', eval_seconds), ('dev_seconds', dev_seconds),
+                                           ('avg_loss', avg_loss), ('dev_epoch', dev_epoch),
+                                           ('dev_accuracy', dev_accuracy if dev_epoch is not None else None),
+                                           ('avg_dev_loss', avg_dev_loss if dev_epoch is not None else None)]))
+
+        if stop:
+            # TODO: would like to return best model but pycnn has a bug with save and load. Maybe copy via code?
+            # return best_model[0]
+            best_dev_epoch = common.finish_dev_evaluation(dev_evaluator, get_dev_accuracy, save_best,
+                                                          best_dev_accuracy, best_dev_epoch, best_avg_dev_loss,
+                                                          patience)
+            common.write_checkpoint(checkpoint_writer, model, trainer, results_file_path, bundle_metadata, e, True,
+                                    False, get_counters(), learning_curves, sampler.batches)
+            checkpoint_writer.wait()
+            train_progress_bar.finish()
+            if plot:
+                plt.cla()
+            return model, e
+
         # finished epoch
         train_progress_bar.update(e)
         if plot:
@@ -425,182 +680,386 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
                 p4, = plt.plot(epochs_x, train_accuracy_y, label='train acc.')
                 plt.legend(loc='upper left', handles=[p1, p2, p3, p4])
             plt.savefig(results_file_path + '.png')
+
+        if (e + 1) % checkpoint_every == 0 or e == epochs - 1:
+            common.write_checkpoint(checkpoint_writer, model, trainer, results_file_path, bundle_metadata, e, False,
+                                    dev_evaluator is not None and dev_evaluator.pending is not None, get_counters(),
+                                    learning_curves, sampler.batches)
+    best_dev_epoch = common.finish_dev_evaluation(dev_evaluator, get_dev_accuracy, save_best, best_dev_accuracy,
+                                                  best_dev_epoch, best_avg_dev_loss, patience)
+    checkpoint_writer.wait()
     train_progress_bar.finish()
     if plot:
         plt.cla()
-    print 'finished training. average loss: ' + str(avg_loss)
+    print 'finished training. average loss: {} best epoch on dev: {}'.format(str(avg_loss), best_dev_epoch)
     return model, e
 
 
-def save_pycnn_model(model, results_file_path):
+# saves the evaluated parameters as the best model - snapshot holds the evaluated parameter arrays, or None if they are
+# the model's current ones
+def save_best_model(model, snapshot, results_file_path, bundle_metadata):
+    if snapshot is None:
+        save_pycnn_model(model, results_file_path, bundle_metadata)
+    else:
+        model_bundle.write_bundle(snapshot[0], snapshot[1], results_file_path + '_bestmodel.bundle', bundle_metadata)
+
+
+def save_pycnn_model(model, results_file_path, bundle_metadata=None):
+    if bundle_metadata is not None:
+        model_bundle.save_bundle(model, results_file_path + '_bestmodel.bundle', bundle_metadata)
+        return
+
     tmp_model_path = results_file_path + '_bestmodel.txt'
     print 'saving to ' + tmp_model_path
     model.save(tmp_model_path)
     print 'saved to {0}'.format(tmp_model_path)
 
 
-# noinspection PyPep8Naming,PyUnusedLocal,PyUnusedLocal,PyUnusedLocal,PyUnusedLocal,PyUnusedLocal,PyUnusedLocal
-def one_word_loss(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, lemma, feats, word, alphabet_index, aligned_pair,
-                  feat_index, feature_types):
+# noinspection PyPep8Naming
+def one_word_loss(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, lemma_indices,
+                  feat_indices, oracle, alphabet_index):
     pc.renew_cg()
 
     # read the parameters
-    # char_lookup = model["char_lookup"]
-    # feat_lookup = model["feat_lookup"]
-    # R = pc.parameter(model["R"])
-    # bias = pc.parameter(model["bias"])
     R = pc.parameter(R)
     bias = pc.parameter(bias)
 
-    padded_lemma = BEGIN_WORD + lemma + END_WORD
-
-    # convert characters to matching embeddings
-    lemma_char_vecs = encode_lemma(alphabet_index, char_lookup, padded_lemma)
-
-    # convert features to matching embeddings, if UNK handle properly
-    feat_vecs = encode_feats(feat_index, feat_lookup, feats, feature_types)
-
-    feats_input = pc.concatenate(feat_vecs)
+    # convert the encoded characters and features to matching embeddings, UNK was resolved when encoding
+    lemma_char_vecs = [char_lookup[index] for index in lemma_indices]
+    feats_input = pc.concatenate([feat_lookup[index] for index in feat_indices])
 
     blstm_outputs = bilstm_transduce(encoder_frnn, encoder_rrnn, lemma_char_vecs)
 
     # initialize the decoder rnn
-    s_0 = decoder_rnn.initial_state()
-    s = s_0
+    s = decoder_rnn.initial_state()
 
-    # set prev_output_vec for first lstm step as BEGIN_WORD
-    prev_output_vec = char_lookup[alphabet_index[BEGIN_WORD]]
+    # set prev_output for first lstm step as BEGIN_WORD
+    prev_output = alphabet_index[BEGIN_WORD]
     loss = []
 
-    # i is input index, j is output index
-    i = 0
-    j = 0
+    # follow the STEP/char oracle of the alignment - each action is predicted at its input index i
+    positions, actions = oracle
+    for i, action in zip(positions, actions):
+
+        # feedback, blstm[i], feats
+        decoder_input = pc.concatenate([char_lookup[prev_output], blstm_outputs[i], feats_input])
+
+        # perform rnn step
+        s = s.add_input(decoder_input)
+        probs = pc.softmax(R * s.output() + bias)
+
+        # compute local loss
+        loss.append(-pc.log(pc.pick(probs, action)))
+
+        # prepare for the next iteration - "feedback"
+        prev_output = action
+
+    # loss = esum(loss)
+    loss = pc.average(loss)
+
+    return loss
 
-    # go through alignments, progress j when new output is introduced, progress i when new char is seen on lemma (no ~)
-    # TODO: try sutskever flip trick?
-    # TODO: attention on the lemma chars/feats could help here?
+
+# encodes examples as ints once, so training and decoding never look characters or features up again - the padded
+# lemmas as alphabet indices and the feature values as feature alphabet indices, in sorted feature type order. the
+# features are encoded once for each distinct morph signature, and examples with the same one share their indices
+def encode_inputs(lemmas, feat_dicts, alphabet_index, feat_index, feature_types):
+    sorted_feature_types = sorted(feature_types)
+    lemma_indices = [encode_lemma_indices(alphabet_index, BEGIN_WORD + lemma + END_WORD) for lemma in lemmas]
+    signatures = {}
+    morph_ids = common.get_morph_ids(feat_dicts, feature_types, signatures)
+    signature_feat_indices = [None] * len(signatures)
+    for morph_id, feat_dict in zip(morph_ids, feat_dicts):
+        if signature_feat_indices[morph_id] is None:
+            signature_feat_indices[morph_id] = encode_feat_indices(feat_index, feat_dict, sorted_feature_types)
+    feat_indices = [signature_feat_indices[morph_id] for morph_id in morph_ids]
+    return lemma_indices, feat_indices
+
+
+# encode_inputs for aligned examples, with the STEP/char oracle of each alignment
+def encode_examples(lemmas, feat_dicts, aligned_pairs, alphabet_index, feat_index, feature_types):
+    lemma_indices, feat_indices = encode_inputs(lemmas, feat_dicts, alphabet_index, feat_index, feature_types)
+    oracles = [get_oracle_actions(lemma, aligned_pair, alphabet_index)
+               for lemma, aligned_pair in zip(lemmas, aligned_pairs)]
+    return lemma_indices, feat_indices, oracles
+
+
+# returns the STEP/char oracle of the given alignment as (input index, gold output index) pairs, which one_word_loss and
+# batch_loss follow
+def get_oracle_actions(lemma, aligned_pair, alphabet_index):
+    padded_lemma = BEGIN_WORD + lemma + END_WORD
     aligned_lemma, aligned_word = aligned_pair
     aligned_lemma += END_WORD
     aligned_word += END_WORD
+    step_index = alphabet_index[STEP]
 
-    # run through the alignments
+    positions = []
+    actions = []
+    i = 0
     for align_index, (input_char, output_char) in enumerate(zip(aligned_lemma, aligned_word)):
-        possible_outputs = []
-
-        # feedback, blstm[i], feats
-        decoder_input = pc.concatenate([prev_output_vec, blstm_outputs[i], feats_input])
-
-        # if reached the end word symbol
         if output_char == END_WORD:
-            s = s.add_input(decoder_input)
-            decoder_rnn_output = s.output()
-            probs = pc.softmax(R * decoder_rnn_output + bias)
-
-            # compute local loss
-            loss.append(-pc.log(pc.pick(probs, alphabet_index[END_WORD])))
+            positions.append(i)
+            actions.append(alphabet_index[END_WORD])
             continue
 
         # initially, if there is no prefix in the output (shouldn't delay on current input), step forward
-        # TODO: check if can remove this condition entirely by adding '<' to both the aligned lemma/word
         if padded_lemma[i] == BEGIN_WORD and aligned_lemma[align_index] != ALIGN_SYMBOL:
+            positions.append(i)
+            actions.append(step_index)
+            i += 1
 
-            # perform rnn step
-            s = s.add_input(decoder_input)
-            decoder_rnn_output = s.output()
-            probs = pc.softmax(R * decoder_rnn_output + bias)
-
-            # compute local loss
-            loss.append(-pc.log(pc.pick(probs, alphabet_index[STEP])))
+        # if a new output character is introduced in the alignment, it should be predicted
+        if aligned_word[align_index] != ALIGN_SYMBOL:
+            positions.append(i)
+            if aligned_word[align_index] in alphabet_index:
+                actions.append(alphabet_index[aligned_word[align_index]])
+            else:
+                actions.append(alphabet_index[UNK])
 
-            # prepare for the next iteration - "feedback"
-            prev_output_vec = char_lookup[alphabet_index[STEP]]
-            prev_char_vec = char_lookup[alphabet_index[EPSILON]]
+        # if the input's not done and we shouldn't delay on the character (many-to-one alignment), perform step
+        if i < len(padded_lemma) - 1 and aligned_lemma[align_index + 1] != ALIGN_SYMBOL:
+            positions.append(i)
+            actions.append(step_index)
             i += 1
 
-        # if a new output character is introduced in the alignment, compute loss for predicting it
-        if aligned_word[align_index] != ALIGN_SYMBOL:
-            decoder_input = pc.concatenate([prev_output_vec, blstm_outputs[i], feats_input])
+    return positions, actions
 
-            # perform rnn step
-            s = s.add_input(decoder_input)
-            decoder_rnn_output = s.output()
-            probs = pc.softmax(R * decoder_rnn_output + bias)
 
-            if aligned_word[align_index] in alphabet_index:
-                current_loss = -pc.log(pc.pick(probs, alphabet_index[aligned_word[align_index]]))
+# noinspection PyPep8Naming
+def batch_loss(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, lemma_indices,
+               feat_indices, oracles, alphabet_index):
+    pc.renew_cg()
+
+    R = pc.parameter(R)
+    bias = pc.parameter(bias)
+
+    lemma_lengths = [len(indices) for indices in lemma_indices]
+
+    # batched BiLSTM over the lemmas, stacked into (hidden x max lemma length) matrices
+    frnn_outputs, rrnn_outputs = batch_bilstm_transduce(encoder_frnn, encoder_rrnn, char_lookup, alphabet_index,
+                                                        lemma_indices)
+    frnn_matrix = pc.concatenate_cols(frnn_outputs)
+    rrnn_matrix = pc.concatenate_cols(rrnn_outputs)
+
+    feats_input = batch_encode_feats(feat_lookup, feat_indices)
 
-                # prepare for the next iteration - "feedback"
-                prev_output_vec = char_lookup[alphabet_index[aligned_word[align_index]]]
+    return batch_oracle_loss(char_lookup, R, bias, decoder_rnn, frnn_matrix, rrnn_matrix, lemma_lengths, feats_input,
+                             oracles, alphabet_index)
+
+
+# the loss of following the STEP/char oracles of a batch of lemmas, given their BiLSTM outputs and features. R and bias
+# are expressions in the current graph
+# noinspection PyPep8Naming
+def batch_oracle_loss(char_lookup, R, bias, decoder_rnn, frnn_matrix, rrnn_matrix, lemma_lengths, feats_input, oracles,
+                      alphabet_index):
+    max_lemma_len = max(lemma_lengths)
+
+    # initialize the decoder rnn
+    s = decoder_rnn.initial_state()
+
+    # set prev_outputs for first lstm step as BEGIN_WORD
+    prev_outputs = [alphabet_index[BEGIN_WORD]] * len(oracles)
+    max_oracle_len = max(len(actions) for positions, actions in oracles)
+    loss = []
+
+    for t in xrange(max_oracle_len):
+        positions = []
+        targets = []
+        weights = []
+        for b, (oracle_positions, oracle_actions) in enumerate(oracles):
+            if t < len(oracle_actions):
+                positions.append(oracle_positions[t])
+                targets.append(oracle_actions[t])
+
+                # each word contributes its average loss, as in one_word_loss
+                weights.append(1.0 / len(oracle_actions))
             else:
-                current_loss = -pc.log(pc.pick(probs, alphabet_index[UNK]))
+                # finished words keep feeding END_WORD, their loss is masked out
+                positions.append(lemma_lengths[b] - 1)
+                targets.append(alphabet_index[END_WORD])
+                weights.append(0.0)
 
-                # prepare for the next iteration - "feedback"
-                prev_output_vec = char_lookup[alphabet_index[UNK]]
-            loss.append(current_loss)
+        # feedback, blstm[i], feats
+        blstm_input = batch_blstm_at(frnn_matrix, rrnn_matrix, positions, lemma_lengths, max_lemma_len)
+        decoder_input = pc.concatenate([pc.lookup_batch(char_lookup, prev_outputs), blstm_input, feats_input])
+        s = s.add_input(decoder_input)
+        step_loss = pc.pickneglogsoftmax_batch(R * s.output() + bias, targets)
+        loss.append(pc.cmult(step_loss, batch_scalars(weights)))
 
-            j += 1
+        # prepare for the next iteration - "feedback"
+        prev_outputs = targets
 
-        # if the input's not done and we shouldn't delay on the character (many-to-one alignment), perform step
-        if i < len(padded_lemma) - 1 and aligned_lemma[align_index + 1] != ALIGN_SYMBOL:
-            # perform rnn step
-            # feedback, blstm[i], feats
-            decoder_input = pc.concatenate([prev_output_vec, blstm_outputs[i], feats_input])
+    return pc.sum_batches(pc.esum(loss))
 
-            s = s.add_input(decoder_input)
-            decoder_rnn_output = s.output()
-            probs = pc.softmax(R * decoder_rnn_output + bias)
 
-            # compute local loss for the step action
-            loss.append(-pc.log(pc.pick(probs, alphabet_index[STEP])))
+def batch_bilstm_transduce(encoder_frnn, encoder_rrnn, char_lookup, alphabet_index, lemma_indices):
+    max_lemma_len = max(len(indices) for indices in lemma_indices)
+    pad_index = alphabet_index[NULL]
 
-            # prepare for the next iteration - "feedback"
-            prev_output_vec = char_lookup[alphabet_index[STEP]]
-            i += 1
+    # lemmas are reversed before padding for the backward pass, so padding never precedes a real character
+    forward_indices = [list(indices) + [pad_index] * (max_lemma_len - len(indices)) for indices in lemma_indices]
+    backward_indices = [list(indices[::-1]) + [pad_index] * (max_lemma_len - len(indices))
+                        for indices in lemma_indices]
 
-    # loss = esum(loss)
-    loss = pc.average(loss)
+    # BiLSTM forward pass
+    s = encoder_frnn.initial_state()
+    frnn_outputs = []
+    for t in xrange(max_lemma_len):
+        s = s.add_input(pc.lookup_batch(char_lookup, [indices[t] for indices in forward_indices]))
+        frnn_outputs.append(s.output())
 
-    return loss
+    # BiLSTM backward pass - step t holds position len(padded_lemma) - t - 1 of each lemma
+    s = encoder_rrnn.initial_state()
+    rrnn_outputs = []
+    for t in xrange(max_lemma_len):
+        s = s.add_input(pc.lookup_batch(char_lookup, [indices[t] for indices in backward_indices]))
+        rrnn_outputs.append(s.output())
 
+    return frnn_outputs, rrnn_outputs
 
-def encode_feats(feat_index, feat_lookup, feats, feature_types):
-    feat_vecs = []
-    for feat in sorted(feature_types):
-        # TODO: is it OK to use same UNK for all feature types? and for unseen feats as well?
-        # if this feature has a value, take it from the lookup. otherwise use UNK
+
+# encodes each distinct lemma in a batch once, and returns its BiLSTM outputs for every request in the batch, as
+# (hidden x max lemma length) matrices batched by request. lemmas are told apart by their indices, so lemmas that
+# differ only in unknown characters share their outputs
+def batch_encode_lemmas(encoder_frnn, encoder_rrnn, char_lookup, alphabet_index, lemma_indices, encoder_cache=None):
+    padded_lemmas = [tuple(indices) for indices in lemma_indices]
+    distinct_lemmas = list(OrderedDict.fromkeys(padded_lemmas))
+    distinct_positions = {padded_lemma: d for d, padded_lemma in enumerate(distinct_lemmas)}
+    request_positions = [distinct_positions[padded_lemma] for padded_lemma in padded_lemmas]
+
+    if encoder_cache is None:
+        frnn_outputs, rrnn_outputs = batch_bilstm_transduce(encoder_frnn, encoder_rrnn, char_lookup, alphabet_index,
+                                                            distinct_lemmas)
+        frnn_matrix = pc.concatenate_cols(frnn_outputs)
+        rrnn_matrix = pc.concatenate_cols(rrnn_outputs)
+    else:
+        # requests for a lemma already encoded in this batch are hits as well
+        encoder_cache.hits += len(padded_lemmas) - len(distinct_lemmas)
+        encoded = [encoder_cache.get(padded_lemma) for padded_lemma in distinct_lemmas]
+        missing = [d for d, outputs in enumerate(encoded) if outputs is None]
+        if len(missing) > 0:
+            missing_lemmas = [distinct_lemmas[d] for d in missing]
+            frnn_outputs, rrnn_outputs = batch_bilstm_transduce(encoder_frnn, encoder_rrnn, char_lookup,
+                                                                alphabet_index, missing_lemmas)
+            hidden_dim = frnn_outputs[0].dim()[0][0]
+            shape = (hidden_dim, len(frnn_outputs), len(missing))
+            frnn_values = pc.concatenate_cols(frnn_outputs).npvalue().reshape(shape)
+            rrnn_values = pc.concatenate_cols(rrnn_outputs).npvalue().reshape(shape)
+
+            # only the first len(padded_lemma) outputs of each direction belong to the lemma, the rest are padding
+            for k, d in enumerate(missing):
+                lemma_len = len(distinct_lemmas[d])
+                encoded[d] = (frnn_values[:, :lemma_len, k].copy(), rrnn_values[:, :lemma_len, k].copy())
+                encoder_cache.put(distinct_lemmas[d], encoded[d])
+
+        # the cached outputs enter the graph as constants, zero padded to the longest lemma
+        max_lemma_len = max(len(padded_lemma) for padded_lemma in distinct_lemmas)
+        hidden_dim = encoded[0][0].shape[0]
+        frnn_values = np.zeros((hidden_dim, max_lemma_len, len(distinct_lemmas)))
+        rrnn_values = np.zeros((hidden_dim, max_lemma_len, len(distinct_lemmas)))
+        for d, (frnn_lemma_values, rrnn_lemma_values) in enumerate(encoded):
+            frnn_values[:, :frnn_lemma_values.shape[1], d] = frnn_lemma_values
+            rrnn_values[:, :rrnn_lemma_values.shape[1], d] = rrnn_lemma_values
+        frnn_matrix = pc.inputTensor(frnn_values, batched=True)
+        rrnn_matrix = pc.inputTensor(rrnn_values, batched=True)
+
+    if len(distinct_lemmas) < len(padded_lemmas):
+        frnn_matrix = pc.pick_batch_elems(frnn_matrix, request_positions)
+        rrnn_matrix = pc.pick_batch_elems(rrnn_matrix, request_positions)
+    return frnn_matrix, rrnn_matrix
+
+
+# a bounded LRU cache of the BiLSTM outputs of padded lemmas, keyed by their indices and kept as numpy matrices so they
+# outlive the computation graph. the outputs are only valid for the parameters they were computed with, so a cache must
+# not be shared between models or kept across training updates
+class EncoderCache:
+
+    def __init__(self, size=ENCODER_CACHE_SIZE):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, padded_lemma):
+        if padded_lemma not in self.entries:
+            self.misses += 1
+            return None
+
+        # move the lemma to the most recently used end
+        self.hits += 1
+        outputs = self.entries.pop(padded_lemma)
+        self.entries[padded_lemma] = outputs
+        return outputs
+
+    def put(self, padded_lemma, outputs):
+        self.entries[padded_lemma] = outputs
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0.0
+        return float(self.hits) / (self.hits + self.misses)
+
+    def report(self):
+        return 'encoder cache: {} hits, {} misses, {:.2f}% hit rate, {} lemmas cached'.format(
+            self.hits, self.misses, 100 * self.hit_rate(), len(self.entries))
+
+
+def batch_blstm_at(frnn_matrix, rrnn_matrix, positions, lemma_lengths, max_lemma_len):
+    # select blstm[i] for each lemma in the batch, where each lemma has its own i
+    backward_positions = [lemma_lengths[b] - i - 1 for b, i in enumerate(positions)]
+    return pc.concatenate([frnn_matrix * batch_one_hots(positions, max_lemma_len),
+                           rrnn_matrix * batch_one_hots(backward_positions, max_lemma_len)])
+
+
+def batch_one_hots(indices, dim):
+    values = [0.0] * (dim * len(indices))
+    for b, index in enumerate(indices):
+        values[b * dim + index] = 1.0
+    return pc.reshape(pc.inputVector(values), (dim,), batch_size=len(indices))
+
+
+def batch_scalars(values):
+    return pc.reshape(pc.inputVector(values), (1,), batch_size=len(values))
+
+
+def batch_encode_feats(feat_lookup, feat_indices):
+    # one batched lookup per feature type
+    return pc.concatenate([pc.lookup_batch(feat_lookup, list(type_indices)) for type_indices in zip(*feat_indices)])
+
+
+# sorted_feature_types are the feature types of the model in sorted order, sorted once by the caller
+def encode_feat_indices(feat_index, feats, sorted_feature_types):
+    unk_index = feat_index[UNK_FEAT]
+    feat_indices = []
+    for feat in sorted_feature_types:
+        # if this feature has a known value, take its index. otherwise use UNK
         if feat in feats:
-            feat_str = feat + ':' + feats[feat]
-            try:
-                feat_vecs.append(feat_lookup[feat_index[feat_str]])
-            except KeyError:
-                # handle UNK or dropout
-                feat_vecs.append(feat_lookup[feat_index[UNK_FEAT]])
+            feat_indices.append(feat_index.get(feat + ':' + feats[feat], unk_index))
         else:
-            feat_vecs.append(feat_lookup[feat_index[UNK_FEAT]])
-    return feat_vecs
+            feat_indices.append(unk_index)
+    return feat_indices
+
+
+def encode_lemma_indices(alphabet_index, padded_lemma):
+    # handle UNK
+    unk_index = alphabet_index[UNK]
+    return [alphabet_index.get(char, unk_index) for char in padded_lemma]
 
 
 # noinspection PyPep8Naming
-def predict_output_sequence(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, lemma, feats, alphabet_index,
-                            inverse_alphabet_index, feat_index, feature_types):
+def predict_output_sequence(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn,
+                            lemma_indices, feat_indices, alphabet_index, inverse_alphabet_index):
     pc.renew_cg()
 
     # read the parameters
-    # char_lookup = model["char_lookup"]
-    # feat_lookup = model["feat_lookup"]
-    # R = pc.parameter(model["R"])
-    # bias = pc.parameter(model["bias"])
     R = pc.parameter(R)
     bias = pc.parameter(bias)
 
-    # convert characters to matching embeddings, if UNK handle properly
-    padded_lemma = BEGIN_WORD + lemma + END_WORD
-    lemma_char_vecs = encode_lemma(alphabet_index, char_lookup, padded_lemma)
-
-    # convert features to matching embeddings, if UNK handle properly
-    feat_vecs = encode_feats(feat_index, feat_lookup, feats, feature_types)
-
-    feats_input = pc.concatenate(feat_vecs)
+    # convert the encoded characters and features to matching embeddings, UNK was resolved when encoding
+    lemma_char_vecs = [char_lookup[index] for index in lemma_indices]
+    feats_input = pc.concatenate([feat_lookup[index] for index in feat_indices])
 
     blstm_outputs = bilstm_transduce(encoder_frnn, encoder_rrnn, lemma_char_vecs)
 
@@ -636,7 +1095,7 @@ def predict_output_sequence(model, char_lookup, feat_lookup, R, bias, encoder_fr
 
         # check if step or char output to promote i.
         if predicted_output == STEP:
-            if i < len(padded_lemma) - 1:
+            if i < len(lemma_indices) - 1:
                 i += 1
 
         num_outputs += 1
@@ -679,33 +1138,251 @@ def bilstm_transduce(encoder_frnn, encoder_rrnn, lemma_char_vecs):
     return blstm_outputs
 
 
-def encode_lemma(alphabet_index, char_lookup, padded_lemma):
-    lemma_char_vecs = []
-    for char in padded_lemma:
-        try:
-            lemma_char_vecs.append(char_lookup[alphabet_index[char]])
-        except KeyError:
-            # handle UNK
-            lemma_char_vecs.append(char_lookup[alphabet_index[UNK]])
+# returns the predicted sequence of each example, in the order of the examples. encoded_inputs are the result of
+# encode_inputs on the lemmas and feats, if they were already encoded
+def predict_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, alphabet_index, inverse_alphabet_index, lemmas,
+                      feats, feat_index, feature_types, encoder_cache=None, encoded_inputs=None):
+    predictions = [None] * len(lemmas)
+    if encoded_inputs is None:
+        encoded_inputs = encode_inputs(lemmas, feats, alphabet_index, feat_index, feature_types)
+    lemma_indices, feat_indices = encoded_inputs
+
+    # decode lemmas of similar length together, so the batched encoder wastes little computation on padding, and the
+    # requests for the same lemma together, so it is encoded once
+    by_length = sorted(xrange(len(lemma_indices)), key=lambda k: (len(lemma_indices[k]), lemma_indices[k]))
+    for start in xrange(0, len(by_length), DECODE_BATCH_SIZE):
+        batch_indices = by_length[start:start + DECODE_BATCH_SIZE]
+        predicted_sequences = predict_output_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn,
+                                                       encoder_rrnn, decoder_rnn,
+                                                       [lemma_indices[k] for k in batch_indices],
+                                                       [feat_indices[k] for k in batch_indices],
+                                                       alphabet_index, inverse_alphabet_index, encoder_cache)
+
+        for k, predicted_sequence in zip(batch_indices, predicted_sequences):
+            predictions[k] = predicted_sequence
 
-    return lemma_char_vecs
+    return predictions
 
 
-def predict_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, alphabet_index, inverse_alphabet_index, lemmas,
-                      feats, feat_index, feature_types):
-    predictions = {}
-    for i, (lemma, feat_dict) in enumerate(zip(lemmas, feats)):
-        predicted_sequence = predict_output_sequence(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, lemma,
-                                                     feat_dict, alphabet_index, inverse_alphabet_index, feat_index,
-                                                     feature_types)
+# greedy decoding of a batch of lemmas in lockstep, gives the same outputs as predict_output_sequence on each lemma
+# noinspection PyPep8Naming
+def predict_output_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn,
+                             lemma_indices, feat_indices, alphabet_index, inverse_alphabet_index, encoder_cache=None):
+    pc.renew_cg()
+
+    R = pc.parameter(R)
+    bias = pc.parameter(bias)
+
+    lemma_lengths = [len(indices) for indices in lemma_indices]
+
+    frnn_matrix, rrnn_matrix = batch_encode_lemmas(encoder_frnn, encoder_rrnn, char_lookup, alphabet_index,
+                                                   lemma_indices, encoder_cache)
+    feats_input = batch_encode_feats(feat_lookup, feat_indices)
 
-        # index each output by its matching inputs - lemma + features
-        joint_index = lemma + ':' + common.get_morph_string(feat_dict, feature_types)
-        predictions[joint_index] = predicted_sequence
+    return batch_greedy_decode(char_lookup, R, bias, decoder_rnn, frnn_matrix, rrnn_matrix, lemma_lengths, feats_input,
+                               alphabet_index, inverse_alphabet_index)
+
+
+# greedy decoding of a batch of lemmas given their BiLSTM outputs and features. R and bias are expressions in the
+# current graph
+# noinspection PyPep8Naming
+def batch_greedy_decode(char_lookup, R, bias, decoder_rnn, frnn_matrix, rrnn_matrix, lemma_lengths, feats_input,
+                        alphabet_index, inverse_alphabet_index):
+    max_lemma_len = max(lemma_lengths)
+
+    # initialize the decoder rnn
+    s = decoder_rnn.initial_state()
+
+    # active holds the batch positions of the lemmas still being decoded, each with its own input index i
+    active = range(len(lemma_lengths))
+    positions = [0] * len(lemma_lengths)
+    prev_outputs = [alphabet_index[BEGIN_WORD]] * len(lemma_lengths)
+    predicted_output_sequences = [[] for _ in lemma_lengths]
+    end_index = alphabet_index[END_WORD]
+    step_index = alphabet_index[STEP]
+    num_outputs = 0
+
+    while num_outputs < MAX_PREDICTION_LEN * 3:
+
+        # prepare input vector and perform LSTM step
+        blstm_input = batch_blstm_at(frnn_matrix, rrnn_matrix, [positions[b] for b in active],
+                                     [lemma_lengths[b] for b in active], max_lemma_len)
+        decoder_input = pc.concatenate([pc.lookup_batch(char_lookup, [prev_outputs[b] for b in active]),
+                                        blstm_input,
+                                        feats_input])
+        s = s.add_input(decoder_input)
+
+        # compute softmax probs and predict with argmax, one column per active lemma
+        probs = pc.softmax(R * s.output() + bias).npvalue().reshape((-1, len(active)))
+        predicted_output_indices = np.argmax(probs, axis=0)
+        num_outputs += 1
+
+        still_active = []
+        for k, b in enumerate(active):
+            predicted_output_index = int(predicted_output_indices[k])
+            predicted_output_sequences[b].append(inverse_alphabet_index[predicted_output_index])
+
+            # check if step or char output to promote i.
+            if predicted_output_index == step_index and positions[b] < lemma_lengths[b] - 1:
+                positions[b] += 1
+
+            # lemmas that reached the end of word drop out of the batch
+            if predicted_output_index != end_index:
+                prev_outputs[b] = predicted_output_index
+                still_active.append(k)
+
+        if len(still_active) == 0:
+            break
+
+        if len(still_active) < len(active):
+            frnn_matrix, rrnn_matrix, feats_input = [pc.pick_batch_elems(e, still_active)
+                                                     for e in [frnn_matrix, rrnn_matrix, feats_input]]
+            s = decoder_rnn.initial_state([pc.pick_batch_elems(e, still_active) for e in s.s()])
+            active = [active[k] for k in still_active]
+
+    # remove the end word symbol
+    return [u''.join(predicted_output_sequence[0:-1]) for predicted_output_sequence in predicted_output_sequences]
+
+
+# the greedy predictions of the dev examples, in their order, and their average oracle loss, in a single pass - each
+# batch is encoded once, and the loss and the greedy decoding both read the same encoder outputs. the average loss is
+# the one one_word_loss gives on each example
+# noinspection PyPep8Naming
+def evaluate_dev(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, lemma_indices,
+                 feat_indices, oracles, alphabet_index, inverse_alphabet_index):
+    predictions = [None] * len(lemma_indices)
+    total_loss = 0.0
+    by_length = sorted(xrange(len(lemma_indices)), key=lambda k: (len(lemma_indices[k]), lemma_indices[k]))
+    for start in xrange(0, len(by_length), DECODE_BATCH_SIZE):
+        batch_indices = by_length[start:start + DECODE_BATCH_SIZE]
+        batch_lemma_indices = [lemma_indices[k] for k in batch_indices]
+        pc.renew_cg()
+
+        R_expression = pc.parameter(R)
+        bias_expression = pc.parameter(bias)
+        lemma_lengths = [len(indices) for indices in batch_lemma_indices]
+        frnn_matrix, rrnn_matrix = batch_encode_lemmas(encoder_frnn, encoder_rrnn, char_lookup, alphabet_index,
+                                                       batch_lemma_indices)
+        feats_input = batch_encode_feats(feat_lookup, [feat_indices[k] for k in batch_indices])
+
+        # the loss is only built here, it is computed along with the decoding since they share the graph
+        loss = batch_oracle_loss(char_lookup, R_expression, bias_expression, decoder_rnn, frnn_matrix, rrnn_matrix,
+                                 lemma_lengths, feats_input, [oracles[k] for k in batch_indices], alphabet_index)
+        predicted_sequences = batch_greedy_decode(char_lookup, R_expression, bias_expression, decoder_rnn,
+                                                  frnn_matrix, rrnn_matrix, lemma_lengths, feats_input,
+                                                  alphabet_index, inverse_alphabet_index)
+        total_loss += loss.value()
+
+        for k, predicted_sequence in zip(batch_indices, predicted_sequences):
+            predictions[k] = predicted_sequence
+
+    return predictions, total_loss / max(len(lemma_indices), 1)
+
+
+# returns the ranked list of (sequence, log prob) of each example, in the order of the examples
+def predict_nbest_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn,
+                            alphabet_index, inverse_alphabet_index, lemmas, feats, feat_index, feature_types,
+                            beam_width, nbest, encoder_cache=None, encoded_inputs=None):
+    predictions = [None] * len(lemmas)
+    if encoded_inputs is None:
+        encoded_inputs = encode_inputs(lemmas, feats, alphabet_index, feat_index, feature_types)
+    lemma_indices, feat_indices = encoded_inputs
+
+    # the beams of a whole batch of lemmas are decoded together, requests for the same lemma in the same batch
+    by_length = sorted(xrange(len(lemma_indices)), key=lambda k: (len(lemma_indices[k]), lemma_indices[k]))
+    for start in xrange(0, len(by_length), DECODE_BATCH_SIZE):
+        batch_indices = by_length[start:start + DECODE_BATCH_SIZE]
+        nbest_sequences = predict_nbest_output_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn,
+                                                         encoder_rrnn, decoder_rnn,
+                                                         [lemma_indices[k] for k in batch_indices],
+                                                         [feat_indices[k] for k in batch_indices],
+                                                         alphabet_index, inverse_alphabet_index, beam_width, nbest,
+                                                         encoder_cache)
+
+        for k, ranked in zip(batch_indices, nbest_sequences):
+            predictions[k] = ranked
 
     return predictions
 
 
+# log-space beam search over a batch of lemmas. the hypotheses of all lemmas advance together in one dynet batch, and
+# hypotheses extending the same prefix share the decoder state computed for it
+# noinspection PyPep8Naming
+def predict_nbest_output_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn,
+                                   lemma_indices, feat_indices, alphabet_index, inverse_alphabet_index, beam_width,
+                                   nbest, encoder_cache=None):
+    pc.renew_cg()
+
+    R = pc.parameter(R)
+    bias = pc.parameter(bias)
+
+    lemma_lengths = [len(indices) for indices in lemma_indices]
+    max_lemma_len = max(lemma_lengths)
+
+    frnn_matrix, rrnn_matrix = batch_encode_lemmas(encoder_frnn, encoder_rrnn, char_lookup, alphabet_index,
+                                                   lemma_indices, encoder_cache)
+    feats_input = batch_encode_feats(feat_lookup, feat_indices)
+
+    end_index = alphabet_index[END_WORD]
+    step_index = alphabet_index[STEP]
+    beams = [beam_search.Beam(beam_width, nbest, end_index) for _ in lemma_indices]
+
+    # the live hypotheses of all beams, grouped by lemma, each with its input index i and previous output
+    hypothesis_lemmas = range(len(lemma_indices))
+    positions = [0] * len(lemma_indices)
+    prev_outputs = [alphabet_index[BEGIN_WORD]] * len(lemma_indices)
+    s = decoder_rnn.initial_state()
+    num_outputs = 0
+
+    while len(hypothesis_lemmas) > 0 and num_outputs < MAX_PREDICTION_LEN * 3:
+
+        # prepare input vectors and perform LSTM step for all hypotheses
+        blstm_input = batch_blstm_at(pc.pick_batch_elems(frnn_matrix, hypothesis_lemmas),
+                                     pc.pick_batch_elems(rrnn_matrix, hypothesis_lemmas),
+                                     positions, [lemma_lengths[b] for b in hypothesis_lemmas], max_lemma_len)
+        decoder_input = pc.concatenate([pc.lookup_batch(char_lookup, prev_outputs),
+                                        blstm_input,
+                                        pc.pick_batch_elems(feats_input, hypothesis_lemmas)])
+        s = s.add_input(decoder_input)
+        log_probs = pc.log_softmax(R * s.output() + bias).npvalue().reshape((-1, len(hypothesis_lemmas)))
+        num_outputs += 1
+
+        # advance the beam of each lemma on its own columns
+        next_lemmas = []
+        next_positions = []
+        next_outputs = []
+        parents = []
+        offset = 0
+        for b in sorted(set(hypothesis_lemmas)):
+            size = beams[b].size()
+            beam_parents, beam_outputs = beams[b].advance(log_probs[:, offset:offset + size])
+            for parent, output_index in zip(beam_parents, beam_outputs):
+                i = positions[offset + parent]
+
+                # check if step or char output to promote i.
+                if output_index == step_index and i < lemma_lengths[b] - 1:
+                    i += 1
+                next_lemmas.append(b)
+                next_positions.append(i)
+                next_outputs.append(int(output_index))
+                parents.append(offset + int(parent))
+            offset += size
+
+        hypothesis_lemmas = next_lemmas
+        positions = next_positions
+        prev_outputs = next_outputs
+        if len(hypothesis_lemmas) > 0:
+            s = decoder_rnn.initial_state([pc.pick_batch_elems(e, parents) for e in s.s()])
+
+    # hypotheses that reached the maximal length without END_WORD lose their last output, as in greedy decoding
+    nbest_sequences = []
+    for beam in beams:
+        nbest_sequences.append([(u''.join([inverse_alphabet_index[o] for o in sequence]), score)
+                                for sequence, score in beam.nbest(trim_unfinished=True)])
+
+    return nbest_sequences
+
+
 def represents_int(s):
     try:
         int(s)
@@ -714,6 +1391,7 @@ def represents_int(s):
         return False
 
 
+# predicted_sequences holds the predicted sequence of each example, in the order of the examples
 def evaluate_model(predicted_sequences, lemmas, feature_dicts, words, feature_types, print_results=False):
     if print_results:
         print 'evaluating model...'
@@ -721,9 +1399,8 @@ def evaluate_model(predicted_sequences, lemmas, feature_dicts, words, feature_ty
     test_data = zip(lemmas, feature_dicts, words)
     c = 0
     for i, (lemma, feat_dict, word) in enumerate(test_data):
-        joint_index = lemma + ':' + common.get_morph_string(feat_dict, feature_types)
-        predicted_template = predicted_sequences[joint_index]
-        predicted_word = predicted_sequences[joint_index].replace(STEP, '')
+        predicted_template = predicted_sequences[i]
+        predicted_word = predicted_sequences[i].replace(STEP, '')
         if predicted_word == word:
             c += 1
             sign = u'V'
@@ -748,65 +1425,88 @@ def evaluate_model(predicted_sequences, lemmas, feature_dicts, words, feature_ty
     return len(predicted_sequences), accuracy
 
 
+# loads a single ensemble model and predicts the test set with it, in a worker process
+def predict_with_ensemble_member(params):
+    (member_index, model_path, alphabet, alphabet_index, inverse_alphabet_index, feat_index, feature_alphabet,
+     feature_types, input_dim, hidden_dim, layers, feat_input_dim, lemmas, feats, beam_width, nbest) = params
+
+    model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn = load_best_model(
+        alphabet, model_path, input_dim, hidden_dim, layers, feature_alphabet, feat_input_dim, feature_types)
+    encoder_cache = EncoderCache()
+    nbest_sequences = None
+    if beam_width > 1:
+        nbest_sequences = predict_nbest_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn,
+                                                  encoder_rrnn, decoder_rnn, alphabet_index, inverse_alphabet_index,
+                                                  lemmas, feats, feat_index, feature_types, beam_width, nbest,
+                                                  encoder_cache)
+        predicted_sequences = [ranked[0][0] for ranked in nbest_sequences]
+    else:
+        predicted_sequences = predict_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn,
+                                                decoder_rnn, alphabet_index, inverse_alphabet_index, lemmas, feats,
+                                                feat_index, feature_types, encoder_cache)
+    print encoder_cache.report()
+
+    # send back only the predicted sequences, and the ranked ones when decoding with a beam, in the order of the
+    # examples
+    return member_index, predicted_sequences, nbest_sequences
+
+
 def evaluate_ndst(alphabet, alphabet_index, ensemble, feat_index, feat_input_dim, feature_alphabet, feature_types,
                   hidden_dim, hyper_params, input_dim, inverse_alphabet_index, layers, results_file_path,
                   sigmorphon_root_dir, test_feat_dicts, test_lemmas, test_path,
-                  test_words, train_path, print_results=False):
+                  test_words, train_path, print_results=False, beam_width=1, nbest=1):
     accuracies = []
     final_results = {}
+    nbest_sequences = None
     if ensemble:
-        # load ensemble models
         ensemble_model_names = ensemble.split(',')
         print 'ensemble paths:\n'
         print '\n'.join(ensemble_model_names)
-        ensemble_models = []
-        for ens in ensemble_model_names:
-            model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn = load_best_model(
-                alphabet,
-                ens,
-                input_dim,
-                hidden_dim,
-                layers,
-                feature_alphabet,
-                feat_input_dim,
-                feature_types)
-
-            ensemble_models.append((model, encoder_frnn, encoder_rrnn, decoder_rnn))
-
-        # predict the entire test set with each model in the ensemble
+
+        # predict the entire test set with each model in the ensemble, one model per worker process
         print 'predicting...'
-        ensemble_predictions = []
-        count = 0
-        for em in ensemble_models:
-            count += 1
-            model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn = em
-            predicted_sequences = predict_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn,
-                                                    alphabet_index,
-                                                    inverse_alphabet_index,
-                                                    test_lemmas,
-                                                    test_feat_dicts,
-                                                    feat_index,
-                                                    feature_types)
-            ensemble_predictions.append(predicted_sequences)
-            print 'finished to predict with ensemble: {}/{}'.format(count, len(ensemble_model_names))
-
-        predicted_sequences = {}
-        string_to_sequence = {}
-
-        # perform voting for each test input - joint_index is a lemma+feats representation
-        test_data = zip(test_lemmas, test_feat_dicts, test_words)
-        for i, (lemma, feat_dict, word) in enumerate(test_data):
-            joint_index = lemma + ':' + common.get_morph_string(feat_dict, feature_types)
-            prediction_counter = defaultdict(int)
-
-            # count votes
-            for en in ensemble_predictions:
-                prediction_str = ''.join(en[joint_index]).replace(STEP, '')
-                prediction_counter[prediction_str] += 1
-                string_to_sequence[prediction_str] = en[joint_index]
-                if print_results:
-                    print 'template: {} prediction: {}'.format(en[joint_index].encode('utf8'),
-                                                               prediction_str.encode('utf8'))
+        params = [[member_index, ens, alphabet, alphabet_index, inverse_alphabet_index, feat_index, feature_alphabet,
+                   feature_types, input_dim, hidden_dim, layers, feat_input_dim, test_lemmas, test_feat_dicts,
+                   beam_width, nbest] for member_index, ens in enumerate(ensemble_model_names)]
+        pool = Pool(min(len(ensemble_model_names), cpu_count()), maxtasksperchild=1)
+
+        # count the votes for each test input as the predictions of each model arrive
+        prediction_counters = [defaultdict(int) for _ in test_lemmas]
+        string_to_sequence = [{} for _ in test_lemmas]
+
+        # when decoding with a beam, the ranked predictions of all the models, with the best score any of them gives
+        string_to_ranked = [{} for _ in test_lemmas]
+        arrived = {}
+        next_member = 0
+        for member_index, member_predictions, member_nbest in pool.imap_unordered(predict_with_ensemble_member,
+                                                                                  params):
+            arrived[member_index] = (member_predictions, member_nbest)
+
+            # votes are counted in ensemble order, so ties are broken the same no matter which model finishes first
+            while next_member in arrived:
+                member_predictions, member_nbest = arrived.pop(next_member)
+                for i, predicted_sequence in enumerate(member_predictions):
+                    prediction_str = predicted_sequence.replace(STEP, '')
+                    prediction_counters[i][prediction_str] += 1
+                    string_to_sequence[i][prediction_str] = predicted_sequence
+                    if print_results:
+                        print 'template: {} prediction: {}'.format(predicted_sequence.encode('utf8'),
+                                                                   prediction_str.encode('utf8'))
+                    if member_nbest is not None:
+                        for sequence, log_prob in member_nbest[i]:
+                            inflection = sequence.replace(STEP, '')
+                            if inflection not in string_to_ranked[i] or log_prob > string_to_ranked[i][inflection][1]:
+                                string_to_ranked[i][inflection] = (sequence, log_prob)
+                next_member += 1
+            print 'finished to predict with ensemble: {}/{}'.format(len(arrived) + next_member,
+                                                                     len(ensemble_model_names))
+        pool.close()
+        pool.join()
+
+        # perform voting for each test input
+        predicted_sequences = [None] * len(test_lemmas)
+        for i in xrange(len(test_lemmas)):
+            prediction_counter = prediction_counters[i]
 
             # return the most predicted output
             predicted_sequence_string = max(prediction_counter, key=prediction_counter.get)
@@ -819,11 +1519,20 @@ def evaluate_ndst(alphabet, alphabet_index, ensemble, feat_index, feat_input_dim
                 print 'chosen:{} with {} votes\n'.format(predicted_sequence_string.encode('utf8'),
                                                          prediction_counter[predicted_sequence_string])
 
-            predicted_sequences[joint_index] = string_to_sequence[predicted_sequence_string]
+            predicted_sequences[i] = string_to_sequence[i][predicted_sequence_string]
 
             # progress indication
             sys.stdout.write("\r%d%%" % (float(i) / len(test_lemmas) * 100))
             sys.stdout.flush()
+
+        # the ranked predictions start with the voted one, followed by the others by the best score any model gave them
+        if beam_width > 1:
+            nbest_sequences = []
+            for i, predicted_sequence in enumerate(predicted_sequences):
+                voted = predicted_sequence.replace(STEP, '')
+                others = sorted([ranked for inflection, ranked in string_to_ranked[i].iteritems()
+                                 if inflection != voted], key=lambda ranked: -ranked[1])
+                nbest_sequences.append([string_to_ranked[i][voted]] + others[:nbest - 1])
     else:
         # load best model - no ensemble
         best_model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn = load_best_model(alphabet,
@@ -831,16 +1540,28 @@ def evaluate_ndst(alphabet, alphabet_index, ensemble, feat_index, feat_input_dim
                                                                               hidden_dim, layers,
                                                                               feature_alphabet, feat_input_dim,
                                                                               feature_types)
+        encoder_cache = EncoderCache()
         try:
-            predicted_sequences = predict_sequences(best_model,
-                                                    char_lookup, feat_lookup, R, bias, encoder_frnn,
-                                                    encoder_rrnn, decoder_rnn,
-                                                    alphabet_index,
-                                                    inverse_alphabet_index,
-                                                    test_lemmas,
-                                                    test_feat_dicts,
-                                                    feat_index,
-                                                    feature_types)
+            if beam_width > 1:
+                nbest_sequences = predict_nbest_sequences(best_model, char_lookup, feat_lookup, R, bias, encoder_frnn,
+                                                          encoder_rrnn, decoder_rnn, alphabet_index,
+                                                          inverse_alphabet_index, test_lemmas, test_feat_dicts,
+                                                          feat_index, feature_types, beam_width, nbest, encoder_cache)
+
+                # the best hypothesis in each beam is the prediction
+                predicted_sequences = [ranked[0][0] for ranked in nbest_sequences]
+            else:
+                predicted_sequences = predict_sequences(best_model,
+                                                        char_lookup, feat_lookup, R, bias, encoder_frnn,
+                                                        encoder_rrnn, decoder_rnn,
+                                                        alphabet_index,
+                                                        inverse_alphabet_index,
+                                                        test_lemmas,
+                                                        test_feat_dicts,
+                                                        feat_index,
+                                                        feature_types,
+                                                        encoder_cache)
+            print encoder_cache.report()
         except Exception as e:
             print e
             traceback.print_exc()
@@ -861,8 +1582,7 @@ def evaluate_ndst(alphabet, alphabet_index, ensemble, feat_index, feat_input_dim
     # get predicted_sequences in the same order they appeared in the original file
     # iterate through them and foreach concat morph, lemma, features in order to print later in the task format
     for i, lemma in enumerate(test_lemmas):
-        joint_index = test_lemmas[i] + ':' + common.get_morph_string(test_feat_dicts[i], feature_types)
-        inflection = ''.join(predicted_sequences[joint_index]).replace(STEP, '')
+        inflection = ''.join(predicted_sequences[i]).replace(STEP, '')
         final_results[i] = (test_lemmas[i], test_feat_dicts[i], inflection)
 
     accuracy_vals = [accuracies[i][1] for i in xrange(len(accuracies))]
@@ -879,9 +1599,24 @@ def evaluate_ndst(alphabet, alphabet_index, ensemble, feat_index, feat_input_dim
     else:
         suffix = '.best'
 
-    common.write_results_file_and_evaluate_externally(hyper_params, micro_average_accuracy, train_path,
-                                                      test_path, results_file_path + suffix, sigmorphon_root_dir,
-                                                      final_results)
+    common.write_results_file_and_evaluate(hyper_params, micro_average_accuracy, train_path, test_path,
+                                           results_file_path + suffix, final_results)
+
+    # write the ranked predictions as well, so the mean reciprocal rank can be computed over them
+    if nbest_sequences is not None:
+        nbest_results = {}
+        for i, lemma in enumerate(test_lemmas):
+            inflections = []
+            for sequence, log_prob in nbest_sequences[i]:
+                inflection = sequence.replace(STEP, '')
+
+                # different templates may result in the same inflection
+                if inflection not in inflections:
+                    inflections.append(inflection)
+            nbest_results[i] = (test_lemmas[i], test_feat_dicts[i], inflections)
+
+        common.write_results_file_and_evaluate(hyper_params, micro_average_accuracy, train_path, test_path,
+                                               results_file_path + suffix, nbest_results, nbest=True)
 
 
 if __name__ == '__main__':
@@ -955,13 +1690,76 @@ if __name__ == '__main__':
         ensemble_param = arguments['--ensemble']
     else:
         ensemble_param = False
+    if arguments['--batch-size']:
+        batch_size_param = int(arguments['--batch-size'])
+    else:
+        batch_size_param = BATCH_SIZE
+    if arguments['--beam']:
+        beam_width_param = int(arguments['--beam'])
+    else:
+        beam_width_param = BEAM_WIDTH
+    if arguments['--nbest']:
+        nbest_param = int(arguments['--nbest'])
+    else:
+        nbest_param = beam_width_param
+    if arguments['--align-cache']:
+        align_cache_dir_param = arguments['--align-cache']
+    else:
+        align_cache_dir_param = None
+    if arguments['--align-shard']:
+        align_shard_size_param = int(arguments['--align-shard'])
+    else:
+        align_shard_size_param = None
+    if arguments['--incremental-align']:
+        incremental_align_param = True
+    else:
+        incremental_align_param = False
+    if arguments['--min-char-count']:
+        min_char_count_param = int(arguments['--min-char-count'])
+    else:
+        min_char_count_param = MIN_CHAR_COUNT
+    if arguments['--min-feat-count']:
+        min_feat_count_param = int(arguments['--min-feat-count'])
+    else:
+        min_feat_count_param = MIN_FEAT_COUNT
+    if arguments['--eval-every']:
+        eval_every_param = int(arguments['--eval-every'])
+    else:
+        eval_every_param = EVAL_EVERY
+    if arguments['--eval-dev-size']:
+        eval_dev_size_param = int(arguments['--eval-dev-size'])
+    else:
+        eval_dev_size_param = EVAL_DEV_SIZE
+    if arguments['--async-eval']:
+        async_eval_param = True
+    else:
+        async_eval_param = False
+    if arguments['--checkpoint-every']:
+        checkpoint_every_param = int(arguments['--checkpoint-every'])
+    else:
+        checkpoint_every_param = CHECKPOINT_EVERY
+    if arguments['--resume']:
+        resume_param = True
+    else:
+        resume_param = False
+    if arguments['--bucket-batches']:
+        bucket_batches_param = int(arguments['--bucket-batches'])
+    else:
+        bucket_batches_param = BUCKET_BATCHES
+    if arguments['--curriculum']:
+        curriculum_epochs_param = int(arguments['--curriculum'])
+    else:
+        curriculum_epochs_param = CURRICULUM_EPOCHS
 
     print arguments
 
     main(train_path_param, dev_path_param, test_path_param, results_file_path_param, sigmorphon_root_dir_param,
          input_dim_param,
          hidden_dim_param, feat_input_dim_param, epochs_param, layers_param, optimization_param, regularization_param,
-         learning_rate_param, plot_param, eval_param, ensemble_param)
+         learning_rate_param, plot_param, eval_param, ensemble_param, batch_size_param, beam_width_param, nbest_param,
+         align_cache_dir_param, align_shard_size_param, incremental_align_param, min_char_count_param,
+         min_feat_count_param, eval_every_param, eval_dev_size_param, async_eval_param, checkpoint_every_param,
+         resume_param, bucket_batches_param, curriculum_epochs_param)
 
 
 def encode_feats_and_chars(alphabet_index, char_lookup, encoder_frnn, encoder_rrnn, feat_index, feat_lookup, feats,
@@ -0,0 +1,311 @@
+"""Serves the predictions of a trained hard attention model over HTTP. The model is loaded once, and requests that
+arrive within a short time window are decoded together in one batch.
+
+Usage:
+  hard_attention_server.py [--dynet-mem MEM] [--input=INPUT] [--hidden=HIDDEN] [--feat-input=FEAT] [--layers=LAYERS]
+  [--host=HOST] [--port=PORT] [--window=WINDOW] [--max-batch=MAX] [--beam=BEAM] [--max-nbest=MAX_NBEST]
+  [--cache=CACHE] RESULTS_PATH [TRAIN_PATH]
+
+Arguments:
+  RESULTS_PATH  results file path the model was trained with, the model is loaded from RESULTS_PATH_bestmodel.bundle
+  TRAIN_PATH    train set path the model was trained on, only needed for models saved before bundles, as
+                RESULTS_PATH_bestmodel.txt. the alphabets are then taken from RESULTS_PATH_vocab.json or built from
+                the train set, and the dimensions are taken from the options
+
+Options:
+  -h --help                     show this help message and exit
+  --dynet-mem MEM               allocates MEM bytes for (py)cnn
+  --input=INPUT                 input vector dimensions
+  --hidden=HIDDEN               hidden layer dimensions
+  --feat-input=FEAT             feature input vector dimension
+  --layers=LAYERS               amount of layers in lstm network
+  --host=HOST                   host to listen on [default: localhost]
+  --port=PORT                   port to listen on [default: 8000]
+  --window=WINDOW               milliseconds to wait for more requests before decoding a batch [default: 5]
+  --max-batch=MAX               maximal amount of requests decoded in one batch [default: 100]
+  --beam=BEAM                   beam width for requests of more than one prediction [default: 5]
+  --max-nbest=MAX_NBEST         maximal amount of predictions a request may ask for, as it widens the beam of its
+                                batch [default: 20]
+  --cache=CACHE                 amount of lemmas to keep in the encoder cache [default: 10000]
+
+Requests:
+  GET /inflect?lemma=LEMMA&feats=FEATS[&nbest=NBEST]
+  POST /inflect with a JSON object {"lemma": LEMMA, "feats": FEATS, "nbest": NBEST}, or a list of such objects
+  GET /stats
+
+FEATS is a feature string as in the sigmorphon files, e.g. pos=V,tense=PST. Each response holds the inflection, the
+ranked inflections and their log probabilities when NBEST > 1, the amount of requests in its batch and the latency in
+milliseconds - time waited for the batch to start, time the batch took to decode, and the total time in the server.
+Requests with NBEST above MAX_NBEST are answered with 400, and an error while decoding fails only the requests decoded
+with the failing one.
+"""
+
+import os
+import json
+import time
+import threading
+import traceback
+import urlparse
+import Queue
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from docopt import docopt
+import prepare_sigmorphon_data
+import hard_attention
+
+
+class Batcher(threading.Thread):
+
+    def __init__(self, model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn,
+                 alphabet_index, inverse_alphabet_index, feat_index, feature_types, window, max_batch, beam_width,
+                 max_nbest, cache_size):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.model_params = (model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn)
+        self.alphabet_index = alphabet_index
+        self.inverse_alphabet_index = inverse_alphabet_index
+        self.feat_index = feat_index
+        self.feature_types = feature_types
+        self.window = window
+        self.max_batch = max_batch
+        self.beam_width = beam_width
+        self.max_nbest = max_nbest
+        self.encoder_cache = hard_attention.EncoderCache(cache_size)
+        self.requests = Queue.Queue()
+        self.served = 0
+        self.batches = 0
+
+    def submit(self, lemma, feat_dict, nbest):
+        # returns immediately, the request's done event is set once it is decoded
+        request = {'lemma': lemma, 'feats': feat_dict, 'nbest': nbest, 'arrival': time.time(),
+                   'done': threading.Event()}
+        self.requests.put(request)
+        return request
+
+    def run(self):
+        # dynet is only used from this thread
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.time() + self.window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except Queue.Empty:
+                    break
+
+            start = time.time()
+            self.decode(batch)
+            end = time.time()
+
+            self.served += len(batch)
+            self.batches += 1
+            for request in batch:
+                request['start'] = start
+                request['end'] = end
+                request['batch_size'] = len(batch)
+                request['done'].set()
+
+    def decode(self, batch):
+        # requests for a single prediction are decoded greedily, the rest with a beam, grouped by amount of predictions.
+        # a group that fails only fails its own requests
+        groups = [[request for request in batch if request['nbest'] <= 1]]
+        for nbest in sorted(set([request['nbest'] for request in batch if request['nbest'] > 1])):
+            groups.append([request for request in batch if request['nbest'] == nbest])
+
+        for group in groups:
+            if len(group) == 0:
+                continue
+            try:
+                if group[0]['nbest'] <= 1:
+                    self.decode_greedy(group)
+                else:
+                    self.decode_nbest(group, group[0]['nbest'])
+            except Exception as e:
+                traceback.print_exc()
+                for request in group:
+                    request['error'] = str(e)
+
+    def decode_greedy(self, group):
+        sequences = hard_attention.predict_output_sequences(*self.model_params + self.encode(group) + (
+            self.alphabet_index, self.inverse_alphabet_index, self.encoder_cache))
+        for request, sequence in zip(group, sequences):
+            request['inflection'] = sequence.replace(hard_attention.STEP, '')
+
+    def decode_nbest(self, group, nbest):
+        nbest_sequences = hard_attention.predict_nbest_output_sequences(*self.model_params + self.encode(group) + (
+            self.alphabet_index, self.inverse_alphabet_index, max(self.beam_width, nbest), nbest, self.encoder_cache))
+        for request, ranked in zip(group, nbest_sequences):
+            # different templates may result in the same inflection, the best scoring one is kept
+            inflections = []
+            for sequence, log_prob in ranked:
+                inflection = sequence.replace(hard_attention.STEP, '')
+                if inflection not in [i for i, p in inflections]:
+                    inflections.append((inflection, log_prob))
+            request['inflection'] = inflections[0][0]
+            request['nbest_inflections'] = inflections
+
+    def encode(self, requests):
+        # the lemma and feature indices of the requests
+        return hard_attention.encode_inputs([request['lemma'] for request in requests],
+                                            [request['feats'] for request in requests], self.alphabet_index,
+                                            self.feat_index, self.feature_types)
+
+    def stats(self):
+        return {'requests': self.served, 'batches': self.batches,
+                'avg_batch_size': float(self.served) / self.batches if self.batches > 0 else 0.0,
+                'cache_hits': self.encoder_cache.hits, 'cache_misses': self.encoder_cache.misses,
+                'cache_hit_rate': self.encoder_cache.hit_rate(), 'cached_lemmas': len(self.encoder_cache.entries)}
+
+
+class InflectionHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == '/stats':
+            self.respond(200, self.server.batcher.stats())
+        elif url.path == '/inflect':
+            query = urlparse.parse_qs(url.query)
+            try:
+                request = {'lemma': query['lemma'][0].decode('utf8'), 'feats': query['feats'][0].decode('utf8'),
+                           'nbest': query.get('nbest', ['1'])[0]}
+            except KeyError:
+                self.respond(400, {'error': 'lemma and feats are required'})
+                return
+            except UnicodeDecodeError:
+                self.respond(400, {'error': 'lemma and feats must be utf8'})
+                return
+            self.inflect([request], single=True)
+        else:
+            self.respond(404, {'error': 'unknown path ' + url.path})
+
+    def do_POST(self):
+        if urlparse.urlparse(self.path).path != '/inflect':
+            self.respond(404, {'error': 'unknown path ' + self.path})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.getheader('content-length', 0))))
+        except ValueError as e:
+            self.respond(400, {'error': 'bad json: ' + str(e)})
+            return
+        if isinstance(body, list):
+            self.inflect(body, single=False)
+        else:
+            self.inflect([body], single=True)
+
+    def inflect(self, requests, single):
+        try:
+            # a request the batcher cannot encode would fail the whole batch it shares with other requests
+            if len([request for request in requests if not isinstance(request['lemma'], basestring) or
+                    not isinstance(request['feats'], basestring)]) > 0:
+                self.respond(400, {'error': 'lemma and feats must be strings'})
+                return
+            parsed = [(request['lemma'], prepare_sigmorphon_data.make_feat_dict(request['feats']),
+                       int(request.get('nbest', 1))) for request in requests]
+        except (KeyError, TypeError, ValueError, AttributeError) as e:
+            self.respond(400, {'error': 'bad request: ' + repr(e)})
+            return
+        max_nbest = self.server.batcher.max_nbest
+        if len([nbest for lemma, feat_dict, nbest in parsed if nbest > max_nbest]) > 0:
+            self.respond(400, {'error': 'nbest may be at most {}'.format(max_nbest)})
+            return
+
+        # all requests are submitted before waiting for any, so they can share a batch
+        submitted = [self.server.batcher.submit(lemma, feat_dict, nbest) for lemma, feat_dict, nbest in parsed]
+
+        responses = []
+        for request, result in zip(requests, submitted):
+            result['done'].wait()
+            response = {'lemma': request['lemma'], 'feats': request['feats'], 'batch_size': result['batch_size'],
+                        'latency_ms': {'queue': 1000 * (result['start'] - result['arrival']),
+                                       'decode': 1000 * (result['end'] - result['start']),
+                                       'total': 1000 * (time.time() - result['arrival'])}}
+            if 'error' in result:
+                response['error'] = result['error']
+            else:
+                response['inflection'] = result['inflection']
+                if 'nbest_inflections' in result:
+                    response['nbest'] = result['nbest_inflections']
+            responses.append(response)
+
+        if single:
+            self.respond(200, responses[0])
+        else:
+            self.respond(200, responses)
+
+    def respond(self, code, content):
+        body = json.dumps(content, ensure_ascii=False).encode('utf8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # a line per request is too much at high request rates
+        pass
+
+
+class InflectionServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, batcher):
+        HTTPServer.__init__(self, address, InflectionHandler)
+        self.batcher = batcher
+
+
+def main(results_file_path, train_path, input_dim, hidden_dim, feat_input_dim, layers, host, port, window, max_batch,
+         beam_width, max_nbest, cache_size):
+    start = time.time()
+    if os.path.isfile(results_file_path + '_bestmodel.bundle'):
+        model_params, alphabet, alphabet_index, inverse_alphabet_index, feature_alphabet, feat_index, feature_types, \
+            hyper_params = hard_attention.load_model_bundle(results_file_path)
+        model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn = model_params
+    elif train_path:
+        (train_words, train_lemmas, train_feat_dicts) = prepare_sigmorphon_data.load_data(train_path)
+        vocabulary = prepare_sigmorphon_data.find_vocabulary([results_file_path])
+        alphabet, alphabet_index, inverse_alphabet_index, feature_alphabet, feat_index, feature_types = \
+            hard_attention.build_alphabets(train_words, train_lemmas, train_feat_dicts, vocabulary=vocabulary)
+        model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn = \
+            hard_attention.load_best_model(alphabet, results_file_path, input_dim, hidden_dim, layers,
+                                           feature_alphabet, feat_input_dim, feature_types)
+    else:
+        print 'no model bundle found for {}, the train set path is needed to load the model'.format(results_file_path)
+        return
+    print 'loaded model in {:.2f} seconds'.format(time.time() - start)
+
+    batcher = Batcher(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn,
+                      alphabet_index, inverse_alphabet_index, feat_index, feature_types, window, max_batch,
+                      beam_width, max_nbest, cache_size)
+    batcher.start()
+
+    server = InflectionServer((host, port), batcher)
+    print 'serving on http://{}:{}/inflect'.format(host, port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    if arguments['--input']:
+        input_dim_param = int(arguments['--input'])
+    else:
+        input_dim_param = hard_attention.INPUT_DIM
+    if arguments['--hidden']:
+        hidden_dim_param = int(arguments['--hidden'])
+    else:
+        hidden_dim_param = hard_attention.HIDDEN_DIM
+    if arguments['--feat-input']:
+        feat_input_dim_param = int(arguments['--feat-input'])
+    else:
+        feat_input_dim_param = hard_attention.FEAT_INPUT_DIM
+    if arguments['--layers']:
+        layers_param = int(arguments['--layers'])
+    else:
+        layers_param = hard_attention.LAYERS
+
+    main(arguments['RESULTS_PATH'], arguments['TRAIN_PATH'], input_dim_param, hidden_dim_param, feat_input_dim_param,
+         layers_param, arguments['--host'], int(arguments['--port']), float(arguments['--window']) / 1000,
+         int(arguments['--max-batch']), int(arguments['--beam']), int(arguments['--max-nbest']),
+         int(arguments['--cache']))
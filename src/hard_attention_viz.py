@@ -319,32 +319,11 @@ def init_model(dev_path, feat_input_dim, hidden_dim, input_dim, layers, results_
     (train_words, train_lemmas, train_feat_dicts) = prepare_sigmorphon_data.load_data(train_path)
     (dev_words, dev_lemmas, dev_feat_dicts) = prepare_sigmorphon_data.load_data(dev_path)
     (test_words, test_lemmas, test_feat_dicts) = prepare_sigmorphon_data.load_data(test_path)
-    alphabet, feature_types = prepare_sigmorphon_data.get_alphabet(train_words, train_lemmas, train_feat_dicts)
 
-    # used for character dropout
-    alphabet.append(NULL)
-    alphabet.append(UNK)
-
-    # used during decoding
-    alphabet.append(EPSILON)
-    alphabet.append(BEGIN_WORD)
-    alphabet.append(END_WORD)
-
-    # add indices to alphabet - used to indicate when copying from lemma to word
-    for marker in [str(i) for i in xrange(3 * MAX_PREDICTION_LEN)]:
-        alphabet.append(marker)
-
-    # indicates the FST to step forward in the input
-    alphabet.append(STEP)
-
-    # char 2 int
-    alphabet_index = dict(zip(alphabet, range(0, len(alphabet))))
-    inverse_alphabet_index = {index: char for char, index in alphabet_index.items()}
-
-    # feat 2 int
-    feature_alphabet = common.get_feature_alphabet(train_feat_dicts)
-    feature_alphabet.append(UNK_FEAT)
-    feat_index = dict(zip(feature_alphabet, range(0, len(feature_alphabet))))
+    # the alphabets of the model's saved vocabulary, as the trainer built them
+    vocabulary = prepare_sigmorphon_data.find_vocabulary([results_file_path])
+    alphabet, alphabet_index, inverse_alphabet_index, feature_alphabet, feat_index, feature_types = \
+        hard_attention.build_alphabets(train_words, train_lemmas, train_feat_dicts, vocabulary=vocabulary)
 
     model_file_name = results_file_path + '_bestmodel.txt'
 
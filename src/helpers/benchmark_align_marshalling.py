@@ -0,0 +1,140 @@
+"""Compares the time align.Aligner spends converting word pairs to and from libalign - one ctypes array per pair in
+and one ctypes read per symbol out, against the contiguous int32 buffers it now uses - without the time of the
+alignment itself. run from the src directory with PYTHONPATH=.
+
+Usage:
+  benchmark_align_marshalling.py [--repeats=REPEATS] DATA_PATH...
+
+Arguments:
+  DATA_PATH     sigmorphon format files, the lemma and inflection pairs of all of them are converted together
+
+Options:
+  -h --help                     show this help message and exit
+  --repeats=REPEATS             amount of times to run each conversion, the fastest run is reported [default: 3]
+"""
+
+import os
+import sys
+import time
+import itertools
+from ctypes import c_int, c_void_p, POINTER
+from docopt import docopt
+import numpy as np
+import prepare_sigmorphon_data
+import align
+
+libalign_add_int_pair = align.libalign.ctx_add_int_pair
+libalign_add_int_pair.argtypes = [c_void_p, POINTER(c_int), POINTER(c_int)]
+libalign_getpairs_in = align.libalign.getpairs_in
+libalign_getpairs_in.restype = POINTER(c_int)
+libalign_getpairs_out = align.libalign.getpairs_out
+libalign_getpairs_out.restype = POINTER(c_int)
+libalign_getpairs_advance = align.libalign.getpairs_advance
+libalign_getpairs_advance.restype = c_void_p
+libalign_getpairs_init = align.libalign.ctx_getpairs_init
+libalign_getpairs_init.argtypes = [c_void_p]
+libalign_getpairs_init.restype = c_void_p
+
+
+def per_pair_in(context, wordpairs, align_symbol):
+    s = set(u''.join((x[0] + x[1] for x in wordpairs)))
+    symboltoint = dict(zip(s, xrange(1, len(s) + 1)))
+    inttosymbol = {v: k for k, v in symboltoint.items()}
+    inttosymbol[0] = align_symbol
+    for i, o in wordpairs:
+        intin = map(lambda x: symboltoint[x], i) + [-1]
+        intout = map(lambda x: symboltoint[x], o) + [-1]
+        libalign_add_int_pair(context, (c_int * len(intin))(*intin), (c_int * len(intout))(*intout))
+    return inttosymbol
+
+
+def per_pair_out(context, inttosymbol):
+    alignedpairs = []
+    stringpairptr = libalign_getpairs_init(context)
+    while stringpairptr != None:
+        inints = libalign_getpairs_in(c_void_p(stringpairptr))
+        outints = libalign_getpairs_out(c_void_p(stringpairptr))
+        instr = []
+        outstr = []
+        for j in itertools.count():
+            if inints[j] == -1:
+                break
+            instr.append(inttosymbol[inints[j]])
+        for j in itertools.count():
+            if outints[j] == -1:
+                break
+            outstr.append(inttosymbol[outints[j]])
+        alignedpairs.append((''.join(instr), ''.join(outstr)))
+        stringpairptr = libalign_getpairs_advance(c_void_p(stringpairptr))
+    return alignedpairs
+
+
+def bulk_in(context, wordpairs, align_symbol):
+    in_codes, in_offsets = align.encode_strings([x[0] for x in wordpairs])
+    out_codes, out_offsets = align.encode_strings([x[1] for x in wordpairs])
+    codes = np.union1d(in_codes, out_codes)
+    in_symbols = (np.searchsorted(codes, in_codes) + 1).astype(np.int32)
+    out_symbols = (np.searchsorted(codes, out_codes) + 1).astype(np.int32)
+    align.libalign_add_int_pairs(context, len(wordpairs), align.int_pointer(in_symbols), align.int_pointer(in_offsets),
+                                 align.int_pointer(out_symbols), align.int_pointer(out_offsets))
+    return np.concatenate([[ord(align_symbol)], codes]).astype(np.int32)
+
+
+def bulk_out(context, code_table, pair_count):
+    length = align.libalign_aligned_length(context)
+    aligned_in = np.zeros(length, dtype=np.int32)
+    aligned_out = np.zeros(length, dtype=np.int32)
+    offsets = np.zeros(pair_count + 1, dtype=np.int32)
+    align.libalign_get_aligned(context, align.int_pointer(aligned_in), align.int_pointer(aligned_out),
+                               align.int_pointer(offsets))
+    return zip(align.decode_strings(code_table[aligned_in], offsets),
+               align.decode_strings(code_table[aligned_out], offsets))
+
+
+def measure(convert_in, convert_out, wordpairs, align_symbol):
+    # the initial alignment is enough to have aligned pairs to convert back, and is not timed
+    context = align.libalign_context_new()
+    try:
+        start = time.time()
+        table = convert_in(context, wordpairs, align_symbol)
+        in_seconds = time.time() - start
+        align.libalign_clear_counts(context)
+        align.libalign_initial_align(context)
+        start = time.time()
+        if convert_out == bulk_out:
+            alignedpairs = convert_out(context, table, len(wordpairs))
+        else:
+            alignedpairs = convert_out(context, table)
+        out_seconds = time.time() - start
+    finally:
+        align.libalign_context_free(context)
+    return in_seconds, out_seconds, alignedpairs
+
+
+def main(data_paths, repeats):
+    wordpairs = []
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        for data_path in data_paths:
+            (words, lemmas, feat_dicts) = prepare_sigmorphon_data.load_data(data_path)[:3]
+            wordpairs += zip(lemmas, words)
+    finally:
+        sys.stdout = stdout
+    print 'pairs: {}'.format(len(wordpairs))
+
+    results = {}
+    for name, convert_in, convert_out in [('per pair', per_pair_in, per_pair_out), ('bulk', bulk_in, bulk_out)]:
+        runs = [measure(convert_in, convert_out, wordpairs, u'~') for i in xrange(repeats)]
+        in_seconds = min([run[0] for run in runs])
+        out_seconds = min([run[1] for run in runs])
+        results[name] = runs[0][2]
+        print '{:10} in: {:7.1f} ms/10k pairs out: {:7.1f} ms/10k pairs total: {:7.1f} ms/10k pairs'.format(
+            name, 1e4 * 1000 * in_seconds / len(wordpairs), 1e4 * 1000 * out_seconds / len(wordpairs),
+            1e4 * 1000 * (in_seconds + out_seconds) / len(wordpairs))
+    print 'same pairs: {}'.format(results['per pair'] == results['bulk'])
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    main(arguments['DATA_PATH'], int(arguments['--repeats']))
@@ -0,0 +1,97 @@
+# benchmarks beam_search.Beam against the probability-space beam search of old_unused/task1_ms2s on random decoder
+# outputs, reporting the amount of candidates expanded per second. run from the src directory:
+# PYTHONPATH=. python helpers/benchmark_beam_search.py
+
+import time
+import numpy as np
+import common
+import beam_search
+
+VOCAB_SIZE = 200
+BEAM_WIDTH = 5
+NBEST = 5
+STEPS = 50
+WORDS = 200
+END_INDEX = 0
+
+
+def random_distributions(steps, beam_width, vocab_size):
+    # one softmax distribution per (step, hypothesis), the end symbol is made unlikely so all steps are decoded
+    logits = np.random.randn(steps, beam_width, vocab_size) * 3
+    logits[:, :, END_INDEX] -= 20
+    probs = np.exp(logits)
+    return probs / probs.sum(axis=2, keepdims=True)
+
+
+def old_beam_search(distributions, beam_width, nbest):
+    # the search loop of task1_ms2s.predict_nbest_template, with the decoder replaced by precomputed distributions.
+    # it keeps every end symbol expansion as complete, also ones outside the beam, so its n-best may differ
+    i = 0
+    beam = {-1: [([-1], 1.0)]}
+    final_states = []
+    expanded = 0
+    while i < len(distributions) and len(beam[i - 1]) > 0:
+        new_hypos = []
+        for h, hypothesis in enumerate(beam[i - 1]):
+            seq, hyp_prob = hypothesis
+            probs = list(distributions[i][h])
+            expanded += len(probs)
+            for index, p in enumerate(probs):
+                new_seq = list(seq)
+                new_seq.append(index)
+                new_prob = hyp_prob * p
+                if new_seq[-1] == END_INDEX:
+                    final_states.append((new_seq[1:-1], new_prob))
+                else:
+                    new_hypos.append((new_seq, new_prob))
+        new_probs = [p for (s, p) in new_hypos]
+        argmax_indices = common.argmax(new_probs, n=beam_width)
+        beam[i] = [new_hypos[l] for l in argmax_indices]
+        i += 1
+
+    # also rank the unfinished hypotheses, as Beam.nbest does
+    final_states += [(seq[1:], p) for seq, p in beam[i - 1]]
+    final_probs = [p for (s, p) in final_states]
+    argmax_indices = common.argmax(final_probs, n=nbest)
+    return [final_states[l] for l in argmax_indices], expanded
+
+
+def new_beam_search(log_distributions, beam_width, nbest):
+    beam = beam_search.Beam(beam_width, nbest, END_INDEX)
+    expanded = 0
+    step = 0
+    while step < len(log_distributions) and not beam.done():
+        log_probs = log_distributions[step][:beam.size()].T
+        expanded += log_probs.size
+        beam.advance(log_probs)
+        step += 1
+    return beam.nbest(), expanded
+
+
+def main():
+    np.random.seed(17)
+    words = [random_distributions(STEPS, BEAM_WIDTH, VOCAB_SIZE) for _ in xrange(WORDS)]
+    log_words = [np.log(w) for w in words]
+
+    start = time.time()
+    old_expanded = 0
+    for distributions in words:
+        nbest, expanded = old_beam_search(distributions, BEAM_WIDTH, NBEST)
+        old_expanded += expanded
+    old_time = time.time() - start
+
+    start = time.time()
+    new_expanded = 0
+    for log_distributions in log_words:
+        nbest, expanded = new_beam_search(log_distributions, BEAM_WIDTH, NBEST)
+        new_expanded += expanded
+    new_time = time.time() - start
+
+    print 'vocabulary: {} beam width: {} steps: {} words: {}'.format(VOCAB_SIZE, BEAM_WIDTH, STEPS, WORDS)
+    print 'old (probability space): {:.0f} candidates/sec'.format(old_expanded / old_time)
+    print 'new (log space):         {:.0f} candidates/sec'.format(new_expanded / new_time)
+    print 'speedup: {:.1f}x'.format((new_expanded / new_time) / (old_expanded / old_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""Compares the parse throughput and peak memory of prepare_sigmorphon_data.load_data, iter_examples,
+load_columnar_data and load_cached_data, loading all the files of a data directory and keeping them in memory. Each
+loader runs in its own process, so the peak memory of one does not hide the others. The binary caches are written
+before the measurements if they are missing, so load_cached_data is measured on warm caches, including to_lists.
+run from the src directory with PYTHONPATH=.
+
+Usage:
+  benchmark_load_data.py [DATA_PATH]
+
+Arguments:
+  DATA_PATH     directory of sigmorphon format files, ../data/sigmorphon_train_dev_merged if not given
+"""
+
+import os
+import sys
+import glob
+import time
+import resource
+from multiprocessing import Process, Queue
+from docopt import docopt
+import prepare_sigmorphon_data
+
+
+def file_task(filename):
+    for task in [2, 3]:
+        if 'task{}'.format(task) in filename:
+            return task
+    return 1
+
+
+def quietly(function, *args):
+    # the loaders print while loading, which is part of their cost but not worth seeing
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args)
+    finally:
+        sys.stdout = stdout
+
+
+def load_with_load_data(filename, task):
+    data = quietly(prepare_sigmorphon_data.load_data, filename, task)
+    return data, len(data[0])
+
+
+def load_with_iter_examples(filename, task):
+    # streaming - nothing is kept besides the count
+    count = 0
+    for example in prepare_sigmorphon_data.iter_examples(filename, task):
+        count += 1
+    return None, count
+
+
+def load_with_load_columnar_data(filename, task):
+    data = prepare_sigmorphon_data.load_columnar_data(filename, task)
+    return data, len(data)
+
+
+def load_with_load_cached_data(filename, task):
+    data = quietly(prepare_sigmorphon_data.load_cached_data, filename, task).to_lists()
+    return data, len(data[0])
+
+
+LOADERS = [('load_data', load_with_load_data), ('iter_examples', load_with_iter_examples),
+           ('load_columnar_data', load_with_load_columnar_data), ('load_cached_data', load_with_load_cached_data)]
+
+
+def measure(loader, filenames, results):
+    # ru_maxrss is in kilobytes on linux
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    loaded = []
+    examples = 0
+    for filename in filenames:
+        data, count = loader(filename, file_task(filename))
+        loaded.append(data)
+        examples += count
+    seconds = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss
+    results.put((seconds, examples, peak_rss))
+
+
+def main(data_path):
+    filenames = sorted([f for f in glob.glob(os.path.join(data_path, '*'))
+                        if os.path.isfile(f) and not f.endswith('.cache')])
+    total_bytes = sum([os.path.getsize(f) for f in filenames])
+    print 'files: {} size: {:.1f} MB'.format(len(filenames), total_bytes / 1e6)
+
+    for filename in filenames:
+        quietly(prepare_sigmorphon_data.load_cached_data, filename, file_task(filename))
+
+    for name, loader in LOADERS:
+        results = Queue()
+        process = Process(target=measure, args=(loader, filenames, results))
+        process.start()
+        seconds, examples, peak_rss = results.get()
+        process.join()
+        print '{:20} {:8d} examples {:6.2f} sec {:9.0f} examples/sec {:6.1f} MB/sec peak memory +{:.1f} MB'.format(
+            name, examples, seconds, examples / seconds, total_bytes / 1e6 / seconds, peak_rss / 1024.0)
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    if arguments['DATA_PATH']:
+        data_path_param = arguments['DATA_PATH']
+    else:
+        data_path_param = '../data/sigmorphon_train_dev_merged'
+    main(data_path_param)
@@ -0,0 +1,115 @@
+"""Compares the latency and accuracy of the soft attention ensemble decoding modes - majority vote between the
+predictions of the models, and averaging the models' output probabilities at each step - on the CELEX folds.
+run from the src directory with PYTHONPATH=.
+
+Usage:
+  benchmark_soft_attention_ensemble.py [--dynet-mem MEM] [--input=INPUT] [--hidden=HIDDEN] [--feat-input=FEAT]
+  [--layers=LAYERS] [--folds=FOLDS] CELEX_PATH MODEL_PATHS
+
+Arguments:
+  CELEX_PATH    directory of the CELEX folds
+  MODEL_PATHS   ensemble model paths separated by a comma, as given to soft_attention.py --ensemble, with {} in place
+                of the fold number
+
+Options:
+  -h --help                     show this help message and exit
+  --dynet-mem MEM               allocates MEM bytes for (py)cnn
+  --input=INPUT                 input vector dimensions
+  --hidden=HIDDEN               hidden layer dimensions
+  --feat-input=FEAT             feature input vector dimension
+  --layers=LAYERS               amount of layers in lstm network
+  --folds=FOLDS                 fold numbers separated by a comma [default: 0,1,2,3,4]
+"""
+
+import time
+from docopt import docopt
+import prepare_sigmorphon_data
+import common
+import soft_attention
+
+CELEX_FORMAT = '{}/13SIA-13SKE_2PIE-13PKE_2PKE-z_rP-pA_{}.{}.txt'
+
+
+def benchmark_fold(celex_path, fold, model_paths, input_dim, hidden_dim, feat_input_dim, layers):
+    train_path = CELEX_FORMAT.format(celex_path, fold, 'train')
+    test_path = CELEX_FORMAT.format(celex_path, fold, 'test')
+    (train_words, train_lemmas, train_feat_dicts) = prepare_sigmorphon_data.load_data(train_path)
+    (test_words, test_lemmas, test_feat_dicts) = prepare_sigmorphon_data.load_data(test_path)
+
+    # the same alphabets soft_attention.main builds for the models
+    alphabet, feature_types = prepare_sigmorphon_data.get_alphabet(train_words, train_lemmas, train_feat_dicts)
+    alphabet += [soft_attention.NULL, soft_attention.UNK, soft_attention.EPSILON, soft_attention.BEGIN_WORD,
+                 soft_attention.END_WORD]
+    alphabet += [str(i) for i in xrange(soft_attention.MAX_PREDICTION_LEN)]
+    alphabet_index = dict(zip(alphabet, range(0, len(alphabet))))
+    inverse_alphabet_index = {index: char for char, index in alphabet_index.items()}
+    feature_alphabet = common.get_feature_alphabet(train_feat_dicts)
+    feature_alphabet.append(soft_attention.UNK_FEAT)
+    feat_index = dict(zip(feature_alphabet, range(0, len(feature_alphabet))))
+
+    ensemble = model_paths.replace('{}', fold)
+    results = {}
+
+    start = time.time()
+    predictions = soft_attention.predict_with_ensemble_majority(alphabet, alphabet_index, ensemble, feat_index,
+                                                                feat_input_dim, feature_alphabet, feature_types,
+                                                                hidden_dim, input_dim, inverse_alphabet_index, layers,
+                                                                test_feat_dicts, test_lemmas, test_words)
+    majority_time = time.time() - start
+    amount, accuracy = soft_attention.evaluate_model(predictions, test_lemmas, test_feat_dicts, test_words,
+                                                     feature_types)
+    results['MAJORITY'] = (majority_time, len(test_lemmas), accuracy)
+
+    start = time.time()
+    predictions = soft_attention.predict_with_ensemble_average(alphabet, alphabet_index, ensemble, feat_index,
+                                                               feat_input_dim, feature_alphabet, feature_types,
+                                                               hidden_dim, input_dim, inverse_alphabet_index, layers,
+                                                               test_feat_dicts, test_lemmas)
+    average_time = time.time() - start
+    amount, accuracy = soft_attention.evaluate_model(predictions, test_lemmas, test_feat_dicts, test_words,
+                                                     feature_types)
+    results['AVERAGE'] = (average_time, len(test_lemmas), accuracy)
+
+    return results
+
+
+def main(celex_path, model_paths, folds, input_dim, hidden_dim, feat_input_dim, layers):
+    fold_results = []
+    for fold in folds:
+        fold_results.append(benchmark_fold(celex_path, fold, model_paths, input_dim, hidden_dim, feat_input_dim,
+                                           layers))
+
+    print 'ensemble size: {} folds: {}'.format(len(model_paths.split(',')), ','.join(folds))
+    for fold, results in zip(folds, fold_results):
+        for mode in ['MAJORITY', 'AVERAGE']:
+            seconds, words, accuracy = results[mode]
+            print 'fold {} {}: {:.2f} ms/word accuracy {:.4f}'.format(fold, mode, 1000 * seconds / words, accuracy)
+
+    for mode in ['MAJORITY', 'AVERAGE']:
+        seconds = sum([results[mode][0] for results in fold_results])
+        words = sum([results[mode][1] for results in fold_results])
+        accuracy = sum([results[mode][2] for results in fold_results]) / len(fold_results)
+        print 'all folds {}: {:.2f} ms/word accuracy {:.4f}'.format(mode, 1000 * seconds / words, accuracy)
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    if arguments['--input']:
+        input_dim_param = int(arguments['--input'])
+    else:
+        input_dim_param = soft_attention.INPUT_DIM
+    if arguments['--hidden']:
+        hidden_dim_param = int(arguments['--hidden'])
+    else:
+        hidden_dim_param = soft_attention.HIDDEN_DIM
+    if arguments['--feat-input']:
+        feat_input_dim_param = int(arguments['--feat-input'])
+    else:
+        feat_input_dim_param = soft_attention.FEAT_INPUT_DIM
+    if arguments['--layers']:
+        layers_param = int(arguments['--layers'])
+    else:
+        layers_param = soft_attention.LAYERS
+
+    main(arguments['CELEX_PATH'], arguments['MODEL_PATHS'], arguments['--folds'].split(','), input_dim_param,
+         hidden_dim_param, feat_input_dim_param, layers_param)
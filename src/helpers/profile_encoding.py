@@ -0,0 +1,134 @@
+"""Profiles how much of a hard attention training epoch went to turning the examples into indices, by running the same
+epoch twice on a new model - once encoding each example as it is used, as the loss functions did before the examples
+were encoded once as ints, and once on the examples hard_attention.encode_examples encoded ahead of the epoch. The dev
+set is decoded the same two ways. run from the src directory with PYTHONPATH=.
+
+Usage:
+  profile_encoding.py [--dynet-mem MEM] [--input=INPUT] [--hidden=HIDDEN] [--feat-input=FEAT] [--layers=LAYERS]
+  [--batch-size=BATCH] [--examples=EXAMPLES] TRAIN_PATH DEV_PATH
+
+Arguments:
+  TRAIN_PATH    train set path, its examples are aligned and trained on for one epoch
+  DEV_PATH      development set path, its examples are decoded greedily
+
+Options:
+  -h --help                     show this help message and exit
+  --dynet-mem MEM               allocates MEM bytes for (py)cnn
+  --input=INPUT                 input vector dimensions [default: 100]
+  --hidden=HIDDEN               hidden layer dimensions [default: 100]
+  --feat-input=FEAT             feature input vector dimension [default: 20]
+  --layers=LAYERS               amount of layers in lstm network [default: 2]
+  --batch-size=BATCH            amount of examples in each training minibatch, 1 updates after every example
+                                [default: 1]
+  --examples=EXAMPLES           amount of train examples to use, all of them if not given
+"""
+
+import os
+import sys
+import time
+import random
+from docopt import docopt
+import dynet as pc
+import prepare_sigmorphon_data
+import common
+import hard_attention
+
+
+def run_epoch(params, trainer, examples, encoded, batch_size, alphabet_index, feat_index, feature_types):
+    lemmas, feat_dicts, aligned_pairs = examples
+    random.seed(17)
+    encode_seconds = 0.0
+    total_loss = 0.0
+    indices = range(len(lemmas))
+    random.shuffle(indices)
+    start = time.time()
+    for k in xrange(0, len(indices), batch_size):
+        batch_indices = indices[k:k + batch_size]
+        if encoded is None:
+            # encode the examples as they are used
+            encode_start = time.time()
+            lemma_indices, feat_indices, oracles = hard_attention.encode_examples(
+                [lemmas[j] for j in batch_indices], [feat_dicts[j] for j in batch_indices],
+                [aligned_pairs[j] for j in batch_indices], alphabet_index, feat_index, feature_types)
+            encode_seconds += time.time() - encode_start
+        else:
+            lemma_indices, feat_indices, oracles = [[column[j] for j in batch_indices] for column in encoded]
+
+        if batch_size > 1:
+            loss = hard_attention.batch_loss(*params + (lemma_indices, feat_indices, oracles, alphabet_index))
+        else:
+            loss = hard_attention.one_word_loss(*params + (lemma_indices[0], feat_indices[0], oracles[0],
+                                                           alphabet_index))
+        total_loss += loss.value()
+        loss.backward()
+        trainer.update()
+    return time.time() - start, encode_seconds, total_loss
+
+
+def run_decode(params, examples, encoded_inputs, alphabet_index, inverse_alphabet_index, feat_index, feature_types):
+    lemmas, feat_dicts = examples
+    start = time.time()
+    predictions = hard_attention.predict_sequences(*params + (alphabet_index, inverse_alphabet_index, lemmas,
+                                                              feat_dicts, feat_index, feature_types, None,
+                                                              encoded_inputs))
+    return time.time() - start, predictions
+
+
+def main(train_path, dev_path, input_dim, hidden_dim, feat_input_dim, layers, batch_size, max_examples):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        (train_words, train_lemmas, train_feat_dicts) = prepare_sigmorphon_data.load_data(train_path)
+        (dev_words, dev_lemmas, dev_feat_dicts) = prepare_sigmorphon_data.load_data(dev_path)
+        alphabet, alphabet_index, inverse_alphabet_index, feature_alphabet, feat_index, feature_types = \
+            hard_attention.build_alphabets(train_words, train_lemmas, train_feat_dicts)
+        if max_examples:
+            train_words, train_lemmas, train_feat_dicts = [column[:max_examples] for column in
+                                                           [train_words, train_lemmas, train_feat_dicts]]
+        train_aligned_pairs = common.mcmc_align(zip(train_lemmas, train_words), hard_attention.ALIGN_SYMBOL)
+    finally:
+        sys.stdout = stdout
+    print 'train examples: {} dev examples: {} batch size: {}'.format(len(train_lemmas), len(dev_lemmas), batch_size)
+
+    start = time.time()
+    encoded = hard_attention.encode_examples(train_lemmas, train_feat_dicts, train_aligned_pairs, alphabet_index,
+                                             feat_index, feature_types)
+    train_encode_seconds = time.time() - start
+    start = time.time()
+    dev_encoded_inputs = hard_attention.encode_inputs(dev_lemmas, dev_feat_dicts, alphabet_index, feat_index,
+                                                      feature_types)
+    dev_encode_seconds = time.time() - start
+
+    removed_seconds = 0.0
+    for name, train_encoded, dev_inputs in [('per example', None, None), ('encoded once', encoded,
+                                                                              dev_encoded_inputs)]:
+        # each run trains a new model
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            params = hard_attention.build_model(alphabet, input_dim, hidden_dim, layers, feature_types,
+                                                feat_input_dim, feature_alphabet)
+        finally:
+            sys.stdout = stdout
+        trainer = pc.SimpleSGDTrainer(params[0])
+        epoch_seconds, encode_seconds, total_loss = run_epoch(params, trainer, (train_lemmas, train_feat_dicts,
+                                                                                train_aligned_pairs),
+                                                              train_encoded, batch_size, alphabet_index, feat_index,
+                                                              feature_types)
+        decode_seconds, predictions = run_decode(params, (dev_lemmas, dev_feat_dicts), dev_inputs, alphabet_index,
+                                                 inverse_alphabet_index, feat_index, feature_types)
+        removed_seconds += encode_seconds
+        print '{:12} epoch: {:7.2f} sec (encoding inside it: {:5.2f} sec, {:4.1f}%) dev decode: {:6.2f} sec ' \
+              'avg loss: {:.4f}'.format(name, epoch_seconds, encode_seconds, 100 * encode_seconds / epoch_seconds,
+                                        decode_seconds, total_loss / len(train_lemmas))
+
+    # the difference between the two epoch times is mostly noise between runs at this share, so the encoding time
+    # measured inside the epoch is reported instead
+    print 'encoding once ahead: train {:.2f} sec dev {:.2f} sec'.format(train_encode_seconds, dev_encode_seconds)
+    print 'encoding time removed from each epoch: {:.2f} sec'.format(removed_seconds)
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    main(arguments['TRAIN_PATH'], arguments['DEV_PATH'], int(arguments['--input']), int(arguments['--hidden']),
+         int(arguments['--feat-input']), int(arguments['--layers']), int(arguments['--batch-size']),
+         int(arguments['--examples']) if arguments['--examples'] else None)
@@ -0,0 +1,141 @@
+# A model bundle is a single file holding all that is needed to rebuild a trained model without its train set - a JSON
+# header with the hyperparameters, the alphabets and the shapes of the parameters, followed by the values of the
+# parameters as raw little-endian float32 arrays, which are memory-mapped when the bundle is read.
+#
+# Layout:
+# MAGIC <= 8 bytes
+# header length <= 8 bytes, little-endian
+# header <= utf8 JSON, zero padded so the parameters start at a multiple of ALIGNMENT bytes
+# parameters, then lookup parameters <= in the order the model created them
+#
+# The models are rebuilt by their own build_model functions, which create the parameters in the same order, and the
+# arrays are then copied into them.
+#
+# Bundles are written to a temporary file that is renamed over the bundle path, so a bundle is either the previous one
+# or the new one, even if the writing process is killed. Training checkpoints are bundles as well, with the training
+# state in their header.
+
+import os
+import sys
+import json
+import struct
+import time
+import threading
+import numpy as np
+
+MAGIC = 'MRBUNDLE'
+ALIGNMENT = 16
+DTYPE = np.dtype('<f4')
+CHECKPOINT_SUFFIX = '_checkpoint.bundle'
+
+
+def save_bundle(model, bundle_path, metadata):
+    parameter_arrays, lookup_parameter_arrays = get_parameter_arrays(model)
+    write_bundle(parameter_arrays, lookup_parameter_arrays, bundle_path, metadata)
+
+
+# copies of the values of the parameters and the lookup parameters of a model, in the order the model created them,
+# which stay as they are while the model goes on training
+def get_parameter_arrays(model):
+    return [p.as_array() for p in model.parameters_list()], [p.as_array() for p in model.lookup_parameters_list()]
+
+
+def write_bundle(parameter_arrays, lookup_parameter_arrays, bundle_path, metadata):
+    arrays = list(parameter_arrays) + list(lookup_parameter_arrays)
+
+    shapes = [list(array.shape) for array in arrays]
+    header = dict(metadata)
+    header['parameter_shapes'] = shapes[:len(parameter_arrays)]
+    header['lookup_parameter_shapes'] = shapes[len(parameter_arrays):]
+    header = json.dumps(header).encode('utf8')
+    header += ' ' * (-(len(MAGIC) + 8 + len(header)) % ALIGNMENT)
+
+    tmp_path = bundle_path + '.tmp{}'.format(os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for array in arrays:
+            f.write(np.ascontiguousarray(array, dtype=DTYPE).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, bundle_path)
+
+    print 'saved model bundle to {} ({:.2f} MB)'.format(bundle_path, os.path.getsize(bundle_path) / 1e6)
+
+
+# writes bundles in a background thread, so training does not wait for the disk. the arrays given to write must not
+# change afterwards - copies such as the ones get_parameter_arrays returns. a write waits for the previous one first,
+# and a write that failed raises its error from the next wait
+class BundleWriter:
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def write(self, parameter_arrays, lookup_parameter_arrays, bundle_path, metadata):
+        self.wait()
+        self.thread = threading.Thread(target=self.run, args=(parameter_arrays, lookup_parameter_arrays, bundle_path,
+                                                              metadata))
+        self.thread.start()
+
+    def run(self, parameter_arrays, lookup_parameter_arrays, bundle_path, metadata):
+        try:
+            write_bundle(parameter_arrays, lookup_parameter_arrays, bundle_path, metadata)
+        except Exception:
+            # the previous bundle is left as it was
+            self.error = sys.exc_info()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error_type, error, error_traceback = self.error
+            self.error = None
+            raise error_type, error, error_traceback
+
+
+def read_bundle(bundle_path):
+    start = time.time()
+    with open(bundle_path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception('{} is not a model bundle'.format(bundle_path))
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        metadata = json.loads(f.read(header_len).decode('utf8'))
+    data_offset = len(MAGIC) + 8 + header_len
+
+    # views on the memory-mapped values, in the order of the shapes
+    values = np.memmap(bundle_path, dtype=DTYPE, mode='r', offset=data_offset)
+    arrays = []
+    position = 0
+    for shape in metadata['parameter_shapes'] + metadata['lookup_parameter_shapes']:
+        size = int(np.prod(shape))
+        arrays.append(values[position:position + size].reshape(shape))
+        position += size
+    parameter_arrays = arrays[:len(metadata['parameter_shapes'])]
+    lookup_parameter_arrays = arrays[len(metadata['parameter_shapes']):]
+
+    print 'read model bundle {} ({:.2f} MB) in {:.3f} seconds'.format(bundle_path, os.path.getsize(bundle_path) / 1e6,
+                                                                      time.time() - start)
+    return metadata, parameter_arrays, lookup_parameter_arrays
+
+
+def set_parameters(model, parameter_arrays, lookup_parameter_arrays):
+    parameters = model.parameters_list()
+    lookup_parameters = model.lookup_parameters_list()
+    if len(parameters) != len(parameter_arrays) or len(lookup_parameters) != len(lookup_parameter_arrays):
+        raise Exception('the bundle holds {} parameters and {} lookup parameters, the model has {} and {}'.format(
+            len(parameter_arrays), len(lookup_parameter_arrays), len(parameters), len(lookup_parameters)))
+
+    for p, array in zip(parameters, parameter_arrays):
+        if tuple(p.shape()) != array.shape:
+            raise Exception('bundle parameter of shape {} does not fit model parameter of shape {}'.format(
+                array.shape, p.shape()))
+        p.set_value(np.array(array))
+
+    for p, array in zip(lookup_parameters, lookup_parameter_arrays):
+        if tuple(p.shape()) != array.shape:
+            raise Exception('bundle lookup parameter of shape {} does not fit model parameter of shape {}'.format(
+                array.shape, p.shape()))
+        p.init_from_array(np.array(array))
@@ -35,6 +35,7 @@ import datetime
 import time
 import os
 import common
+import beam_search
 from collections import defaultdict
 from multiprocessing import Pool
 from matplotlib import pyplot as plt
@@ -641,50 +642,31 @@ def predict_nbest_template(model, encoder_frnn, encoder_rrnn, decoder_rnn, lemma
 
     # beam search
 
-    # initialize the decoder rnn
-    s_0 = decoder_rnn.initial_state()
-
-    i = 0
-    beam_width = BEAM_WIDTH
-
-    # holds beam step index mapped to sequences, probability, decoder state
-    beam = {-1: [([BEGIN_WORD], 1.0, s_0)]}
-    final_states = []
+    # initialize the decoder rnn, one decoder state per live hypothesis
+    decoder_states = [decoder_rnn.initial_state()]
+    prev_output_vecs = [char_lookup[alphabet_index[BEGIN_WORD]]]
+    beam = beam_search.Beam(BEAM_WIDTH, nbest, alphabet_index[END_WORD])
 
     # run the decoder through the sequence and predict characters
-    while i < MAX_PREDICTION_LEN and len(beam[i - 1]) > 0:
-
-        # at each stage:
-        # create all expansions from the previous beam:
-        new_hypos = []
-        for hypothesis in beam[i - 1]:
-            seq, hyp_prob, prefix_decoder = hypothesis
-            last_hypo_char = seq[-1]
-
-            # cant expand finished sequences
-            if last_hypo_char == END_WORD:
-                continue
+    i = 0
+    while i < MAX_PREDICTION_LEN and not beam.done():
 
-            # expand from the last character of the hypothesis
+        # if the lemma is finished, pad with epsilon chars
+        if i < len(lemma):
+            blstm_output = blstm_outputs[i]
             try:
-                prev_output_vec = char_lookup[alphabet_index[last_hypo_char]]
+                lemma_input_char_vec = char_lookup[alphabet_index[lemma[i]]]
             except KeyError:
-                # not a character
-                # print 'impossible to expand, key error'# + str(seq)
-                continue
-
-            # if the lemma is finished, pad with epsilon chars
-            if i < len(lemma):
-                blstm_output = blstm_outputs[i]
-                try:
-                    lemma_input_char_vec = char_lookup[alphabet_index[lemma[i]]]
-                except KeyError:
-                    # handle unseen characters
-                    lemma_input_char_vec = char_lookup[alphabet_index[UNK]]
-            else:
-                lemma_input_char_vec = char_lookup[alphabet_index[EPSILON]]
-                blstm_output = blstm_outputs[lemma_char_vecs_len - 1]
+                # handle unseen characters
+                lemma_input_char_vec = char_lookup[alphabet_index[UNK]]
+        else:
+            lemma_input_char_vec = char_lookup[alphabet_index[EPSILON]]
+            blstm_output = blstm_outputs[lemma_char_vecs_len - 1]
 
+        # compute the log probs of all expansions of the beam
+        new_states = []
+        log_probs = []
+        for prefix_decoder, prev_output_vec in zip(decoder_states, prev_output_vecs):
             decoder_input = concatenate([blstm_output,
                                          prev_output_vec,
                                          lemma_input_char_vec,
@@ -693,33 +675,18 @@ def predict_nbest_template(model, encoder_frnn, encoder_rrnn, decoder_rnn, lemma
 
             # prepare input vector and perform LSTM step
             s = prefix_decoder.add_input(decoder_input)
+            new_states.append(s)
+            log_probs.append(log_softmax(R * s.output() + bias).vec_value())
 
-            # compute softmax probs
-            decoder_rnn_output = s.output()
-            probs = softmax(R * decoder_rnn_output + bias)
-            probs = probs.vec_value()
-
-            # expand - create new hypos
-            for index, p in enumerate(probs):
-                new_seq = list(seq)
-                new_seq.append(inverse_alphabet_index[index])
-                new_prob = hyp_prob * p
-                if new_seq[-1] == END_WORD:
-                    # if found a complete sequence - add to final states
-                    final_states.append((new_seq[1:-1], new_prob))
-                else:
-                    new_hypos.append((new_seq, new_prob, s))
-
-        # add the expansions with the largest probability to the beam together with their score and prefix rnn state
-        new_probs = [p for (s, p, r) in new_hypos]
-        argmax_indices = common.argmax(new_probs, n=beam_width)
-        beam[i] = [new_hypos[l] for l in argmax_indices]
+        # keep the expansions with the largest log probability together with their prefix rnn state
+        parents, outputs = beam.advance(np.array(log_probs).T)
+        decoder_states = [new_states[p] for p in parents]
+        prev_output_vecs = [char_lookup[o] for o in outputs]
         i += 1
 
-    # get nbest results from final states found in search
-    final_probs = [p for (s, p) in final_states]
-    argmax_indices = common.argmax(final_probs, n=nbest)
-    nbest_templates = [final_states[l] for l in argmax_indices]
+    # get nbest results from the complete sequences found in search
+    nbest_templates = [([inverse_alphabet_index[o] for o in sequence], log_prob)
+                       for sequence, log_prob in beam.nbest()]
 
     return nbest_templates
 
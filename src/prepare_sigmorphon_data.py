@@ -1,7 +1,17 @@
+import os
 import sys
 import codecs
+import json
+import struct
+import hashlib
+from array import array
+import numpy as np
 
 NULL = 'NULL'
+CACHE_MAGIC = 'MRDCACHE'
+CACHE_ALIGNMENT = 16
+COLUMNS = ['sources', 'source_offsets', 'targets', 'target_offsets', 'target_bundles', 'source_bundles']
+VOCABULARY_SUFFIX = '_vocab.json'
 
 
 def load_data(filename, task=1):
@@ -128,6 +138,334 @@ def make_feat_dict(feats_str):
     return feat_dict
 
 
+def iter_examples(filename, task=1):
+    """ Iterate over the examples in a file without loading it into memory
+
+    filename (str): file containing morphology reinflection data, in the formats described in load_data
+    yields a tuple of strings for each example, the features are left as the feature strings of the file. for task 1:
+                    (lemma, feats, word), where word is 'COVERED' in test-covered files
+                    for task 2:
+                    (source_feats, source_word, target_feats, target_word)
+                    and for task 3:
+                    (source_word, feats, target_word)
+    """
+
+    covered = 'test-covered' in filename
+    with codecs.open(filename, encoding='utf8') as f:
+        for line in f:
+            splt = line.strip().split()
+            if len(splt) == 0:
+                # empty line marks end of lemma; ignore this for now
+                continue
+            if task in [1, 3]:
+                if covered:
+                    assert len(splt) == 2, 'bad line: ' + line.encode('utf8') + '\n'
+                    yield splt[0], splt[1], 'COVERED'
+                elif len(splt) > 3:
+                    # fix finnish ddn13 bad examples
+                    yield splt[0], [s for s in splt if '=' in s][0], splt[-1]
+                else:
+                    assert len(splt) == 3, 'bad line: ' + line.encode('utf8') + '\n'
+                    yield splt[0], splt[1], splt[2]
+            else:
+                if covered:
+                    assert len(splt) == 3, 'bad line: ' + line.encode('utf8') + '\n'
+                    yield splt[0], splt[1], splt[2], 'COVERED'
+                else:
+                    assert len(splt) == 4, 'bad line: ' + line.encode('utf8') + '\n'
+                    yield splt[0], splt[1], splt[2], splt[3]
+
+
+class ColumnarData:
+    """ Compact in-memory form of a data file
+
+    the characters of all sources and of all targets are stored as two int32 arrays of character ids, each with an
+    offsets array so that source i is sources[source_offsets[i]:source_offsets[i + 1]]. feature strings are interned,
+    every example holds the id of its feature bundle, and each distinct bundle is parsed into a dict once.
+    """
+
+    def __init__(self, task=1):
+        self.task = task
+        self.chars = []
+        self.char_ids = {}
+        self.bundles = []
+        self.bundle_ids = {}
+        self.bundle_dicts = []
+        self.size = 0
+
+        # the result of get_alphabet on this data, when read from a cache
+        self.alphabet = None
+        self.possible_feats = None
+
+        # filled while loading, then converted to numpy arrays by finish()
+        self.sources = array('i')
+        self.source_offsets = array('l', [0])
+        self.targets = array('i')
+        self.target_offsets = array('l', [0])
+        self.target_bundles = array('i')
+        self.source_bundles = array('i')
+
+    def __len__(self):
+        return self.size
+
+    def intern_chars(self, string, chars):
+        char_ids = self.char_ids
+        try:
+            chars.extend([char_ids[char] for char in string])
+        except KeyError:
+            # the string has new characters
+            for char in string:
+                if char not in char_ids:
+                    char_ids[char] = len(self.chars)
+                    self.chars.append(char)
+            chars.extend([char_ids[char] for char in string])
+
+    def intern_bundle(self, feats_str):
+        try:
+            return self.bundle_ids[feats_str]
+        except KeyError:
+            self.bundle_ids[feats_str] = len(self.bundles)
+            self.bundles.append(feats_str)
+            self.bundle_dicts.append(make_feat_dict(feats_str))
+            return self.bundle_ids[feats_str]
+
+    def add(self, source, target, target_feats, source_feats=None):
+        self.intern_chars(source, self.sources)
+        self.source_offsets.append(len(self.sources))
+        self.intern_chars(target, self.targets)
+        self.target_offsets.append(len(self.targets))
+        self.target_bundles.append(self.intern_bundle(target_feats))
+        if source_feats is not None:
+            self.source_bundles.append(self.intern_bundle(source_feats))
+        self.size += 1
+
+    def finish(self):
+        # the arrays are wrapped without copying, their item sizes depend on the platform
+        for name in COLUMNS:
+            values = getattr(self, name)
+            setattr(self, name, np.frombuffer(values, dtype='i{}'.format(values.itemsize)))
+
+    def source(self, i):
+        return u''.join([self.chars[c] for c in self.sources[self.source_offsets[i]:self.source_offsets[i + 1]]])
+
+    def target(self, i):
+        return u''.join([self.chars[c] for c in self.targets[self.target_offsets[i]:self.target_offsets[i + 1]]])
+
+    def target_feat_dict(self, i):
+        # the dicts are shared by all the examples with the same bundle, and must not be modified
+        return self.bundle_dicts[self.target_bundles[i]]
+
+    def source_feat_dict(self, i):
+        return self.bundle_dicts[self.source_bundles[i]]
+
+    def strings(self, chars, offsets):
+        # decode all the strings of a column at once and slice them apart
+        text = u''.join([self.chars[c] for c in chars.tolist()])
+        offsets = offsets.tolist()
+        return [text[offsets[i]:offsets[i + 1]] for i in xrange(self.size)]
+
+    def to_lists(self):
+        """ return the data as the tuple load_data returns for the same task, with shared feature dicts """
+        targets = self.strings(self.targets, self.target_offsets)
+        sources = self.strings(self.sources, self.source_offsets)
+        target_feat_dicts = [self.bundle_dicts[b] for b in self.target_bundles.tolist()]
+        if self.task in [1, 3]:
+            return targets, sources, target_feat_dicts
+        else:
+            return targets, sources, target_feat_dicts, [self.bundle_dicts[b] for b in self.source_bundles.tolist()]
+
+    def get_alphabet(self):
+        """ return get_alphabet of the data, as fresh lists that can be extended """
+        if self.alphabet is None:
+            lists = self.to_lists()
+            self.alphabet, self.possible_feats = get_alphabet(*lists)
+        return list(self.alphabet), list(self.possible_feats)
+
+
+def load_columnar_data(filename, task=1):
+    """ Load data from file into a ColumnarData
+
+    filename (str): file containing morphology reinflection data, in the formats described in load_data
+    """
+
+    data = ColumnarData(task)
+    for example in iter_examples(filename, task):
+        if task in [1, 3]:
+            source, feats, target = example
+            data.add(source, target, feats)
+        else:
+            source_feats, source, target_feats, target = example
+            data.add(source, target, target_feats, source_feats)
+    data.finish()
+    return data
+
+
+def file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def write_data_cache(data, cache_filename, source_hash):
+    """ Write a ColumnarData to a binary cache file
+
+    the file holds CACHE_MAGIC, the length of a JSON header (8 bytes, little-endian), the header - hash of the source
+    file, task, characters, feature bundles, alphabet and the type and length of each column - zero padded to a
+    multiple of CACHE_ALIGNMENT bytes, and then the columns as raw little-endian arrays, so they can be memory-mapped
+    """
+
+    alphabet, possible_feats = data.get_alphabet()
+    columns = [np.ascontiguousarray(getattr(data, name), dtype=getattr(data, name).dtype.newbyteorder('<'))
+               for name in COLUMNS]
+    header = {'source_hash': source_hash, 'task': data.task, 'size': data.size, 'chars': data.chars,
+              'bundles': data.bundles, 'alphabet': alphabet, 'possible_feats': possible_feats,
+              'columns': [[name, column.dtype.str, len(column)] for name, column in zip(COLUMNS, columns)]}
+    header = json.dumps(header).encode('utf8')
+    header += ' ' * (-(len(CACHE_MAGIC) + 8 + len(header)) % CACHE_ALIGNMENT)
+
+    # written under a temporary name first, so a reader never sees a partial cache
+    tmp_filename = cache_filename + '.tmp{}'.format(os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        f.write(CACHE_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for column in columns:
+            f.write(column.tobytes())
+    os.rename(tmp_filename, cache_filename)
+
+
+def read_data_cache(cache_filename, source_hash):
+    """ Read a ColumnarData from a cache written by write_data_cache
+
+    return None if there is no cache, or if it was written for a different version of the source file
+    """
+
+    if not os.path.isfile(cache_filename):
+        return None
+    with open(cache_filename, 'rb') as f:
+        if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+            return None
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_len).decode('utf8'))
+    if header['source_hash'] != source_hash:
+        return None
+
+    data = ColumnarData(header['task'])
+    data.size = header['size']
+    data.chars = header['chars']
+    data.char_ids = {char: i for i, char in enumerate(data.chars)}
+    for bundle in header['bundles']:
+        data.intern_bundle(bundle)
+    data.alphabet = header['alphabet']
+    data.possible_feats = header['possible_feats']
+
+    offset = len(CACHE_MAGIC) + 8 + header_len
+    for name, dtype, length in header['columns']:
+        if length > 0:
+            column = np.memmap(cache_filename, dtype=dtype, mode='r', offset=offset, shape=(length,))
+        else:
+            column = np.zeros(0, dtype=dtype)
+        setattr(data, name, column)
+        offset += length * np.dtype(dtype).itemsize
+    return data
+
+
+def load_cached_data(filename, task=1):
+    """ Load data from file into a ColumnarData, through a binary cache next to the file
+
+    the cache is filename + '.cache', and is used only if it was written for the current content of the file.
+    otherwise the file is parsed and the cache is (re)written. if the cache can't be written, the data is still returned
+    """
+
+    source_hash = file_hash(filename)
+    cache_filename = filename + '.cache'
+    data = read_data_cache(cache_filename, source_hash)
+    if data is not None and data.task == task:
+        print 'loaded {} examples from cache: {}'.format(data.size, cache_filename)
+        return data
+
+    data = load_columnar_data(filename, task)
+    try:
+        write_data_cache(data, cache_filename, source_hash)
+        print 'wrote cache: {}'.format(cache_filename)
+    except (IOError, OSError) as e:
+        print 'could not write cache {}: {}'.format(cache_filename, e)
+    return data
+
+
+def build_vocabulary(data, min_char_count=1, min_feat_count=1):
+    """
+    Build the character and feature vocabularies of a ColumnarData, counting over its columns
+
+    data (ColumnarData): the train set
+    min_char_count (int): characters seen less times are left out of the alphabet
+    min_feat_count (int): feature values seen in less examples are left out of the alphabets
+    return (vocabulary): a dictionary of
+        alphabet (list): the characters, then key=value for each feature value and key=NULL for each feature name,
+                         like the alphabet of get_alphabet
+        feature_types (list): the feature names, like the possible_feats of get_alphabet
+        feature_alphabet (list): key:value for each target feature value, like common.get_feature_alphabet
+        min_char_count, min_feat_count (int): the cutoffs
+    each list is sorted, so the same data and cutoffs always give the same indices
+    """
+
+    char_counts = np.bincount(np.concatenate([data.sources, data.targets]), minlength=len(data.chars))
+    chars = sorted([data.chars[i] for i in np.flatnonzero(char_counts >= min_char_count)])
+
+    # a feature value is counted once for each example whose bundle holds it
+    target_bundle_counts = np.bincount(data.target_bundles, minlength=len(data.bundles)).tolist()
+    bundle_counts = np.bincount(data.source_bundles, minlength=len(data.bundles)).tolist()
+    feat_counts = {}
+    target_feat_counts = {}
+    for feat_dict, count, target_count in zip(data.bundle_dicts, bundle_counts, target_bundle_counts):
+        for feat_key in feat_dict:
+            feat = (feat_key, feat_dict[feat_key])
+            feat_counts[feat] = feat_counts.get(feat, 0) + count + target_count
+            target_feat_counts[feat] = target_feat_counts.get(feat, 0) + target_count
+
+    feature_types = sorted(set([feat_key for feat_key, value in feat_counts]))
+    feats = set([feat_key + '=' + value for (feat_key, value), count in feat_counts.items() if count >= min_feat_count])
+    feats.update([feat_key + '=' + NULL for feat_key in feature_types])
+    feature_alphabet = sorted([feat_key + ':' + value for (feat_key, value), count in target_feat_counts.items()
+                               if count >= min_feat_count])
+
+    print 'vocabulary: {} of {} characters, {} of {} feature values'.format(len(chars), len(data.chars),
+                                                                           len(feature_alphabet),
+                                                                           len(target_feat_counts))
+    return {'alphabet': chars + sorted(feats), 'feature_types': feature_types, 'feature_alphabet': feature_alphabet,
+            'min_char_count': min_char_count, 'min_feat_count': min_feat_count}
+
+
+def save_vocabulary(vocabulary, path):
+    with codecs.open(path, 'w', encoding='utf8') as f:
+        json.dump(vocabulary, f, ensure_ascii=False, indent=0, sort_keys=True)
+
+
+def find_vocabulary(results_file_paths):
+    """ Load the vocabulary saved next to the models, None if none of them has one
+
+    the models are used with the same indices, so an exception is raised if their vocabularies differ or only some of
+    them have one
+    """
+    vocabulary = None
+    found = []
+    for results_file_path in results_file_paths:
+        path = results_file_path + VOCABULARY_SUFFIX
+        if os.path.isfile(path):
+            with codecs.open(path, 'r', encoding='utf8') as f:
+                model_vocabulary = json.load(f)
+            print 'loaded vocabulary from {}'.format(path)
+            if vocabulary is not None and model_vocabulary != vocabulary:
+                raise Exception('the vocabulary of {} differs from the one of {}'.format(results_file_path, found[0]))
+            vocabulary = model_vocabulary
+            found.append(results_file_path)
+    if 0 < len(found) < len(results_file_paths):
+        raise Exception('only some of the models have a saved vocabulary: {}'.format(', '.join(found)))
+    return vocabulary
+
+
 def convert_data_to_indices(words, lemmas, feat_dicts, alphabet_index, possible_feats, output_prefix):
     """ Convert data to indices
 
@@ -4,15 +4,16 @@ files and evaluation script.
 Usage:
   soft_attention.py [--dynet-mem MEM][--input=INPUT] [--hidden=HIDDEN]
   [--feat-input=FEAT] [--epochs=EPOCHS] [--layers=LAYERS] [--optimization=OPTIMIZATION] [--reg=REGULARIZATION]
-  [--learning=LEARNING] [--plot] [--override] [--eval] [--ensemble=ENSEMBLE] TRAIN_PATH DEV_PATH TEST_PATH RESULTS_PATH
-  SIGMORPHON_PATH...
+  [--learning=LEARNING] [--plot] [--override] [--eval] [--ensemble=ENSEMBLE] [--ensemble-mode=MODE] [--async-eval]
+  [--checkpoint-every=EPOCHS] [--resume] [--curriculum=EPOCHS]
+  TRAIN_PATH DEV_PATH TEST_PATH RESULTS_PATH SIGMORPHON_PATH...
 
 Arguments:
   TRAIN_PATH    train set path path
   DEV_PATH      development set path
   TEST_PATH     test set path
   RESULTS_PATH  results file path
-  SIGMORPHON_PATH   sigmorphon root containing data, src dirs
+  SIGMORPHON_PATH   sigmorphon root containing data, src dirs. not needed for the evaluation, which runs in-process
 
 Options:
   -h --help                     show this help message and exit
@@ -28,7 +29,17 @@ Options:
   --plot                        draw a learning curve plot while training each model
   --override                    override the existing model with the same name, if exists
   --ensemble=ENSEMBLE           ensemble model paths separated by a comma
+  --ensemble-mode=MODE          MAJORITY to vote between the predictions of the ensemble models, or AVERAGE to average
+                                the ensemble's output probabilities at each step. MAJORITY if not given
   --eval                        run evaluation without training
+  --async-eval                  evaluate a snapshot of the parameters on dev in a worker process while the next epoch
+                                trains. saving the best model and early stopping act on each epoch one epoch late
+  --checkpoint-every=EPOCHS     save the parameters and the training state to RESULTS_PATH_checkpoint.bundle every
+                                EPOCHS epochs and after the last one. 1 if not given
+  --resume                      go on training from RESULTS_PATH_checkpoint.bundle if it exists, instead of from the
+                                start or from the saved best model
+  --curriculum=EPOCHS           train on the shortest examples first, adding longer ones in each of the first EPOCHS
+                                epochs until all of them are used. 0 if not given
 """
 
 import numpy as np
@@ -39,11 +50,12 @@ import datetime
 import time
 import os
 import common
+import model_bundle
 import dynet as pc
 
 from matplotlib import pyplot as plt
 from docopt import docopt
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 # default values
 INPUT_DIM = 300
@@ -59,6 +71,10 @@ REGULARIZATION = 0.0
 LEARNING_RATE = 0.0001  # 0.1
 PARALLELIZE = True
 BEAM_WIDTH = 5
+ENSEMBLE_MODE = 'MAJORITY'
+ENSEMBLE_MODES = ['MAJORITY', 'AVERAGE']
+CHECKPOINT_EVERY = 1
+CURRICULUM_EPOCHS = 0
 
 NULL = '%'
 UNK = '#'
@@ -69,47 +85,46 @@ UNK_FEAT = '@'
 
 
 def main(train_path, dev_path, test_path, results_file_path, sigmorphon_root_dir, input_dim, hidden_dim, feat_input_dim,
-         epochs, layers, optimization, regularization, learning_rate, plot, override, eval_only, ensemble):
+         epochs, layers, optimization, regularization, learning_rate, plot, override, eval_only, ensemble,
+         ensemble_mode=ENSEMBLE_MODE, async_eval=False, checkpoint_every=CHECKPOINT_EVERY, resume=False,
+         curriculum_epochs=CURRICULUM_EPOCHS):
     hyper_params = {'INPUT_DIM': input_dim, 'HIDDEN_DIM': hidden_dim, 'FEAT_INPUT_DIM': feat_input_dim,
                     'EPOCHS': epochs, 'LAYERS': layers, 'MAX_PREDICTION_LEN': MAX_PREDICTION_LEN,
                     'OPTIMIZATION': optimization, 'PATIENCE': MAX_PATIENCE, 'REGULARIZATION': regularization,
                     'LEARNING_RATE': learning_rate}
+    if ensemble_mode not in ENSEMBLE_MODES:
+        raise ValueError('unknown ensemble mode {}, expected one of {}'.format(ensemble_mode, '/'.join(ENSEMBLE_MODES)))
 
     print 'train path = ' + str(train_path)
     print 'test path =' + str(test_path)
     for param in hyper_params:
         print param + '=' + str(hyper_params[param])
 
-    # load train and test data
-    (train_words, train_lemmas, train_feat_dicts) = prepare_sigmorphon_data.load_data(train_path)
-    (test_words, test_lemmas, test_feat_dicts) = prepare_sigmorphon_data.load_data(test_path)
-    (dev_words, dev_lemmas, dev_feat_dicts) = prepare_sigmorphon_data.load_data(dev_path)
-    alphabet, feature_types = prepare_sigmorphon_data.get_alphabet(train_words, train_lemmas, train_feat_dicts)
-
-    # used for character dropout
-    alphabet.append(NULL)
-    alphabet.append(UNK)
-
-    # used during decoding
-    alphabet.append(EPSILON)
-    alphabet.append(BEGIN_WORD)
-    alphabet.append(END_WORD)
-
-    # add indices to alphabet - used to indicate when copying from lemma to word
-    for marker in [str(i) for i in xrange(MAX_PREDICTION_LEN)]:
-        alphabet.append(marker)
-
-    # char 2 int
-    alphabet_index = dict(zip(alphabet, range(0, len(alphabet))))
-    inverse_alphabet_index = {index: char for char, index in alphabet_index.items()}
-
-    # feat 2 int
-    feature_alphabet = common.get_feature_alphabet(train_feat_dicts)
-    feature_alphabet.append(UNK_FEAT)
-    feat_index = dict(zip(feature_alphabet, range(0, len(feature_alphabet))))
+    # load train and test data, through the binary caches next to the files
+    train_data = prepare_sigmorphon_data.load_cached_data(train_path)
+    (train_words, train_lemmas, train_feat_dicts) = train_data.to_lists()
+    (test_words, test_lemmas, test_feat_dicts) = prepare_sigmorphon_data.load_cached_data(test_path).to_lists()
+    (dev_words, dev_lemmas, dev_feat_dicts) = prepare_sigmorphon_data.load_cached_data(dev_path).to_lists()
 
+    # a new model gets a vocabulary built from the train set, which is saved next to it so every run on the model gets
+    # the same indices. models saved without a vocabulary use the alphabets get_alphabet builds from the train set
     model_file_name = results_file_path + '_bestmodel.txt'
-    if os.path.isfile(model_file_name) and not override:
+    # an existing model or checkpoint and the ensemble members are used with the same vocabulary, which they must all
+    # have
+    existing = os.path.isfile(model_file_name) or os.path.isfile(results_file_path + model_bundle.CHECKPOINT_SUFFIX)
+    vocabulary = prepare_sigmorphon_data.find_vocabulary(([results_file_path] if existing else []) +
+                                                         (ensemble.split(',') if ensemble else []))
+    if vocabulary is None and not eval_only and (override or not os.path.isfile(model_file_name)):
+        vocabulary = prepare_sigmorphon_data.build_vocabulary(train_data)
+        prepare_sigmorphon_data.save_vocabulary(vocabulary,
+                                                results_file_path + prepare_sigmorphon_data.VOCABULARY_SUFFIX)
+    alphabet, alphabet_index, inverse_alphabet_index, feature_alphabet, feat_index, feature_types = build_alphabets(
+        train_words, train_lemmas, train_feat_dicts, train_data.get_alphabet(), vocabulary)
+
+    # a resumed training takes its parameters from the checkpoint instead of the best model
+    resume_checkpoint = resume and not eval_only and os.path.isfile(results_file_path +
+                                                                    model_bundle.CHECKPOINT_SUFFIX)
+    if os.path.isfile(model_file_name) and not override and not resume_checkpoint:
         print 'loading existing model from {}'.format(model_file_name)
         model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, W_c, W__a, U__a, v__a = load_best_model(alphabet, results_file_path, input_dim,
                                                                          hidden_dim, layers, feature_alphabet,
@@ -126,7 +141,14 @@ def main(train_path, dev_path, test_path, results_file_path, sigmorphon_root_dir
                                                             train_lemmas, train_feat_dicts, train_words, dev_lemmas,
                                                             dev_feat_dicts, dev_words, alphabet_index,
                                                             inverse_alphabet_index, epochs, optimization,
-                                                            results_file_path, feat_index, feature_types, plot)
+                                                            results_file_path, feat_index, feature_types, plot,
+                                                            common.make_model_metadata(alphabet, feature_alphabet,
+                                                                                       feature_types, input_dim,
+                                                                                       hidden_dim, layers,
+                                                                                       feat_input_dim,
+                                                                                       MAX_PREDICTION_LEN),
+                                                            async_eval, checkpoint_every, resume,
+                                                            curriculum_epochs)
         model = trained_model
         print 'last epoch is {}'.format(last_epoch)
         print 'best epoch is {}'.format(best_epoch)
@@ -134,11 +156,16 @@ def main(train_path, dev_path, test_path, results_file_path, sigmorphon_root_dir
     else:
         print 'skipped training, evaluating on test set...'
 
-    if ensemble:
+    if ensemble and ensemble_mode == 'MAJORITY':
         predicted_sequences = predict_with_ensemble_majority(alphabet, alphabet_index, ensemble, feat_index,
                                                              feat_input_dim, feature_alphabet, feature_types,
                                                              hidden_dim, input_dim, inverse_alphabet_index, layers,
                                                              test_feat_dicts, test_lemmas, test_words)
+    elif ensemble:
+        predicted_sequences = predict_with_ensemble_average(alphabet, alphabet_index, ensemble, feat_index,
+                                                            feat_input_dim, feature_alphabet, feature_types,
+                                                            hidden_dim, input_dim, inverse_alphabet_index, layers,
+                                                            test_feat_dicts, test_lemmas)
     else:
         predicted_sequences = predict_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, W_c, W__a, U__a, v__a, alphabet_index,
                                                 inverse_alphabet_index, test_lemmas, test_feat_dicts, feat_index,
@@ -151,21 +178,26 @@ def main(train_path, dev_path, test_path, results_file_path, sigmorphon_root_dir
 
         final_results = {}
         for i in xrange(len(test_lemmas)):
-            joint_index = test_lemmas[i] + ':' + common.get_morph_string(test_feat_dicts[i], feature_types)
-            inflection = predicted_sequences[joint_index]
+            inflection = predicted_sequences[i]
             final_results[i] = (test_lemmas[i], test_feat_dicts[i], ''.join(inflection))
 
         # evaluate best models
-        common.write_results_file_and_evaluate_externally(hyper_params, accuracy, train_path, test_path,
-                                                          results_file_path + '.external_eval.txt', sigmorphon_root_dir,
-                                                          final_results)
+        common.write_results_file_and_evaluate(hyper_params, accuracy, train_path, test_path,
+                                               results_file_path + '.external_eval.txt', final_results)
     return
 
 
-def predict_with_ensemble_majority(alphabet, alphabet_index, ensemble, feat_index, feat_input_dim, feature_alphabet,
-                                   feature_types, hidden_dim, input_dim, inverse_alphabet_index, layers,
-                                   test_feat_dicts, test_lemmas, test_words):
+# builds the character and feature alphabets of the model from the train set, or from its saved vocabulary
+def build_alphabets(train_words, train_lemmas, train_feat_dicts, train_alphabet=None, vocabulary=None):
+    # NULL and UNK are used for character dropout, EPSILON, BEGIN_WORD and END_WORD during decoding, and the indices
+    # to indicate when copying from lemma to word
+    symbols = [NULL, UNK, EPSILON, BEGIN_WORD, END_WORD] + [str(i) for i in xrange(MAX_PREDICTION_LEN)]
+    return common.build_alphabets(train_words, train_lemmas, train_feat_dicts, symbols, UNK_FEAT, train_alphabet,
+                                  vocabulary)
+
 
+def load_ensemble_models(alphabet, ensemble, input_dim, hidden_dim, layers, feature_alphabet, feat_input_dim,
+                         feature_types):
     ensemble_model_names = ensemble.split(',')
     print 'ensemble paths:\n'
     print '\n'.join(ensemble_model_names)
@@ -177,7 +209,18 @@ def predict_with_ensemble_majority(alphabet, alphabet_index, ensemble, feat_inde
                                                                          feature_alphabet, feat_input_dim,
                                                                          feature_types)
 
-        ensemble_models.append((model, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, W_c, W__a, U__a, v__a))
+        ensemble_models.append((model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, W_c,
+                                W__a, U__a, v__a))
+
+    return ensemble_models
+
+
+def predict_with_ensemble_majority(alphabet, alphabet_index, ensemble, feat_index, feat_input_dim, feature_alphabet,
+                                   feature_types, hidden_dim, input_dim, inverse_alphabet_index, layers,
+                                   test_feat_dicts, test_lemmas, test_words, print_results=False):
+
+    ensemble_models = load_ensemble_models(alphabet, ensemble, input_dim, hidden_dim, layers, feature_alphabet,
+                                           feat_input_dim, feature_types)
 
     # predict the entire test set with each model in the ensemble
     ensemble_predictions = []
@@ -189,29 +232,51 @@ def predict_with_ensemble_majority(alphabet, alphabet_index, ensemble, feat_inde
 
         ensemble_predictions.append(predicted_sequences)
 
-    # perform voting for each test input - joint_index is a lemma+feats representation
-    majority_predicted_sequences = {}
+    # perform voting for each test input
+    majority_predicted_sequences = [None] * len(test_lemmas)
     string_to_template = {}
-    test_data = zip(test_lemmas, test_feat_dicts, test_words)
-    for i, (lemma, feat_dict, word) in enumerate(test_data):
-        joint_index = lemma + ':' + common.get_morph_string(feat_dict, feature_types)
+    for i in xrange(len(test_lemmas)):
         prediction_counter = defaultdict(int)
         for ens in ensemble_predictions:
-            prediction_str = ''.join(ens[joint_index])
+            prediction_str = ''.join(ens[i])
             prediction_counter[prediction_str] += 1
-            string_to_template[prediction_str] = ens[joint_index]
-            print 'template: {} prediction: {}'.format(''.join([e.encode('utf-8') for e in ens[joint_index]]),
-                                                       prediction_str.encode('utf-8'))
+            string_to_template[prediction_str] = ens[i]
+            if print_results:
+                print 'template: {} prediction: {}'.format(''.join([e.encode('utf-8') for e in ens[i]]),
+                                                           prediction_str.encode('utf-8'))
 
         # return the most predicted output
         majority_prediction_string = max(prediction_counter, key=prediction_counter.get)
-        print 'chosen:{} with {} votes\n'.format(majority_prediction_string.encode('utf-8'),
-                                                  prediction_counter[majority_prediction_string])
-        majority_predicted_sequences[joint_index] = string_to_template[majority_prediction_string]
+        if print_results:
+            print 'chosen:{} with {} votes\n'.format(majority_prediction_string.encode('utf-8'),
+                                                      prediction_counter[majority_prediction_string])
+        majority_predicted_sequences[i] = string_to_template[majority_prediction_string]
 
     return majority_predicted_sequences
 
 
+def predict_with_ensemble_average(alphabet, alphabet_index, ensemble, feat_index, feat_input_dim, feature_alphabet,
+                                  feature_types, hidden_dim, input_dim, inverse_alphabet_index, layers,
+                                  test_feat_dicts, test_lemmas):
+
+    ensemble_models = load_ensemble_models(alphabet, ensemble, input_dim, hidden_dim, layers, feature_alphabet,
+                                           feat_input_dim, feature_types)
+
+    # decode the entire test set once, with all the models in the same graph
+    print 'predicting...'
+    predictions = []
+    data_len = len(test_lemmas)
+    for i, (lemma, feat_dict) in enumerate(zip(test_lemmas, test_feat_dicts)):
+        predicted_template = predict_ensemble_output_sequence(ensemble_models, lemma, feat_dict, alphabet_index,
+                                                              inverse_alphabet_index, feat_index, feature_types)
+        if i % 1000 == 0 and i > 0:
+            print 'predicted {} examples out of {}'.format(i, data_len)
+
+        predictions.append(predicted_template)
+
+    return predictions
+
+
 def save_pycnn_model(model, results_file_path):
     tmp_model_path = results_file_path + '_bestmodel.txt'
     print 'saving to ' + tmp_model_path
@@ -219,6 +284,19 @@ def save_pycnn_model(model, results_file_path):
     print 'saved to {0}'.format(tmp_model_path)
 
 
+# saves the evaluated parameters as the best model - snapshot holds the evaluated parameter arrays, or None if they are
+# the model's current ones. a snapshot is loaded into the model for the save, and the model's own parameters are put
+# back afterwards
+def save_best_model(model, snapshot, results_file_path):
+    if snapshot is None:
+        save_pycnn_model(model, results_file_path)
+        return
+    parameter_arrays, lookup_parameter_arrays = model_bundle.get_parameter_arrays(model)
+    model_bundle.set_parameters(model, snapshot[0], snapshot[1])
+    save_pycnn_model(model, results_file_path)
+    model_bundle.set_parameters(model, parameter_arrays, lookup_parameter_arrays)
+
+
 def load_best_model(alphabet, results_file_path, input_dim, hidden_dim, layers, feature_alphabet,
                     feat_input_dim, feature_types):
 
@@ -276,7 +354,8 @@ def build_model(alphabet, input_dim, hidden_dim, layers, feature_types, feat_inp
 def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, W_c, W__a, U__a,
                 v__a, train_lemmas, train_feat_dicts, train_words, dev_lemmas,
                 dev_feat_dicts, dev_words, alphabet_index, inverse_alphabet_index, epochs, optimization,
-                results_file_path, feat_index, feature_types, plot):
+                results_file_path, feat_index, feature_types, plot, model_metadata=None, async_eval=False,
+                checkpoint_every=CHECKPOINT_EVERY, resume=False, curriculum_epochs=CURRICULUM_EPOCHS):
     print 'training...'
 
     np.random.seed(17)
@@ -309,6 +388,12 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
     dev_loss_y = []
     train_accuracy_y = []
     dev_accuracy_y = []
+    learning_curves = (epochs_x, train_loss_y, dev_loss_y, train_accuracy_y, dev_accuracy_y)
+
+    # saves the evaluated parameters when they are the best so far, and gives the accuracy of the dev predictions
+    save_best = lambda snapshot: save_best_model(model, snapshot, results_file_path)
+    get_dev_accuracy = lambda predictions: evaluate_model(predictions, dev_lemmas, dev_feat_dicts, dev_words,
+                                                          feature_types)[1]
 
     # progress bar init
     widgets = [progressbar.Bar('>'), ' ', progressbar.ETA()]
@@ -316,33 +401,81 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
     avg_loss = -1
     e = 0
 
-    for e in xrange(epochs):
-
-        # randomize the training set
-        indices = range(train_len)
-        random.shuffle(indices)
-        train_set = zip(train_lemmas, train_feat_dicts, train_words)
-        train_set = [train_set[i] for i in indices]
-
-        # compute loss for each example and update
-        for i, example in enumerate(train_set):
-            lemma, feats, word = example
+    # the dev evaluation of each epoch may run in a worker process on a snapshot of the parameters, while the next
+    # epoch trains. its results then arrive an epoch late
+    dev_evaluator = None
+    if async_eval and EARLY_STOPPING and len(dev_lemmas) > 0:
+        if model_metadata is None:
+            print 'evaluating on dev synchronously, the worker process needs the model metadata to build its model'
+        else:
+            dev_args = (dev_lemmas, dev_feat_dicts, dev_words, alphabet_index, inverse_alphabet_index, feat_index,
+                        feature_types)
+            dev_evaluator = common.AsyncEvaluator(common.init_dev_worker, (build_model, evaluate_dev, model_metadata,
+                                                                           dev_args), common.evaluate_dev_snapshot)
+
+    # checkpoints are written in the background while the next epoch trains, with these counters
+    checkpoint_writer = model_bundle.BundleWriter()
+    get_counters = lambda: {'total_loss': total_loss, 'avg_loss': avg_loss, 'best_avg_dev_loss': best_avg_dev_loss,
+                            'best_dev_accuracy': best_dev_accuracy, 'best_train_accuracy': best_train_accuracy,
+                            'best_dev_epoch': best_dev_epoch, 'best_train_epoch': best_train_epoch,
+                            'patience': patience}
+    first_epoch = 0
+    state = common.resume_training(model, trainer, optimization, results_file_path, model_metadata,
+                                   dev_evaluator) if resume else None
+    if state is not None:
+        e = state['epoch']
+        first_epoch = e + 1
+        total_loss, avg_loss, best_avg_dev_loss, best_dev_accuracy, best_train_accuracy, best_dev_epoch, \
+            best_train_epoch, patience = [state[name] for name in ['total_loss', 'avg_loss', 'best_avg_dev_loss',
+                                                                   'best_dev_accuracy', 'best_train_accuracy',
+                                                                   'best_dev_epoch', 'best_train_epoch', 'patience']]
+        learning_curves = state['learning_curves']
+        epochs_x, train_loss_y, dev_loss_y, train_accuracy_y, dev_accuracy_y = learning_curves
+        if state['stopped']:
+            train_progress_bar.finish()
+            return model, e, best_train_epoch
+
+    # per epoch throughput and timings, in JSON lines
+    telemetry = common.TrainingTelemetry(results_file_path + '_telemetry.jsonl')
+    example_chars = [len(lemma) + len(word) for lemma, word in zip(train_lemmas, train_words)]
+
+    # the order of the examples in each epoch, by lemma length and then by word length for the curriculum
+    sampler = common.TrainingSampler([(len(lemma), len(word)) for lemma, word in zip(train_lemmas, train_words)],
+                                     curriculum_epochs=curriculum_epochs)
+
+    for e in xrange(first_epoch, epochs):
+        epoch_start = time.time()
+
+        # compute loss for each example, in random order, and update
+        for i, k in enumerate(sampler.epoch(e)):
+            telemetry.start_step()
             loss = compute_loss(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, W_c,
-                                W__a, U__a, v__a, lemma, feats, word, alphabet_index, feat_index,
-                                feature_types)
+                                W__a, U__a, v__a, train_lemmas[k], train_feat_dicts[k], train_words[k],
+                                alphabet_index, feat_index, feature_types)
+            telemetry.mark('graph')
             loss_value = loss.value()
+            telemetry.mark('forward')
             total_loss += loss_value
             loss.backward()
+            telemetry.mark('backward')
             trainer.update()
+            telemetry.mark('update')
             if i > 0:
-                avg_loss = total_loss / float(i + e * train_len)
+                avg_loss = total_loss / float(i + sampler.examples_before(e))
             else:
                 avg_loss = total_loss
 
             if i % 100 == 0 and i > 0:
                 print 'went through {} examples out of {}'.format(i, train_len)
 
+        train_seconds = time.time() - epoch_start
+        eval_seconds = 0.0
+        dev_seconds = 0.0
+        dev_epoch = None
+        stop = False
+
         if EARLY_STOPPING:
+            eval_start = time.time()
             print 'starting epoch evaluation'
 
             # get train accuracy
@@ -366,48 +499,34 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
             avg_dev_loss = 0
 
             if len(dev_lemmas) > 0:
-                print 'dev prediction:'
-                # get dev accuracy
-                dev_predictions = predict_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn,
-                                                    encoder_rrnn, decoder_rnn, W_c, W__a, U__a, v__a, alphabet_index,
-                                                    inverse_alphabet_index, dev_lemmas,
-                                                    dev_feat_dicts, feat_index, feature_types)
-                print 'dev evaluation:'
-                # get dev accuracy
-                dev_accuracy = evaluate_model(dev_predictions, dev_lemmas, dev_feat_dicts, dev_words, feature_types,
-                                              print_results=False)[1]
-
-                if dev_accuracy >= best_dev_accuracy:
-                    best_dev_accuracy = dev_accuracy
-                    best_dev_epoch = e
-
-                    # save best model to disk
-                    save_pycnn_model(model, results_file_path)
-                    print 'saved new best model'
-                    patience = 0
+                dev_start = time.time()
+                if dev_evaluator is not None:
+                    print 'dev prediction on a snapshot in the background:'
+                    dev_result = dev_evaluator.submit(e, model_bundle.get_parameter_arrays(model))
                 else:
-                    patience += 1
-
-                # found "perfect" model
-                if dev_accuracy == 1:
-                    train_progress_bar.finish()
-                    if plot:
-                        plt.cla()
-                    return model, e
-
-                # get dev loss
-                total_dev_loss = 0
-                for i in xrange(len(dev_lemmas)):
-                    total_dev_loss += compute_loss(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, W_c, W__a, U__a, v__a, dev_lemmas[i],
-                                                   dev_feat_dicts[i], dev_words[i], alphabet_index, feat_index,
-                                                   feature_types).value()
-
-                avg_dev_loss = total_dev_loss / float(len(dev_lemmas))
-                if avg_dev_loss < best_avg_dev_loss:
-                    best_avg_dev_loss = avg_dev_loss
-
-                print 'epoch: {0} train loss: {1:.4f} dev loss: {2:.4f} dev accuracy: {3:.4f} train accuracy = {4:.4f} \
- best dev accuracy {5:.4f} (epoch {8}) best train accuracy: {6:.4f} (epoch {9}) patience = {7}'.format(
+                    print 'dev prediction:'
+                    dev_result = (e, None, evaluate_dev(model, char_lookup, feat_lookup, R, bias, encoder_frnn,
+                                                        encoder_rrnn, decoder_rnn, W_c, W__a, U__a, v__a, dev_lemmas,
+                                                        dev_feat_dicts, dev_words, alphabet_index,
+                                                        inverse_alphabet_index, feat_index, feature_types))
+                dev_seconds = time.time() - dev_start
+
+                # the first snapshot evaluated in the background has no result yet
+                if dev_result is None:
+                    print 'epoch: {0} train loss: {1:.4f} train accuracy = {2:.4f}'.format(e, avg_loss,
+                                                                                           train_accuracy)
+                else:
+                    dev_epoch, dev_snapshot, (dev_predictions, avg_dev_loss) = dev_result
+                    print 'dev evaluation:'
+                    # get dev accuracy
+                    dev_accuracy = evaluate_model(dev_predictions, dev_lemmas, dev_feat_dicts, dev_words,
+                                                  feature_types, print_results=False)[1]
+                    best_dev_accuracy, best_dev_epoch, best_avg_dev_loss, patience = common.update_best_dev(
+                        save_best, dev_snapshot, dev_epoch, dev_accuracy, avg_dev_loss, best_dev_accuracy,
+                        best_dev_epoch, best_avg_dev_loss, patience, improve_on_tie=True)
+
+                    print 'epoch: {0} train loss: {1:.4f} dev loss: {2:.4f} dev accuracy: {3:.4f} train accuracy = \
+{4:.4f} best dev accuracy {5:.4f} (epoch {8}) best train accuracy: {6:.4f} (epoch {9}) patience = {7}'.format(
                                                                                                 e,
                                                                                                 avg_loss,
                                                                                                 avg_dev_loss,
@@ -418,17 +537,16 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
                                                                                                 patience,
                                                                                                 best_dev_epoch,
                                                                                                 best_train_epoch)
+                    if dev_epoch != e:
+                        print 'dev results of epoch {0}'.format(dev_epoch)
 
-                log_to_file(results_file_path + '_log.txt', e, avg_loss, train_accuracy, dev_accuracy)
+                    log_to_file(results_file_path + '_log.txt', e, avg_loss, train_accuracy, dev_accuracy)
 
-                if patience == MAX_PATIENCE:
-                        print 'out of patience after {0} epochs'.format(str(e))
-                        # TODO: would like to return best model but pycnn has a bug with save and load. Maybe copy via code?
-                        # return best_model[0]
-                        train_progress_bar.finish()
-                        if plot:
-                            plt.cla()
-                        return model, e
+                    # found "perfect" model or patience has reached
+                    if dev_accuracy == 1 or patience == MAX_PATIENCE:
+                        if patience == MAX_PATIENCE:
+                            print 'out of patience after {0} epochs'.format(str(e))
+                        stop = True
             else:
 
                 # if no dev set is present, optimize on train set
@@ -449,11 +567,7 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
                 patience = {4}'.format(e, avg_loss, train_accuracy, best_train_accuracy, patience)
 
                 # found "perfect" model on train set or patience has reached
-                if train_accuracy == 1 or patience == MAX_PATIENCE:
-                    train_progress_bar.finish()
-                    if plot:
-                        plt.cla()
-                    return model, e
+                stop = train_accuracy == 1 or patience == MAX_PATIENCE
 
             # update lists for plotting
             train_accuracy_y.append(train_accuracy)
@@ -461,6 +575,28 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
             train_loss_y.append(avg_loss)
             dev_loss_y.append(avg_dev_loss)
             dev_accuracy_y.append(dev_accuracy)
+            eval_seconds = time.time() - eval_start
+
+        epoch_examples = sampler.epoch_examples(e)
+        telemetry.write_epoch(e, len(epoch_examples), sum([example_chars[k] for k in epoch_examples]), train_seconds,
+                              OrderedDict([('eval_seconds', eval_seconds), ('dev_seconds', dev_seconds),
+                                           ('avg_loss', avg_loss), ('dev_epoch', dev_epoch),
+                                           ('dev_accuracy', dev_accuracy if dev_epoch is not None else None),
+                                           ('avg_dev_loss', avg_dev_loss if dev_epoch is not None else None)]))
+
+        if stop:
+            # TODO: would like to return best model but pycnn has a bug with save and load. Maybe copy via code?
+            # return best_model[0]
+            best_dev_epoch = common.finish_dev_evaluation(dev_evaluator, get_dev_accuracy, save_best,
+                                                          best_dev_accuracy, best_dev_epoch, best_avg_dev_loss,
+                                                          patience, improve_on_tie=True)
+            common.write_checkpoint(checkpoint_writer, model, trainer, results_file_path, model_metadata, e, True,
+                                    False, get_counters(), learning_curves)
+            checkpoint_writer.wait()
+            train_progress_bar.finish()
+            if plot:
+                plt.cla()
+            return model, e, best_train_epoch
 
         # finished epoch
         train_progress_bar.update(e)
@@ -474,6 +610,14 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
                 plt.legend(loc='upper left', handles=[p1, p2, p3, p4])
             plt.savefig(results_file_path + 'plot.png')
 
+        if (e + 1) % checkpoint_every == 0 or e == epochs - 1:
+            common.write_checkpoint(checkpoint_writer, model, trainer, results_file_path, model_metadata, e, False,
+                                    dev_evaluator is not None and dev_evaluator.pending is not None, get_counters(),
+                                    learning_curves)
+
+    best_dev_epoch = common.finish_dev_evaluation(dev_evaluator, get_dev_accuracy, save_best, best_dev_accuracy,
+                                                  best_dev_epoch, best_avg_dev_loss, patience, improve_on_tie=True)
+    checkpoint_writer.wait()
     train_progress_bar.finish()
     if plot:
         plt.cla()
@@ -483,6 +627,22 @@ def train_model(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_
     return model, e, best_train_epoch
 
 
+# the dev predictions of a model and its average loss on dev
+def evaluate_dev(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, W_c, W__a, U__a,
+                 v__a, dev_lemmas, dev_feat_dicts, dev_words, alphabet_index, inverse_alphabet_index, feat_index,
+                 feature_types):
+    dev_predictions = predict_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn,
+                                        decoder_rnn, W_c, W__a, U__a, v__a, alphabet_index, inverse_alphabet_index,
+                                        dev_lemmas, dev_feat_dicts, feat_index, feature_types)
+    total_dev_loss = 0
+    for i in xrange(len(dev_lemmas)):
+        total_dev_loss += compute_loss(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn,
+                                       decoder_rnn, W_c, W__a, U__a, v__a, dev_lemmas[i], dev_feat_dicts[i],
+                                       dev_words[i], alphabet_index, feat_index, feature_types).value()
+
+    return dev_predictions, total_dev_loss / float(len(dev_lemmas))
+
+
 def log_to_file(file_name, e, avg_loss, train_accuracy, dev_accuracy):
 
     # if first write, add headers
@@ -517,6 +677,7 @@ def compute_loss(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder
 
     blstm_outputs = encode_feats_and_chars(alphabet_index, char_lookup, encoder_frnn, encoder_rrnn, feat_index,
                                            feat_lookup, feats, feature_types, lemma)
+    H, U__a_H = stack_blstm_outputs(blstm_outputs, U__a)
 
     # initialize the decoder rnn
     s_0 = decoder_rnn.initial_state()
@@ -534,7 +695,7 @@ def compute_loss(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder
         s = s.add_input(prev_output_vec)
         decoder_rnn_output = s.output()
 
-        attention_output_vector, alphas, W = attend(blstm_outputs, decoder_rnn_output, W_c, v__a, W__a, U__a)
+        attention_output_vector, alphas, W = attend(H, U__a_H, decoder_rnn_output, W_c, v__a, W__a)
 
         # compute output probabilities
         # print 'computing readout layer...'
@@ -610,6 +771,7 @@ def predict_output_sequence(model, char_lookup, feat_lookup, R, bias, encoder_fr
 
     blstm_outputs = encode_feats_and_chars(alphabet_index, char_lookup, encoder_frnn, encoder_rrnn, feat_index,
                                            feat_lookup, feats, feature_types, lemma)
+    H, U__a_H = stack_blstm_outputs(blstm_outputs, U__a)
 
     # initialize the decoder rnn
     s_0 = decoder_rnn.initial_state()
@@ -628,7 +790,7 @@ def predict_output_sequence(model, char_lookup, feat_lookup, R, bias, encoder_fr
         decoder_rnn_output = s.output()
 
         # perform attention step
-        attention_output_vector, alphas, W = attend(blstm_outputs, decoder_rnn_output, W_c, v__a, W__a, U__a)
+        attention_output_vector, alphas, W = attend(H, U__a_H, decoder_rnn_output, W_c, v__a, W__a)
 
         # compute output probabilities
         # print 'computing readout layer...'
@@ -651,6 +813,57 @@ def predict_output_sequence(model, char_lookup, feat_lookup, R, bias, encoder_fr
     return predicted_sequence[0:-1]
 
 
+# decodes with all the ensemble models in lockstep, choosing each character by the average of their softmax outputs
+def predict_ensemble_output_sequence(ensemble_models, lemma, feats, alphabet_index, inverse_alphabet_index, feat_index,
+                                     feature_types):
+    pc.renew_cg()
+
+    # encode the input and initialize the decoder of each model
+    members = []
+    for em in ensemble_models:
+        model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, W_c, W__a, U__a, v__a = em
+        blstm_outputs = encode_feats_and_chars(alphabet_index, char_lookup, encoder_frnn, encoder_rrnn, feat_index,
+                                               feat_lookup, feats, feature_types, lemma)
+        H, U__a_H = stack_blstm_outputs(blstm_outputs, pc.parameter(U__a))
+        members.append([char_lookup, pc.parameter(R), pc.parameter(bias), pc.parameter(W_c), pc.parameter(W__a),
+                        pc.parameter(v__a), H, U__a_H, decoder_rnn.initial_state()])
+
+    # set prev_output_vec for first lstm step as BEGIN_WORD
+    next_char_index = alphabet_index[BEGIN_WORD]
+    i = 0
+    predicted_sequence = []
+
+    # run the decoders through the sequence and predict characters
+    while i < MAX_PREDICTION_LEN:
+        member_probs = []
+        for member in members:
+            char_lookup, R, bias, W_c, W__a, v__a, H, U__a_H, s = member
+
+            # get current h of the decoder - "feedback" of the previous ensemble prediction
+            s = s.add_input(char_lookup[next_char_index])
+            member[-1] = s
+
+            # perform attention step
+            attention_output_vector, alphas, W = attend(H, U__a_H, s.output(), W_c, v__a, W__a)
+
+            # compute output probabilities
+            member_probs.append(pc.softmax(R * attention_output_vector + bias))
+
+        # find best candidate output according to the averaged probabilities
+        probs = pc.esum(member_probs) * (1.0 / len(members))
+        next_char_index = common.argmax(probs.vec_value())
+        predicted_sequence.append(inverse_alphabet_index[next_char_index])
+
+        # check if reached end of word
+        if predicted_sequence[-1] == END_WORD:
+            break
+
+        i += 1
+
+    # remove the end word symbol
+    return predicted_sequence[0:-1]
+
+
 def encode_feats_and_chars(alphabet_index, char_lookup, encoder_frnn, encoder_rrnn, feat_index, feat_lookup, feats,
                            feature_types, lemma):
 
@@ -687,40 +900,32 @@ def encode_feats_and_chars(alphabet_index, char_lookup, encoder_frnn, encoder_rr
     return blstm_outputs
 
 
+# stacks the BiLSTM outputs of a word as the columns of a matrix, and computes their part of the attention scores,
+# which is the same for all the decoder steps
+def stack_blstm_outputs(blstm_outputs, U__a):
+    H = pc.concatenate_cols(blstm_outputs)
+    return H, U__a * H
+
+
 # Loung-style attention mechanism:
-def attend(blstm_outputs, h_t, W_c, v_a, W__a, U__a):
-    # iterate through input states to compute alphas
-    # print 'computing scores...'
-    # scores = [W_a * pc.concatenate([h_t, h_input]) for h_input in blstm_outputs]
-    scores = [v_a * pc.tanh(W__a * h_t + U__a * h_input) for h_input in blstm_outputs]
-    # print 'computed scores'
+def attend(H, U__a_H, h_t, W_c, v_a, W__a, return_W=False):
+    # compute the scores of all the input states at once - column j is W__a * h_t + U__a * h_input_j
+    scores = v_a * pc.tanh(pc.colwise_add(U__a_H, W__a * h_t))
+
     # normalize to alphas using softmax
-    # print 'computing alphas...'
-    alphas = pc.softmax(pc.concatenate(scores))
-    # print 'computed alphas...'
+    alphas = pc.softmax(pc.transpose(scores))
+
     # compute c using alphas
-    # print 'computing c...'
-
-    # import time
-    # s = time.time()
-    # dim = len(blstm_outputs[0].vec_value())
-    # stacked_alphas = pc.concatenate_cols([alphas for j in xrange(dim)])
-    # stacked_vecs = pc.concatenate_cols([h_input for h_input in blstm_outputs])
-    # c = pc.esum(pc.cwise_multiply(stacked_vecs, stacked_alphas))
-    # print "stack time:", time.time() - s
-
-    # s = time.time()
-    c = pc.esum([h_input * pc.pick(alphas, j) for j, h_input in enumerate(blstm_outputs)])
-    # print "pick time:", time.time() - s
-    # print 'computed c'
-    # print 'c len is {}'.format(len(c.vec_value()))
+    c = H * alphas
+
     # compute output state h~ using c and the decoder's h (global attention variation from Loung and Manning 2015)
-    # print 'computing h~...'
     h_output = pc.tanh(W_c * pc.concatenate([h_t, c]))
-    # print 'len of h_output is {}'.format(len(h_output.vec_value()))
-    # print 'computed h~'
 
-    return h_output, alphas, W__a.value()
+    # copying the attention parameters to numpy is only needed for visualization
+    if return_W:
+        return h_output, alphas, W__a.value()
+    else:
+        return h_output, alphas, None
 
 
 # Bahdanau style attention
@@ -743,10 +948,11 @@ def attend2(blstm_outputs, s_prev, y_feedback, v_a, W_a, U_a, U_o, V_o, C_o):
     return attention_output_vector, alphas
 
 
+# returns the predicted template of each example, in the order of the examples
 def predict_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, W_c, W__a, U__a, v__a, alphabet_index, inverse_alphabet_index, lemmas,
                       feats, feat_index, feature_types):
     print 'predicting...'
-    predictions = {}
+    predictions = []
     data_len = len(lemmas)
     for i, (lemma, feat_dict) in enumerate(zip(lemmas, feats)):
         predicted_template = predict_output_sequence(model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, W_c, W__a, U__a, v__a, lemma,
@@ -755,8 +961,7 @@ def predict_sequences(model, char_lookup, feat_lookup, R, bias, encoder_frnn, en
         if i % 1000 == 0 and i > 0:
             print 'predicted {} examples out of {}'.format(i, data_len)
 
-        joint_index = lemma + ':' + common.get_morph_string(feat_dict, feature_types)
-        predictions[joint_index] = predicted_template
+        predictions.append(predicted_template)
 
     return predictions
 
@@ -768,8 +973,7 @@ def evaluate_model(predicted_templates, lemmas, feature_dicts, words, feature_ty
     test_data = zip(lemmas, feature_dicts, words)
     c = 0
     for i, (lemma, feat_dict, word) in enumerate(test_data):
-        joint_index = lemma + ':' + common.get_morph_string(feat_dict, feature_types)
-        predicted_word = ''.join(predicted_templates[joint_index])
+        predicted_word = ''.join(predicted_templates[i])
         if predicted_word == word:
             c += 1
             sign = 'V'
@@ -868,9 +1072,33 @@ if __name__ == '__main__':
         ensemble_param = arguments['--ensemble']
     else:
         ensemble_param = False
+    if arguments['--ensemble-mode']:
+        ensemble_mode_param = arguments['--ensemble-mode']
+    else:
+        ensemble_mode_param = ENSEMBLE_MODE
+    if ensemble_mode_param not in ENSEMBLE_MODES:
+        raise ValueError('--ensemble-mode must be one of {}, got {}'.format('/'.join(ENSEMBLE_MODES),
+                                                                          ensemble_mode_param))
+    if arguments['--async-eval']:
+        async_eval_param = True
+    else:
+        async_eval_param = False
+    if arguments['--checkpoint-every']:
+        checkpoint_every_param = int(arguments['--checkpoint-every'])
+    else:
+        checkpoint_every_param = CHECKPOINT_EVERY
+    if arguments['--resume']:
+        resume_param = True
+    else:
+        resume_param = False
+    if arguments['--curriculum']:
+        curriculum_epochs_param = int(arguments['--curriculum'])
+    else:
+        curriculum_epochs_param = CURRICULUM_EPOCHS
 
     print arguments
 
     main(train_path_param, dev_path_param, test_path_param, results_file_path_param, sigmorphon_root_dir_param,
          input_dim_param, hidden_dim_param, feat_input_dim_param, epochs_param, layers_param, optimization_param,
-         regularization_param, learning_rate_param, plot_param, override_param, eval_param, ensemble_param)
+         regularization_param, learning_rate_param, plot_param, override_param, eval_param, ensemble_param,
+         ensemble_mode_param, async_eval_param, checkpoint_every_param, resume_param, curriculum_epochs_param)
@@ -411,25 +411,10 @@ def init_model(dev_path, feat_input_dim, hidden_dim, input_dim, layers, results_
     (train_words, train_lemmas, train_feat_dicts) = prepare_sigmorphon_data.load_data(train_path)
     (test_words, test_lemmas, test_feat_dicts) = prepare_sigmorphon_data.load_data(test_path)
     (dev_words, dev_lemmas, dev_feat_dicts) = prepare_sigmorphon_data.load_data(dev_path)
-    alphabet, feature_types = prepare_sigmorphon_data.get_alphabet(train_words, train_lemmas, train_feat_dicts)
-    # used for character dropout
-    alphabet.append(NULL)
-    alphabet.append(UNK)
-    # used during decoding
-    alphabet.append(EPSILON)
-    alphabet.append(BEGIN_WORD)
-    alphabet.append(END_WORD)
-    # add indices to alphabet - used to indicate when copying from lemma to word
-    for marker in [str(i) for i in xrange(MAX_PREDICTION_LEN)]:
-        alphabet.append(marker)
-
-    # char 2 int
-    alphabet_index = dict(zip(alphabet, range(0, len(alphabet))))
-    inverse_alphabet_index = {index: char for char, index in alphabet_index.items()}
-    # feat 2 int
-    feature_alphabet = common.get_feature_alphabet(train_feat_dicts)
-    feature_alphabet.append(UNK_FEAT)
-    feat_index = dict(zip(feature_alphabet, range(0, len(feature_alphabet))))
+    # the alphabets of the model's saved vocabulary, as the trainer built them
+    vocabulary = prepare_sigmorphon_data.find_vocabulary([results_file_path])
+    alphabet, alphabet_index, inverse_alphabet_index, feature_alphabet, feat_index, feature_types = \
+        soft_attention.build_alphabets(train_words, train_lemmas, train_feat_dicts, vocabulary=vocabulary)
     model_file_name = results_file_path + '_bestmodel.txt'
     # load model and everything else needed for prediction
     initial_model, char_lookup, feat_lookup, R, bias, encoder_frnn, encoder_rrnn, decoder_rnn, W_c, W__a, U__a, v__a = soft_attention.load_best_model(
@@ -465,6 +450,7 @@ def predict_output_sequence(model, encoder_frnn, encoder_rrnn, decoder_rnn, lemm
     blstm_outputs = soft_attention.encode_feats_and_chars(alphabet_index, char_lookup, encoder_frnn,
                                                           encoder_rrnn, feat_index, feat_lookup,
                                                           feats, feature_types, lemma)
+    H, U__a_H = soft_attention.stack_blstm_outputs(blstm_outputs, U__a)
     feat_list = []
     for feat in sorted(feature_types):
         if feat in feats:
@@ -488,8 +474,8 @@ def predict_output_sequence(model, encoder_frnn, encoder_rrnn, decoder_rnn, lemm
         decoder_rnn_output = s.output()
 
         # perform attention step
-        attention_output_vector, alphas, W = soft_attention.attend(blstm_outputs, decoder_rnn_output,
-                                                                   W_c, v__a, W__a, U__a)
+        attention_output_vector, alphas, W = soft_attention.attend(H, U__a_H, decoder_rnn_output,
+                                                                   W_c, v__a, W__a, return_W=True)
         val = alphas.vec_value()
         print 'alphas:'
         print val